@@ -1,127 +1,169 @@
-import base64
-import json
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, Tuple
 
-import yaml
-from fastapi import Depends, FastAPI, HTTPException, Response
-from sqlmodel import Session, select
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.api.routes import papers
 from app.core.config import settings
-from app.core.database import get_session
-from app.core.models import Route, User
-from app.utils.dns_factory import DNSFactory
-from app.utils.routing_factory import RoutingFactory
-from app.utils.xray_config_factory import OutboundFactory
-
-app = FastAPI()
+from app.core.database import get_async_session, init_db
+from app.core.grpc_client import AzenordXrayAsyncControl
+from app.core.metrics import metrics
+from app.core.models import User
+from app.utils.compression import CompressedBodyCache, compress, negotiate_encoding
+from app.utils.mesh_snapshot import MeshSnapshot, mesh_cache
+from app.utils.traffic_collector import parse_duration, traffic_series, traffic_totals
+
+# Формат подписки -> Content-Type
+SUB_FORMATS = {"json": "application/json", "clash": "text/yaml; charset=utf-8"}
+# Клиенты, которые понимают только Clash YAML
+CLASH_USER_AGENTS = ("clash", "mihomo", "stash")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Идемпотентно: докатывает MeshState и триггеры версий на старые базы
+    init_db()
+    # Один aio-канал к Xray на воркер; создается внутри event loop воркера
+    app.state.xray = AzenordXrayAsyncControl()
+    yield
+    await app.state.xray.close()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(papers.router)
 
+# Сжатые варианты тел: пересжатие только при смене версии меша, а не на каждый опрос
+body_cache = CompressedBodyCache(settings.SUB_CACHE_BYTES)
+
+
+def get_xray(request: Request) -> AzenordXrayAsyncControl:
+    return request.app.state.xray
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak-сравнение If-None-Match (RFC 9110): W/ префикс не учитывается"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+def negotiate_format(fmt: Optional[str], user_agent: Optional[str]) -> str:
+    """?format= важнее User-Agent; по умолчанию — JSON Xray"""
+    if fmt:
+        fmt = fmt.lower()
+        if fmt not in SUB_FORMATS:
+            raise HTTPException(status_code=400, detail="Azenord: Unknown subscription format")
+        return fmt
+    agent = (user_agent or "").lower()
+    return "clash" if any(name in agent for name in CLASH_USER_AGENTS) else "json"
+
+
+async def encode_subscription(
+    snapshot: MeshSnapshot, user_uuid: str, email: str, fmt: str, accept_encoding: Optional[str]
+) -> Tuple[bytes, str]:
+    """Тело подписки в лучшей кодировке, которую принимает клиент"""
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding == "identity":
+        return snapshot.render(user_uuid, email, fmt), encoding
+
+    version = snapshot.version
+    key = f"{user_uuid}:{fmt}"
+    body = body_cache.get(version, key, encoding) if version else None
+    if body is None:
+        # Сжатие тела в сотни КБ — десятки мс CPU: не держим на нем event loop воркера
+        body = await run_in_threadpool(compress, snapshot.render(user_uuid, email, fmt), encoding)
+        if version:
+            body_cache.put(version, key, encoding, body)
+    return body, encoding
+
 
 @app.get("/v1/sub/{user_uuid}")
-async def get_subscription(user_uuid: str, session: Session = Depends(get_session)):
-    # 1. Fetch Data
-    user = session.exec(select(User).where(User.uuid == user_uuid, User.is_active)).first()
-    if not user:
+async def get_subscription(
+    user_uuid: str,
+    fmt: Optional[str] = Query(None, alias="format", description="json | clash"),
+    user_agent: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+    session: AsyncSession = Depends(get_async_session),
+):
+    # 1. Shared part (DNS hosts, routing, standard outbounds) — из снапшота текущей версии
+    snapshot = await mesh_cache.get(session)
+
+    # 2. Lookup по in-memory индексу: мусорные и забаненные UUID не доходят до SQLite
+    email = snapshot.active_emails.get(user_uuid)
+    if email is None:
         raise HTTPException(status_code=404, detail="Azenord: Invalid subscription")
 
-    all_users = list(session.exec(select(User)).all())
-    db_routes = list(session.exec(select(Route)).all())
+    fmt = negotiate_format(fmt, user_agent)
 
-    # 2. Build Components using Factories
-    dns_hosts = DNSFactory.build_hosts(all_users)
-    routing_rules = RoutingFactory.build_rules(db_routes)
+    # Клиенты опрашивают подписку по таймеру — в 99% случаев ничего не изменилось
+    headers = {"Vary": "Accept-Encoding, User-Agent"}
+    etag = snapshot.etag(user_uuid, email, fmt)
+    if etag:
+        headers.update({"ETag": etag, "Cache-Control": "no-cache"})
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
 
-    # 3. Build Outbounds (Transports)
-    outbounds = [
-        OutboundFactory.create_outbound(tag, user.uuid) for tag in settings.inbound_tags_list
-    ]
-    outbounds = [o for o in outbounds if o]  # Filter empty
-    outbounds.extend(OutboundFactory.get_standard_outbounds())
+    # 3. Per-user outbounds (Transports) вклеиваются в заранее сериализованный шаблон
+    body, encoding = await encode_subscription(snapshot, user_uuid, email, fmt, accept_encoding)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
 
     # Отдаем как ТЕКСТ (это важно для парсеров)
+    return Response(content=body, media_type=SUB_FORMATS[fmt], headers=headers)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    # Наружу не торчит: nginx проксирует только /v1/sub/
+    return metrics.snapshot()
+
+
+@app.get("/stats/users/{user_uuid}")
+async def get_user_stats(
+    user_uuid: str,
+    session: AsyncSession = Depends(get_async_session),
+    xray: AzenordXrayAsyncControl = Depends(get_xray),
+):
+    # Внутренний, как и /metrics. Живые счетчики одного юзера (через общий кэш QueryStats)
+    # плюс история, которую коллектор уже сбросил из Xray в SQLite
+    user = await _find_user(session, user_uuid)
+    uplink, downlink = await xray.get_user_traffic(user.email)
+    stored = await session.run_sync(traffic_totals, "user", name=user.email)
+    stored_up, stored_down = stored.get(user.email, (0, 0))
+    return {"email": user.email, "uplink": uplink + stored_up, "downlink": downlink + stored_down}
+
+
+@app.get("/stats/users/{user_uuid}/series")
+async def get_user_series(
+    user_uuid: str,
+    since: str = Query("24h", description="Окно: 15m, 24h, 7d"),
+    step: str = Query("1h", description="Ширина бакета"),
+    session: AsyncSession = Depends(get_async_session),
+):
+    try:
+        window, bucket = parse_duration(since), parse_duration(step)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    user = await _find_user(session, user_uuid)
+    start = int(time.time()) - window
+    series = await session.run_sync(traffic_series, "user", user.email, since=start, step=bucket)
     return {
         "email": user.email,
-        "fakedns": [{"ipPool": "198.18.0.0/16", "poolSize": 65535}],
-        "dns": {
-            "hosts": dns_hosts,
-            "servers": DNSFactory.get_default_servers(),
-            "queryStrategy": "UseIPv4",
-        },
-        "outbounds": outbounds,
-        "routing": {"domainStrategy": "IPIfNonMatch", "rules": routing_rules},
+        "step": bucket,
+        "points": [{"ts": ts, "uplink": up, "downlink": down} for ts, up, down in series],
     }
 
 
-# @app.get("/v1/sub/{user_uuid}")
-# async def get_subscription(user_uuid: str, session: Session = Depends(get_session)):
-#     # 1. Fetch Data (Your original logic)
-#     user = session.exec(select(User).where(User.uuid == user_uuid, User.is_active)).first()
-#     if not user:
-#         return Response(status_code=404)
-
-#     all_users = list(session.exec(select(User)).all())
-#     db_routes = list(session.exec(select(Route)).all())
-
-#     # 2. Use your Factories
-#     dns_hosts = DNSFactory.build_hosts(all_users)
-#     # We convert your routing_rules (JSON) into Clash-style rules (String list)
-#     clash_rules = [f"DOMAIN-SUFFIX,{settings.MESH_DOMAIN},🚀 Azenord-Mesh"]
-#     for r in db_routes:
-#         # Example mapping of your custom routes to Clash format
-#         clash_rules.append(f"DOMAIN-KEYWORD,{r.pattern},🚀 Azenord-Mesh")
-#     clash_rules.append("MATCH,DIRECT")
-
-#     # 3. Build Outbounds
-#     # We extract your outbound logic into Clash proxy format
-#     proxies = []
-#     for tag in settings.inbound_tags_list:
-#         outbound = OutboundFactory.create_outbound(tag, user.uuid)
-#         if outbound:
-#             # Reformatting Xray JSON outbound to Clash Proxy YAML
-#             proxy = {
-#                 "name": f"Azenord-{tag}",
-#                 "type": "vless",
-#                 "server": settings.XRAY_DOMAIN,
-#                 "port": outbound["settings"]["vnext"][0]["port"],
-#                 "uuid": user.uuid,
-#                 "tls": True,
-#                 "servername": settings.XRAY_DOMAIN,
-#                 "network": outbound["streamSettings"]["network"],
-#             }
-#             # Handle transport-specific opts
-#             if proxy["network"] == "tcp":
-#                 proxy["flow"] = "xtls-rprx-vision"
-#             elif proxy["network"] == "xhttp":
-#                 proxy["xhttp-opts"] = {
-#                     "path": settings.XHTTP_PATH,
-#                     "mode": "stream-one",
-#                     "extra-alpn": outbound["streamSettings"]["tlsSettings"]["alpn"],
-#                 }
-#             proxies.append(proxy)
-
-#     # 4. Final Clash Assembly (Nothing lost)
-#     clash_config = {
-#         "version": "2.0",  # Kept from your original
-#         "email": user.email,  # Kept from your original
-#         "proxies": proxies,
-#         "proxy-groups": [
-#             {"name": "🚀 Azenord-Mesh", "type": "select", "proxies": [p["name"] for p in proxies]}
-#         ],
-#         "dns": {
-#             "enable": True,
-#             "enhanced-mode": "fake-ip",
-#             "fake-ip-range": "198.18.0.1/16",
-#             "nameserver": DNSFactory.get_default_servers(),
-#             "hosts": dns_hosts,  # YOUR MESH PHONEBOOK
-#             "query-strategy": "UseIPv4",  # Kept from your original
-#         },
-#         "rules": clash_rules,
-#     }
-
-#     yaml_data = yaml.dump(clash_config, allow_unicode=True, sort_keys=False)
-
-#     return Response(
-#         content=yaml_data,
-#         media_type="text/yaml",
-#         headers={"Subscription-Userinfo": "upload=0;download=0;total=107374182400;expire=0"},
-#     )
+async def _find_user(session: AsyncSession, user_uuid: str) -> User:
+    user = (await session.exec(select(User).where(User.uuid == user_uuid))).first()
+    if user is None:
+        raise HTTPException(status_code=404, detail="Azenord: Unknown user")
+    return user
@@ -8,11 +8,13 @@ import qrcode
 from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.core.config import settings
-from app.core.database import get_session
+from app.core.database import get_async_session
 from app.core.models import User
+from app.utils.mesh_snapshot import mesh_cache
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
 TEMPLATE_DIR = BASE_DIR / "templates"
@@ -26,10 +28,14 @@ async def get_resident_papers(
     request: Request,
     user_uuid: str,
     pls: str = Query(..., description="One-time secret token"),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ) -> HTMLResponse:
-    # 1. Find user by UUID
-    user = session.exec(select(User).where(User.uuid == user_uuid)).first()
+    # 1. Find user by UUID (неизвестные UUID отсекаются по индексу снапшота)
+    snapshot = await mesh_cache.get(session)
+    if user_uuid not in snapshot.known_uuids:
+        raise HTTPException(status_code=404, detail="Resident not found")
+
+    user = (await session.exec(select(User).where(User.uuid == user_uuid))).first()
 
     if not user:
         raise HTTPException(status_code=404, detail="Resident not found")
@@ -44,8 +50,8 @@ async def get_resident_papers(
     new_token = secrets.token_hex(64)
     user.papers_token = new_token
     session.add(user)
-    session.commit()
-    session.refresh(user)
+    await session.commit()
+    await session.refresh(user)
 
     sub_url = f"https://{settings.API_DOMAIN}/v1/sub/{user.uuid}"
     qr = qrcode.QRCode(version=1, box_size=10, border=2)
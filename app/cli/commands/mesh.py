@@ -1,14 +1,30 @@
 import os
+import time
+from datetime import datetime
+from typing import Dict, List
 
 import typer
 from rich.console import Console
+from rich.live import Live
 from rich.table import Table
 from sqlmodel import Session, select
 
 from app.cli.utils.xray_client import xray
 from app.core.config import settings
 from app.core.database import engine
+from app.core.grpc_client import INBOUND_STATS, USER_STATS
 from app.core.models import User
+from app.utils.ipam import pool_usage
+from app.utils.quota import QuotaEnforcer
+from app.utils.rates import RateEngine, RateRow
+from app.utils.sys_stats import sys_series
+from app.utils.traffic_collector import (
+    TrafficCollector,
+    parse_counters,
+    parse_duration,
+    traffic_series,
+    traffic_totals,
+)
 
 app = typer.Typer(help="Управление Mesh-сетью")
 console = Console()
@@ -18,8 +34,16 @@ console = Console()
 def mesh_status():
     """Проверка здоровья: gRPC адрес из .env и SQLite"""
     console.print(f"🔍 Цель: [bold]{settings.XRAY_GRPC_ADDR}[/bold]")
-    if xray.check_connection():
+    # GetSysStats — одновременно проба здоровья и рантайм Xray
+    runtime = xray.get_sys_stats()
+    if runtime is not None:
         console.print("[green]✔ Xray gRPC: ONLINE[/green]")
+        console.print(
+            f"  ⏱ Uptime: {_uptime(runtime['uptime'])} | "
+            f"goroutines: {runtime['goroutines']} | "
+            f"heap: {runtime['alloc'] / 1024**2:.1f} MB (sys {runtime['sys'] / 1024**2:.1f} MB) | "
+            f"GC: {runtime['num_gc']} runs, {runtime['pause_total_ns'] / 1e6:.1f} ms paused"
+        )
         with Session(engine) as session:
             count = len(session.exec(select(User)).all())
             console.print(f"[green]✔ Database: OK ({count} users)[/green]")
@@ -27,16 +51,26 @@ def mesh_status():
         console.print("[red]✘ Xray gRPC: OFFLINE[/red]")
 
 
+def _uptime(seconds: int) -> str:
+    days, rest = divmod(seconds, 86_400)
+    return f"{days}d {rest // 3600:02d}h {rest % 3600 // 60:02d}m"
+
+
 @app.command("stats")  # Оставляем одну главную команду stats
 def mesh_stats():
     """Общая статистика потребления сети всей Mesh-сетью"""
-    all_stats = xray.get_traffic_stats()
-    if not all_stats:
+    # Живые счетчики инбаундов (с последнего сброса коллектором или рестарта Xray)
+    # плюс все, что коллектор уже сохранил в SQLite
+    live = parse_counters(xray.get_inbound_traffic())
+    with Session(engine) as session:
+        stored = traffic_totals(session, "inbound")
+
+    if not live and not stored:
         console.print("[yellow]Статистика недоступна (Xray offline?)[/yellow]")
         return
 
-    total_down = sum(v for k, v in all_stats.items() if "downlink" in k)
-    total_up = sum(v for k, v in all_stats.items() if "uplink" in k)
+    total_up = sum(up for up, _ in stored.values()) + sum(up for up, _ in live.values())
+    total_down = sum(down for _, down in stored.values()) + sum(down for _, down in live.values())
 
     console.print("📊 [bold]Mesh Total Traffic:[/bold]")
     console.print(f"⬇ Download: [cyan]{total_down / 1024**3:.2f}[/cyan] GB")
@@ -46,7 +80,8 @@ def mesh_stats():
 @app.command("user-stats")  # Переименовываем детальную таблицу
 def user_stats():
     """📊 Детальная статистика трафика по каждому входу/юзеру"""
-    data = xray.get_traffic_stats()
+    # Инбаунды и юзеры; outbound-счетчики сюда не тянем
+    data = {**xray.query_stats(INBOUND_STATS), **xray.query_stats(USER_STATS)}
     if not data:
         console.print("[yellow]Нет данных.[/yellow]")
         return
@@ -67,7 +102,7 @@ def user_stats():
 
 @app.command("scan")
 def mesh_scan():
-    """Пинг всех активных IP в Mesh (10.0.8.0/24)"""
+    """Пинг всех активных IP в Mesh (пулы MESH_POOLS)"""
     console.print("[bold cyan]📡 Сканирование Mesh-сети...[/bold cyan]")
     with Session(engine) as session:
         users = session.exec(select(User).where(User.is_active)).all()
@@ -75,3 +110,196 @@ def mesh_scan():
             response = os.system(f"ping -n 1 -w 1000 {u.internal_ip} > nul")
             status = "[green]ONLINE[/green]" if response == 0 else "[red]OFFLINE[/red]"
             console.print(f"Resident: {u.nickname:15} | IP: {u.internal_ip:12} | {status}")
+
+
+@app.command("pools")
+def mesh_pools():
+    """🧮 Адресные пулы меша: занято / аренды / емкость"""
+    with Session(engine) as session:
+        usage = pool_usage(session)
+
+    table = Table(title="Mesh Address Pools")
+    table.add_column("Pool", style="magenta")
+    table.add_column("Subnet", style="cyan")
+    table.add_column("Used", justify="right")
+    table.add_column("Leased", justify="right")
+    table.add_column("Free", justify="right")
+    table.add_column("Util", justify="right")
+    for pool in usage:
+        color = "red" if pool.free == 0 else "yellow" if pool.utilization >= 0.9 else "green"
+        table.add_row(
+            pool.name,
+            pool.subnet,
+            str(pool.used),
+            str(pool.leased),
+            str(pool.free),
+            f"[{color}]{pool.utilization:.1%}[/{color}]"
+            + (" [dim](stale)[/dim]" if pool.stale else ""),
+        )
+    console.print(table)
+
+
+@app.command("collect")
+def mesh_collect(
+    interval: float = typer.Option(
+        settings.TRAFFIC_COLLECT_INTERVAL, "--interval", help="Период опроса Xray, сек"
+    ),
+    once: bool = typer.Option(False, "--once", help="Один замер и выход (для cron/systemd timer)"),
+    enforce: bool = typer.Option(True, "--enforce/--no-enforce", help="Автобан по квотам"),
+    sys_stats: bool = typer.Option(
+        True, "--sys/--no-sys", help="Писать рантайм Xray (GetSysStats)"
+    ),
+):
+    """📥 Коллектор трафика: QueryStats(reset) -> история в SQLite (+ учет квот)"""
+    enforcer = QuotaEnforcer() if enforce else None
+    collector = TrafficCollector(lambda: Session(engine), on_deltas=enforcer, sample_sys=sys_stats)
+    try:
+        if once:
+            deltas = collector.collect_once()
+            console.print(f"[green]✔ Collected {len(deltas)} sources[/green]")
+            return
+        console.print(f"[bold cyan]📥 Collecting every {interval:g}s (Ctrl+C to stop)[/bold cyan]")
+        collector.run_forever(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.close()
+
+
+@app.command("traffic")
+def mesh_traffic(
+    nickname: str = typer.Argument(None, help="Резидент; без него — все инбаунды"),
+    since: str = typer.Option("24h", "--since", help="Окно: 15m, 24h, 7d, 4w"),
+    step: str = typer.Option("1h", "--step", help="Шаг ряда для резидента"),
+):
+    """📈 История трафика из SQLite (собирает `mesh collect`)"""
+    try:
+        window, bucket = parse_duration(since), parse_duration(step)
+    except ValueError as e:
+        console.print(f"[red]{e}[/red]")
+        raise typer.Exit(1)
+    start = int(time.time()) - window
+
+    with Session(engine) as session:
+        if nickname is None:
+            table = Table(title=f"Inbound traffic, last {since}")
+            table.add_column("Inbound", style="cyan")
+            table.add_column("⬆ Up", style="magenta", justify="right")
+            table.add_column("⬇ Down", style="green", justify="right")
+            for tag, (up, down) in sorted(traffic_totals(session, "inbound", since=start).items()):
+                table.add_row(tag, f"{up / 1024**2:.2f} MB", f"{down / 1024**2:.2f} MB")
+            console.print(table)
+            return
+
+        user = session.exec(select(User).where(User.nickname == nickname)).first()
+        if not user:
+            console.print("[red]Юзер не найден[/red]")
+            raise typer.Exit(1)
+        series = traffic_series(session, "user", user.email, since=start, step=bucket)
+
+    table = Table(title=f"{nickname}: last {since}, step {step}")
+    table.add_column("From", style="dim")
+    table.add_column("⬆ Up", style="magenta", justify="right")
+    table.add_column("⬇ Down", style="green", justify="right")
+    for ts, up, down in series:
+        moment = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
+        table.add_row(moment, f"{up / 1024**2:.2f} MB", f"{down / 1024**2:.2f} MB")
+    console.print(table)
+
+
+def _rate(value: float) -> str:
+    """байт/с -> Mbit/s"""
+    return f"{value * 8 / 1_000_000:.2f}"
+
+
+def _top_table(rows: List[RateRow], names: Dict[str, str], users: int, interval: float) -> Table:
+    table = Table(title=f"Top users ({users} tracked, every {interval:g}s), Mbit/s")
+    table.add_column("Resident", style="cyan")
+    table.add_column("⬆ Now", style="magenta", justify="right")
+    table.add_column("⬇ Now", style="green", justify="right")
+    table.add_column("⬆ Avg", style="dim", justify="right")
+    table.add_column("⬇ Avg", style="dim", justify="right")
+    for row in rows:
+        table.add_row(
+            names.get(row.email, row.email),
+            _rate(row.up),
+            _rate(row.down),
+            _rate(row.avg_up),
+            _rate(row.avg_down),
+        )
+    return table
+
+
+@app.command("top")
+def mesh_top(
+    limit: int = typer.Option(15, "-n", "--limit", help="Сколько юзеров показать"),
+    interval: float = typer.Option(
+        settings.RATE_SAMPLE_INTERVAL, "--interval", help="Период замера, сек"
+    ),
+    window: int = typer.Option(
+        settings.RATE_WINDOW, "--window", help="Окно скользящего среднего, замеров"
+    ),
+    sort: str = typer.Option("total", "--sort", help="total | up | down | avg"),
+    count: int = typer.Option(0, "--count", help="Сколько обновлений (0 — до Ctrl+C)"),
+):
+    """🔥 Кто грузит узел прямо сейчас: скорости юзеров, live"""
+    if sort not in ("total", "up", "down", "avg"):
+        console.print(f"[red]Unknown sort: {sort}[/red]")
+        raise typer.Exit(1)
+
+    with Session(engine) as session:
+        names = {u.email: u.nickname for u in session.exec(select(User)).all()}
+
+    rates = RateEngine(window)
+    # Базовый замер: скорость считается со второго
+    rates.sample(xray.query_stats(USER_STATS, max_age=0))
+    updates = 0
+    try:
+        with Live(console=console, auto_refresh=False) as live:
+            while not count or updates < count:
+                time.sleep(interval)
+                rates.sample(xray.query_stats(USER_STATS, max_age=0))
+                rows = rates.top(limit, sort)
+                live.update(_top_table(rows, names, len(rates), interval), refresh=True)
+                updates += 1
+    except KeyboardInterrupt:
+        pass
+
+
+@app.command("sys")
+def mesh_sys(
+    since: str = typer.Option("24h", "--since", help="Окно: 6h, 24h, 7d"),
+    step: str = typer.Option("1h", "--step", help="Ширина бакета"),
+):
+    """🧠 Память и GC Xray против числа юзеров и трафика (пишет `mesh collect`)"""
+    try:
+        window, bucket = parse_duration(since), parse_duration(step)
+    except ValueError as e:
+        console.print(f"[red]{e}[/red]")
+        raise typer.Exit(1)
+
+    with Session(engine) as session:
+        series = sys_series(session, since=int(time.time()) - window, step=bucket)
+    if not series:
+        console.print("[yellow]Нет замеров: запустите `mesh collect`[/yellow]")
+        return
+
+    table = Table(title=f"Xray runtime, last {since}, step {step}")
+    table.add_column("From", style="dim")
+    table.add_column("Heap max", justify="right")
+    table.add_column("Sys max", justify="right")
+    table.add_column("Goroutines", justify="right")
+    table.add_column("GC runs", justify="right")
+    table.add_column("Users", style="cyan", justify="right")
+    table.add_column("Traffic", style="green", justify="right")
+    for point in series:
+        table.add_row(
+            datetime.fromtimestamp(point.ts).strftime("%Y-%m-%d %H:%M"),
+            f"{point.max_alloc / 1024**2:.1f} MB",
+            f"{point.max_sys / 1024**2:.1f} MB",
+            str(point.max_goroutines),
+            str(point.gc_runs),
+            f"{point.avg_users:.0f}",
+            f"{point.traffic / 1024**2:.1f} MB",
+        )
+    console.print(table)
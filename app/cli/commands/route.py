@@ -7,6 +7,7 @@ from app.cli.utils.xray_client import xray
 from app.core.constants import InboundTag
 from app.core.database import engine
 from app.core.models import Route, RoutePolicy
+from app.utils.sub_export import refresh_static_export
 
 app = typer.Typer(help="Управление маршрутизацией")
 console = Console()
@@ -33,6 +34,7 @@ def add_route(
         )
         session.add(route)
         session.commit()
+        refresh_static_export(session)
         console.print(f"[green]✔ Rule added for {pattern or 'Port/App'} -> {policy.value}[/green]")
 
 
@@ -44,6 +46,7 @@ def route_remove(route_id: int):
         if route:
             session.delete(route)
             session.commit()
+            refresh_static_export(session)
             console.print(f"[green]✔ Правило {route_id} удалено.[/green]")
 
 
@@ -54,6 +57,7 @@ def route_clear():
         with Session(engine) as session:
             session.query(Route).delete()
             session.commit()
+            refresh_static_export(session)
             console.print("[red]🗑 Таблица маршрутов очищена.[/red]")
 
 
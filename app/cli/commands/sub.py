@@ -1,3 +1,6 @@
+from pathlib import Path
+from typing import Optional
+
 import qrcode
 import typer
 from rich.console import Console
@@ -6,6 +9,7 @@ from sqlmodel import Session, select
 from app.core.config import settings
 from app.core.database import engine
 from app.core.models import User
+from app.utils.sub_export import export_subscriptions
 
 app = typer.Typer(help="Управление подписками")
 console = Console()
@@ -62,3 +66,19 @@ def get_qr(nickname: str):
         qr.print_ascii(invert=True)
 
         console.print(f"\n[dim]URL: {sub_url}[/dim]")
+
+
+@app.command("export")
+def export_subs(
+    out: Optional[Path] = typer.Option(None, "--out", help="Каталог экспорта (SUB_EXPORT_DIR)"),
+):
+    """📦 Выгрузить подписки всех активных юзеров в файлы для прямой раздачи nginx"""
+    with Session(engine) as session:
+        report = export_subscriptions(session, out)
+
+    console.print(
+        f"[bold green]✅ Экспортировано: {report.exported}[/bold green] "
+        f"(собрано тел: {report.rendered}, новых объектов: {report.written}, "
+        f"убрано ссылок: {report.removed}, удалено объектов: {report.collected}) "
+        f"за {report.elapsed_ms:.0f} ms"
+    )
@@ -1,17 +1,28 @@
+import csv
+import time
 import uuid
-from typing import Optional
+from pathlib import Path
+from typing import Annotated, Optional
 
 import typer
 from rich.console import Console
 from rich.panel import Panel
+from rich.progress import BarColumn, MofNCompleteColumn, Progress, TextColumn, TimeElapsedColumn
 from rich.table import Table
 from sqlmodel import Session, select
 
 from app.cli.utils.get_active_tags import get_active_tags
 from app.cli.utils.xray_client import xray
+from app.core.config import settings
 from app.core.database import engine
-from app.core.models import User
-from app.utils.ipam import get_next_free_ip
+from app.core.models import QuotaPeriod, User, UserQuota
+from app.utils.bulk_sync import add_ops, run_bulk_sync
+from app.utils.ipam import cancel_ips, confirm_ips, get_next_free_ip, release_ips
+from app.utils.quota import forget_auto_ban, parse_size, period_start
+from app.utils.reconcile import InboundUsersError, run_reconcile
+from app.utils.sub_export import refresh_static_export
+from app.utils.traffic_collector import traffic_totals
+from app.utils.user_import import FORMATS, detect_format, read_rows, run_import
 
 app = typer.Typer(help="Управление пользователями")
 console = Console()
@@ -24,6 +35,11 @@ def add_user(
     no_sync: Optional[bool] = typer.Option(
         None, "--no-sync", help="Skip Xray gRPC synchronization"
     ),
+    # Annotated: при прямом вызове add_user() дефолт — настоящий None, а не OptionInfo
+    pool: Annotated[
+        Optional[str],
+        typer.Option("--pool", help="Адресный пул из MESH_POOLS (по умолчанию — первый)"),
+    ] = None,
 ):
     """Safe registration with full rollback on failure"""
     if not xray.check_connection() and no_sync is not True:
@@ -38,7 +54,12 @@ def add_user(
             return
 
         new_uuid = str(uuid.uuid4())
-        new_ip = get_next_free_ip(session)
+        # Адрес резервируется арендой сразу: параллельный `user add` его уже не получит
+        try:
+            new_ip = get_next_free_ip(session, pool)
+        except ValueError as e:
+            console.print(f"[bold red]❌ {e}[/bold red]")
+            return
         active_tags = get_active_tags()
 
         added_tags = []  # Track where we actually succeeded
@@ -48,17 +69,18 @@ def add_user(
             if no_sync is True:
                 console.print("[blue]ℹ Skipping Xray sync as requested.[/blue]")
             else:
-                for tag in active_tags:
-                    if xray.add_user(inbound_tag=tag.value, email=email, user_uuid=new_uuid):
-                        added_tags.append(tag.value)
-                    else:
-                        raise Exception(f"Failed to add to inbound: {tag.value}")
+                # Все теги параллельно: один round trip вместо одного на транспорт
+                results = xray.add_user_to_tags([t.value for t in active_tags], email, new_uuid)
+                added_tags = [tag for tag, result in results.items() if result]
+                failed = [f"{tag} ({r.error})" for tag, r in results.items() if not r]
+                if failed:
+                    raise Exception(f"Failed to add to inbound: {', '.join(failed)}")
 
             # 3. Database Phase
             user = User(nickname=nickname, email=email, uuid=new_uuid, internal_ip=new_ip)
             session.add(user)
+            confirm_ips(session, [new_ip])
             session.commit()
-            console.print(f"[green]✔ {nickname} синхронизирован во всех транспортах.[/green]")
 
         except Exception as e:
             # 4. ROLLBACK PHASE (The "Safety Net")
@@ -67,11 +89,21 @@ def add_user(
 
             if no_sync is True:
                 console.print("[blue]ℹ Skipping Xray sync as requested.[/blue]")
-            else:
-                for tag in added_tags:
-                    xray.remove_user(inbound_tag=tag, email=email)
+            elif added_tags:
+                xray.remove_user_from_tags(added_tags, email)
+
+            session.rollback()
+            cancel_ips([new_ip])
 
             console.print("[red]Cleanup complete. No changes were saved.[/red]")
+            return
+
+        console.print(f"[green]✔ {nickname} синхронизирован во всех транспортах.[/green]")
+        # Юзер уже в БД и в Xray: сбой экспорта не повод их откатывать
+        try:
+            refresh_static_export(session)
+        except Exception as e:
+            console.print(f"[yellow]⚠ Static export failed: {e}[/yellow]")
 
 
 @app.command("list")
@@ -101,11 +133,15 @@ def remove_user(nickname: str):
             return
 
         tags = ["vless-vision", "vless-h2", "vless-h3"]
-        for tag in tags:
-            xray.remove_user(tag, user.email)
+        xray.remove_user_from_tags(tags, user.email)
 
+        quota = session.get(UserQuota, user.id)
+        if quota:
+            session.delete(quota)
         session.delete(user)
         session.commit()
+        release_ips([user.internal_ip])
+        refresh_static_export(session)
         console.print(f"[green]✔ Юзер {nickname} полностью удален.[/green]")
 
 
@@ -120,19 +156,19 @@ def toggle_user(nickname: str):
         tags = ["vless-vision", "vless-h2", "vless-h3"]
         if user.is_active:
             # БАН: удаляем из памяти Xray
-            for tag in tags:
-                xray.remove_user(tag, user.email)
+            xray.remove_user_from_tags(tags, user.email)
             user.is_active = False
             label = "[red]заблокирован[/red]"
         else:
             # РАЗБАН: возвращаем в память Xray
-            for tag in tags:
-                xray.add_user(tag, user.email, user.uuid)
+            xray.add_user_to_tags(tags, user.email, user.uuid)
             user.is_active = True
             label = "[green]активирован[/green]"
 
+        forget_auto_ban(session, user.id)
         session.add(user)
         session.commit()
+        refresh_static_export(session)
         console.print(f"👤 Юзер {nickname} {label}.")
 
 
@@ -144,11 +180,13 @@ def user_info(nickname: str):
         if not user:
             return console.print("[red]Юзер не найден[/red]")
 
-        # Запрашиваем статы через gRPC
-        all_stats = xray.get_traffic_stats()
-        # Ищем ключ вида user>>>email>>>traffic>>>downlink
-        down = all_stats.get(f"user>>>{user.email}>>>traffic>>>downlink", 0)
-        up = all_stats.get(f"user>>>{user.email}>>>traffic>>>uplink", 0)
+        # Только счетчики этого юзера (user>>>email>>>...), а не вся таблица,
+        # плюс история, которую коллектор уже забрал из Xray со сбросом
+        up, down = xray.get_user_traffic(user.email)
+        stored_up, stored_down = traffic_totals(session, "user", name=user.email).get(
+            user.email, (0, 0)
+        )
+        up, down = up + stored_up, down + stored_down
 
         down_mb = f"{down / 1024**2:.2f} MB"
         up_mb = f"{up / 1024**2:.2f} MB"
@@ -170,6 +208,10 @@ def user_info(nickname: str):
         table.add_row("[bold blue]Traffic Down[/]", down_mb)
         table.add_row("[bold blue]Traffic Up[/]", up_mb)
 
+        quota = session.get(UserQuota, user.id)
+        if quota:
+            table.add_row("[bold blue]Quota[/]", _format_quota(quota))
+
         table.add_section()
 
         # Access Info
@@ -214,24 +256,31 @@ def toggle_user_logic(nickname: str, force_state: bool):
 
         tags = ["vless-vision", "vless-h2", "vless-h3"]
         if force_state is False:  # BAN
-            for tag in tags:
-                xray.remove_user(tag, user.email)
+            xray.remove_user_from_tags(tags, user.email)
             user.is_active = False
             label = "[red]заблокирован[/red]"
         else:  # UNBAN
-            for tag in tags:
-                xray.add_user(tag, user.email, user.uuid)
+            xray.add_user_to_tags(tags, user.email, user.uuid)
             user.is_active = True
             label = "[green]активирован[/green]"
 
+        forget_auto_ban(session, user.id)
         session.add(user)
         session.commit()
+        refresh_static_export(session)
         console.print(f"👤 Юзер {nickname} {label}.")
 
 
 @app.command("sync")
-def sync_all():
-    """Force push all users from DB to Xray"""
+def sync_all(
+    inflight: int = typer.Option(
+        settings.XRAY_SYNC_INFLIGHT, "--inflight", help="Одновременных gRPC-вызовов к Xray"
+    ),
+    strict: bool = typer.Option(
+        False, "--strict", help="Считать 'already exists' ошибкой, а не успехом"
+    ),
+):
+    """Force push all active users from DB to Xray"""
     if not xray.check_connection():
         console.print("[bold red]❌ Cannot sync: Xray gRPC unreachable.[/bold red]")
         return
@@ -239,23 +288,267 @@ def sync_all():
     active_tags = [t.value for t in get_active_tags()]
 
     with Session(engine) as session:
-        users = session.exec(select(User)).all()
+        users = session.exec(select(User).where(User.is_active)).all()
         if not users:
             console.print("[yellow]No users in database to sync.[/yellow]")
             return
+        ops = add_ops([(u.email, u.uuid) for u in users], active_tags)
+
+    with Progress(
+        TextColumn("[bold green]Syncing users to Xray"),
+        BarColumn(),
+        MofNCompleteColumn(),
+        TimeElapsedColumn(),
+        console=console,
+    ) as progress:
+        task = progress.add_task("sync", total=len(ops))
+        report = run_bulk_sync(
+            ops,
+            inflight=inflight,
+            exist_ok=not strict,
+            on_progress=lambda r: progress.update(task, completed=r.done),
+        )
+
+    table = Table(title=f"Sync: {len(users)} users x {len(active_tags)} tags")
+    table.add_column("Tag", style="cyan")
+    table.add_column("Added", style="green", justify="right")
+    table.add_column("Already there", style="dim", justify="right")
+    table.add_column("Failed", style="red", justify="right")
+    for tag, counts in report.by_tag.items():
+        table.add_row(tag, str(counts["applied"]), str(counts["unchanged"]), str(counts["failed"]))
+    console.print(table)
+
+    for op, error in report.failed[:10]:
+        console.print(f"[red]✘[/red] {op.email} -> {op.tag}: {error}")
+    if len(report.failed) > 10:
+        console.print(f"[red]... и еще {len(report.failed) - 10} ошибок[/red]")
+
+    status = "✅ Full sync complete" if report.ok else "⚠ Sync finished with errors"
+    color = "green" if report.ok else "yellow"
+    console.print(
+        f"[bold {color}]{status}[/bold {color}] "
+        f"({report.done} ops, {report.elapsed:.2f}s, {report.rate:.0f} ops/s)"
+    )
+
+
+@app.command("reconcile")
+def reconcile_users(
+    dry_run: bool = typer.Option(False, "--dry-run", help="Только показать план, ничего не менять"),
+    inflight: int = typer.Option(
+        settings.XRAY_SYNC_INFLIGHT, "--inflight", help="Одновременных gRPC-вызовов к Xray"
+    ),
+):
+    """Привести Xray к БД: добавить недостающих, убрать лишних (по GetInboundUsers)"""
+    if not xray.check_connection():
+        console.print("[bold red]❌ Cannot reconcile: Xray gRPC unreachable.[/bold red]")
+        return
+
+    active_tags = [t.value for t in get_active_tags()]
+    with Session(engine) as session:
+        try:
+            result = run_reconcile(session, active_tags, dry_run=dry_run, inflight=inflight)
+        except InboundUsersError as e:
+            # Неизвестный тег ("handler not found") или Xray без GetInboundUsers
+            console.print(
+                f"[bold red]❌ GetInboundUsers failed for {e.tag}:[/bold red] "
+                f"{e.code().name} {e.details()}"
+            )
+            raise typer.Exit(code=1)
+    plan = result.plan
+
+    table = Table(title="Reconcile" + (" (dry run)" if dry_run else ""))
+    table.add_column("Tag", style="cyan")
+    table.add_column("In Xray", justify="right")
+    table.add_column("In DB", justify="right")
+    table.add_column("+ Add", style="green", justify="right")
+    table.add_column("- Remove", style="red", justify="right")
+    for tag in active_tags:
+        adds = sum(1 for op in plan.to_add if op.tag == tag)
+        removes = sum(1 for op in plan.to_remove if op.tag == tag)
+        table.add_row(
+            tag,
+            str(plan.live_counts.get(tag, 0)),
+            str(plan.desired_counts.get(tag, 0)),
+            str(adds),
+            str(removes),
+        )
+    console.print(table)
+
+    if dry_run:
+        for op in (plan.to_remove + plan.to_add)[:20]:
+            sign = "[green]+[/green]" if op.action == "add" else "[red]-[/red]"
+            console.print(f"{sign} {op.email} -> {op.tag}")
+
+    timings = Table(title="Phases", show_header=False)
+    timings.add_column("Phase", style="dim")
+    timings.add_column("ms", justify="right")
+    for phase, ms in result.timings.items():
+        timings.add_row(phase, f"{ms:.1f}")
+    console.print(timings)
+
+    failed = [f for r in (result.removed, result.added) if r for f in r.failed]
+    for op, error in failed[:10]:
+        console.print(f"[red]✘[/red] {op.action} {op.email} -> {op.tag}: {error}")
+
+    if plan.in_sync:
+        console.print("[bold green]✅ Xray already matches the database[/bold green]")
+    elif dry_run:
+        pending = f"{len(plan.to_add)} adds, {len(plan.to_remove)} removes pending"
+        console.print(f"[yellow]Dry run: {pending}[/yellow]")
+    elif result.ok:
+        console.print("[bold green]✅ Reconcile complete[/bold green]")
+    else:
+        console.print(f"[bold yellow]⚠ Reconcile finished with {len(failed)} errors[/bold yellow]")
+
+
+@app.command("import")
+def import_users(
+    path: Path = typer.Argument(
+        ..., exists=True, dir_okay=False, help="CSV (nickname,email[,pool]), JSON Lines или JSON"
+    ),
+    fmt: Optional[str] = typer.Option(
+        None, "--format", help=f"{' | '.join(FORMATS)} (по умолчанию — по расширению)"
+    ),
+    pool: Optional[str] = typer.Option(
+        None, "--pool", help="Пул для строк без колонки pool (по умолчанию — первый)"
+    ),
+    batch_size: int = typer.Option(
+        settings.IMPORT_BATCH_SIZE, "--batch-size", help="Строк на батч (все или ничего)"
+    ),
+    inflight: int = typer.Option(
+        settings.XRAY_SYNC_INFLIGHT, "--inflight", help="Одновременных gRPC-вызовов к Xray"
+    ),
+    no_sync: bool = typer.Option(False, "--no-sync", help="Skip Xray gRPC synchronization"),
+    errors_out: Optional[Path] = typer.Option(
+        None, "--errors", help="Записать ошибки по строкам в CSV"
+    ),
+):
+    """Массовый импорт юзеров из файла: батчами, с откатом батча при сбое"""
+    fmt = fmt or detect_format(path.name)
+    if fmt not in FORMATS:
+        console.print(f"[bold red]❌ Unknown format: {fmt}[/bold red]")
+        return
+    if pool is not None and pool not in settings.mesh_pools:
+        console.print(f"[bold red]❌ Unknown mesh pool: {pool}[/bold red]")
+        return
+    if not no_sync and not xray.check_connection():
+        console.print("[bold red]❌ Cannot import: Xray gRPC unreachable.[/bold red]")
+        return
+
+    active_tags = [t.value for t in get_active_tags()]
+
+    with open(path, newline="", encoding="utf-8") as stream, Session(engine) as session:
+        with Progress(
+            TextColumn("[bold green]Importing users"),
+            TextColumn("{task.completed} rows, {task.fields[created]} created"),
+            TimeElapsedColumn(),
+            console=console,
+        ) as progress:
+            task = progress.add_task("import", total=None, created=0)
+            try:
+                report = run_import(
+                    session,
+                    read_rows(stream, fmt),
+                    active_tags,
+                    sync=not no_sync,
+                    pool=pool,
+                    batch_size=batch_size,
+                    inflight=inflight,
+                    on_batch=lambda r: progress.update(task, completed=r.rows, created=r.created),
+                )
+            except ValueError as e:
+                console.print(f"[bold red]❌ {e}[/bold red]")
+                return
+        if report.created:
+            refresh_static_export(session)
+
+    for err in report.errors[:10]:
+        console.print(f"[red]✘[/red] line {err.line} {err.nickname or '-'}: {err.error}")
+    if len(report.errors) > 10:
+        console.print(f"[red]... и еще {len(report.errors) - 10} ошибок[/red]")
+
+    if errors_out is not None and report.errors:
+        with open(errors_out, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["line", "nickname", "email", "error"])
+            writer.writerows(report.errors)
+        console.print(f"[dim]Ошибки по строкам: {errors_out}[/dim]")
+
+    status = "✅ Import complete" if report.ok else "⚠ Import finished with errors"
+    color = "green" if report.ok else "yellow"
+    console.print(
+        f"[bold {color}]{status}[/bold {color}] "
+        f"({report.created}/{report.rows} created, {len(report.errors)} failed, "
+        f"{report.batches} batches, {report.failed_batches} rolled back, {report.elapsed:.2f}s)"
+    )
+
+
+def _format_quota(quota: UserQuota) -> str:
+    parts = []
+    if quota.total_limit is not None:
+        parts.append(f"{quota.used / 1024**3:.2f} / {quota.total_limit / 1024**3:.2f} GB total")
+    if quota.period is not None and quota.period_limit is not None:
+        parts.append(
+            f"{quota.period_used / 1024**3:.2f} / {quota.period_limit / 1024**3:.2f} GB "
+            f"per {quota.period.value}"
+        )
+    label = ", ".join(parts) or "no limits"
+    return f"[red]{label} (exceeded)[/]" if quota.exceeded_at else label
+
+
+@app.command("quota")
+def user_quota(
+    nickname: str,
+    total: Optional[str] = typer.Option(None, "--total", help="Общий лимит: 500M, 50G, 1T"),
+    period: Optional[QuotaPeriod] = typer.Option(None, "--period", help="day | week | month"),
+    period_limit: Optional[str] = typer.Option(None, "--period-limit", help="Лимит на период"),
+    clear: bool = typer.Option(False, "--clear", help="Снять все лимиты"),
+    reset: bool = typer.Option(False, "--reset", help="Обнулить израсходованное"),
+):
+    """📏 Квота трафика (uplink + downlink). Без опций — показать текущую"""
+    with Session(engine) as session:
+        user = session.exec(select(User).where(User.nickname == nickname)).first()
+        if not user:
+            console.print("[red]Юзер не найден[/red]")
+            raise typer.Exit(1)
+        quota = session.get(UserQuota, user.id)
+
+        if clear:
+            if quota:
+                session.delete(quota)
+                session.commit()
+            console.print(f"[green]✔ Квота {nickname} снята[/green]")
+            return
+
+        if total is None and period is None and period_limit is None and not reset:
+            label = _format_quota(quota) if quota else "no quota"
+            console.print(f"📏 {nickname}: {label}")
+            return
 
-        with console.status("[bold green]Syncing users to Xray..."):
-            for user in users:
-                for tag in active_tags:
-                    success = xray.add_user(inbound_tag=tag, email=user.email, user_uuid=user.uuid)
-                    if success:
-                        console.print(f"[green]✔[/green] {user.nickname} -> {tag}")
-                    else:
-                        console.print(
-                            f"[red]✘[/red] {user.nickname} -> {tag} (likely already exists)"
-                        )
-
-    console.print("[bold green]✅ Full sync complete.[/bold green]")
+        assert user.id is not None
+        try:
+            quota = quota or UserQuota(user_id=user.id)
+            if total is not None:
+                quota.total_limit = parse_size(total)
+            if period_limit is not None:
+                quota.period_limit = parse_size(period_limit)
+                quota.period = period or quota.period or QuotaPeriod.month
+            elif period is not None:
+                quota.period = period
+        except ValueError as e:
+            console.print(f"[red]{e}[/red]")
+            raise typer.Exit(1)
+
+        if quota.period is not None and not quota.period_start:
+            quota.period_start = period_start(quota.period, int(time.time()))
+        if reset:
+            quota.used = quota.period_used = 0
+            # Юзер остается забаненным: вернуть доступ — `user unban`
+            quota.exceeded_at = None
+
+        session.add(quota)
+        session.commit()
+        console.print(f"[green]✔ {nickname}: {_format_quota(quota)}[/green]")
 
 
 @app.command("link")
@@ -1,5 +1,7 @@
 import os
-from typing import List
+from ipaddress import ip_network
+from pathlib import Path
+from typing import Any, Dict, List
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -23,10 +25,61 @@ class Settings(BaseSettings):
     # --- Управление Xray ---
     XRAY_GRPC_ADDR: str = "127.0.0.1:10085"
     INTERNAL_API_ADDR: str = "127.0.0.1:444"
+    # Дедлайн на каждый вызов (сек): зависший Xray не вешает CLI навсегда
+    XRAY_GRPC_TIMEOUT: float = 5.0
+    # Проба здоровья (GetSysStats): свой короткий дедлайн и кэш результата (сек)
+    XRAY_HEALTH_TIMEOUT: float = 1.0
+    XRAY_HEALTH_TTL: float = 2.0
+    # Keepalive канала. Xray (grpc-go) по умолчанию не терпит пинги чаще раза в 5 минут
+    XRAY_GRPC_KEEPALIVE_MS: int = 300_000
+    XRAY_GRPC_KEEPALIVE_TIMEOUT_MS: int = 20_000
+    # Повторы идемпотентных вызовов (Stats, GetInboundUsers) при UNAVAILABLE с backoff.
+    # Каждый повтор считается в метрике xray_grpc.retries
+    XRAY_GRPC_RETRY_ATTEMPTS: int = 4  # всего попыток, включая первую; 1 — без повторов
+    XRAY_GRPC_RETRY_INITIAL_BACKOFF: float = 0.1
+    XRAY_GRPC_RETRY_MAX_BACKOFF: float = 2.0
+    XRAY_GRPC_RETRY_BACKOFF_MULTIPLIER: float = 2.0
+    # Массовая синхронизация (`user sync`): одновременных AlterInbound на узел Xray
+    XRAY_SYNC_INFLIGHT: int = 64
+    # Сколько секунд ответ QueryStats (без reset) переиспользуется CLI и API
+    XRAY_STATS_TTL: float = 2.0
+    # Коллектор трафика (`mesh collect`): период опроса QueryStats(reset=True), сек
+    TRAFFIC_COLLECT_INTERVAL: float = 60.0
+    # Сколько хранить сырые замеры до свертки в часы и часы до свертки в сутки (сек)
+    TRAFFIC_RAW_RETENTION: int = 86_400
+    TRAFFIC_HOURLY_RETENTION: int = 30 * 86_400
+    # Замеры рантайма Xray (GetSysStats) на каждом тике коллектора: сколько хранить (сек)
+    SYS_STATS_RETENTION: int = 30 * 86_400
+    # Автобан по квотам: сколько юзеров за раз выключать в БД и удалять из Xray
+    QUOTA_BAN_BATCH: int = 500
+    # `mesh top`: период замера скоростей (сек) и длина окна скользящего среднего (замеров)
+    RATE_SAMPLE_INTERVAL: float = 2.0
+    RATE_WINDOW: int = 30
+    # Адресные пулы меша: "имя=CIDR" через запятую, первый — пул по умолчанию для
+    # `user add`. IPv6 ULA тоже: "main=10.0.8.0/24,v6=fd8a:2e00:8::/112". Индекс IPAM
+    # держит бит на адрес, поэтому пул — не больше 2^24 адресов (IPv4 /8, IPv6 /104)
+    MESH_POOLS: str = "main=10.0.8.0/24"
+    # IPAM: адрес резервируется арендой до INSERT юзера (пока идет синк с Xray), сек.
+    # Аренда брошенного/упавшего `user add` истекает и адрес возвращается в пул
+    IPAM_LEASE_TTL: int = 600
+    # Повторы резервирования при конфликте (database is locked, IntegrityError)
+    IPAM_RETRY_ATTEMPTS: int = 5
+    # `user import`: строк на батч — один резерв IP, один INSERT, один откат при сбое
+    IMPORT_BATCH_SIZE: int = 500
 
     # --- Инфраструктура ---
     DATABASE_URL: str = "sqlite:///./output/hrm_database.db"
 
+    # --- Кэш подписок (API) ---
+    # Сколько байт сжатых тел (gzip/br) держать в памяти воркера
+    SUB_CACHE_BYTES: int = 64 * 1024 * 1024
+    # Как часто воркер сверяет версию меша с SQLite (сек). Это же — задержка,
+    # с которой воркеры видят изменения из CLI (add/ban/remove, маршруты)
+    MESH_VERSION_TTL: float = 1.0
+    # Статический экспорт подписок (`sub export`): nginx отдает файлы сам, API — только промахи
+    SUB_STATIC_EXPORT: bool = False
+    SUB_EXPORT_DIR: str = "output/sub"
+
     # --- Логика Mesh ---
     # Мы ожидаем строку через запятую: "vless-vision,vless-h2"
     ACTIVE_INBOUND_TAGS: str = "vless-vision,vless-h2,vless-h3"
@@ -45,6 +98,36 @@ class Settings(BaseSettings):
     XRAY_CERT_PATH: str = "/path/to/your/cert"
     XRAY_KEY_PATH: str = "/path/to/your/key"
 
+    @property
+    def async_database_url(self) -> str:
+        """Тот же DATABASE_URL, но через aiosqlite — для async-пути API"""
+        if self.DATABASE_URL.startswith("sqlite://"):
+            return self.DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
+        return self.DATABASE_URL
+
+    @property
+    def sub_export_path(self) -> Path:
+        """Абсолютный путь экспорта (nginx root не понимает относительных путей)"""
+        return Path(self.PROJECT_ROOT) / self.SUB_EXPORT_DIR
+
+    @property
+    def mesh_pools(self) -> Dict[str, str]:
+        """MESH_POOLS -> {имя: CIDR} в порядке объявления; без имени — имя = CIDR"""
+        pools = {}
+        for item in self.MESH_POOLS.split(","):
+            name, _, cidr = item.strip().rpartition("=")
+            if cidr.strip():
+                pools[name.strip() or cidr.strip()] = cidr.strip()
+        return pools
+
+    @property
+    def mesh_fakedns_pools(self) -> List[Dict[str, Any]]:
+        """FakeDNS в xray_config: по записи на пул меша (poolSize Xray — не больше 65535)"""
+        return [
+            {"ipPool": cidr, "poolSize": min(ip_network(cidr).num_addresses, 65535)}
+            for cidr in self.mesh_pools.values()
+        ]
+
     @property
     def inbound_tags_list(self) -> List[str]:
         """Превращает строку из .env в чистый список строк-тегов"""
@@ -1,17 +1,75 @@
+import uuid
+
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from app.core.models import Route, RoutePolicy, User
+from app.core.models import (
+    IpLease,
+    IpPool,
+    MeshState,
+    Route,
+    RoutePolicy,
+    TrafficSample,
+    User,
+    UserQuota,
+    XraySysSample,
+)
 
 from .config import settings
 
 # Теперь база может лежать где угодно, согласно .env
 engine = create_engine(settings.DATABASE_URL, connect_args={"check_same_thread": False})
+# Async-движок для API: запросы к SQLite не блокируют event loop uvicorn
+async_engine = create_async_engine(settings.async_database_url)
+
+# Любое изменение, влияющее на общую часть подписки, бампает MeshState.version.
+# Триггеры живут в самой SQLite, поэтому новую версию видят все процессы (CLI, воркеры
+# gunicorn). Ротация papers_token сюда не входит — на конфиг она не влияет.
+_MESH_FIELDS = "nickname, email, uuid, internal_ip, is_active, dns_name"
+_MESH_TRIGGERS = {
+    "mesh_user_insert": 'AFTER INSERT ON "user"',
+    "mesh_user_update": f'AFTER UPDATE OF {_MESH_FIELDS} ON "user"',
+    "mesh_user_delete": 'AFTER DELETE ON "user"',
+    "mesh_route_insert": 'AFTER INSERT ON "route"',
+    "mesh_route_update": 'AFTER UPDATE ON "route"',
+    "mesh_route_delete": 'AFTER DELETE ON "route"',
+}
+
+# Индекс IPAM (IpPool.bitmap) сверяется с юзерами по счетчику изменений, а не пересчетом
+_IPAM_TRIGGERS = {
+    "ipam_user_insert": 'AFTER INSERT ON "user"',
+    "ipam_user_update": 'AFTER UPDATE OF internal_ip ON "user"',
+    "ipam_user_delete": 'AFTER DELETE ON "user"',
+}
 
 
 def init_db():
     SQLModel.metadata.create_all(engine)
 
+    with engine.begin() as conn:
+        for name, event in _MESH_TRIGGERS.items():
+            conn.exec_driver_sql(
+                f"CREATE TRIGGER IF NOT EXISTS {name} {event} "
+                "BEGIN UPDATE meshstate SET version = version + 1; END"
+            )
+        for name, event in _IPAM_TRIGGERS.items():
+            conn.exec_driver_sql(
+                f"CREATE TRIGGER IF NOT EXISTS {name} {event} "
+                "BEGIN UPDATE ippool SET user_seq = user_seq + 1; END"
+            )
+        # INSERT OR IGNORE: воркеры могут стартовать одновременно
+        conn.exec_driver_sql(
+            "INSERT OR IGNORE INTO meshstate (id, epoch, version) VALUES (1, ?, 0)",
+            (uuid.uuid4().hex,),
+        )
+
 
 def get_session():
     with Session(engine) as session:
         yield session
+
+
+async def get_async_session():
+    async with AsyncSession(async_engine) as session:
+        yield session
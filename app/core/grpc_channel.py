@@ -0,0 +1,167 @@
+import asyncio
+import random
+import time
+from collections import namedtuple
+from typing import Any, Callable, List, Optional, Tuple, Union
+
+import grpc
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+# Идемпотентные вызовы: повтор не меняет состояние Xray.
+# AlterInbound сюда не входит (повторный add -> "already exists"), QueryStats с reset=True —
+# тоже неидемпотентен: такие клиенты создаются с retry=False (см. create_channel).
+IDEMPOTENT_SERVICES = {"xray.app.stats.command.StatsService"}
+IDEMPOTENT_METHODS = {
+    "xray.app.proxyman.command.HandlerService/GetInboundUsers",
+    "xray.app.proxyman.command.HandlerService/GetInboundUsersCount",
+}
+
+
+def is_idempotent(method: str) -> bool:
+    path = method.lstrip("/")
+    return path.split("/", 1)[0] in IDEMPOTENT_SERVICES or path in IDEMPOTENT_METHODS
+
+
+def channel_options() -> List[Tuple[str, Any]]:
+    return [
+        ("grpc.keepalive_time_ms", settings.XRAY_GRPC_KEEPALIVE_MS),
+        ("grpc.keepalive_timeout_ms", settings.XRAY_GRPC_KEEPALIVE_TIMEOUT_MS),
+        # Xray (grpc-go) по умолчанию рвет соединение за пинги без активных вызовов
+        ("grpc.keepalive_permit_without_calls", 0),
+    ]
+
+
+def _method_name(method: Union[str, bytes]) -> str:
+    return method.decode() if isinstance(method, bytes) else method
+
+
+def _record(method: str, code: grpc.StatusCode):
+    metrics.inc("xray_grpc.calls")
+    if code == grpc.StatusCode.DEADLINE_EXCEEDED:
+        metrics.inc("xray_grpc.timeouts")
+        metrics.inc(f"xray_grpc.timeouts.{method.rsplit('/', 1)[-1]}")
+    elif code != grpc.StatusCode.OK:
+        metrics.inc("xray_grpc.errors")
+
+
+# grpc.ClientCallDetails — абстрактный: повтор с урезанным дедлайном собирается заново
+class _CallDetails(
+    namedtuple(
+        "_CallDetails",
+        ("method", "timeout", "metadata", "credentials", "wait_for_ready", "compression"),
+    ),
+    grpc.ClientCallDetails,
+):
+    pass
+
+
+class _Backoff:
+    """Повторы UNAVAILABLE: экспоненциальный backoff с джиттером (как retryPolicy gRPC),
+    все попытки укладываются в дедлайн исходного вызова. Повторы делаются в интерцепторе,
+    а не в service config канала — иначе их не видно и не посчитать"""
+
+    def __init__(self, method: str, timeout: Optional[float]):
+        self.method = method
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.attempt = 1
+        self.backoff = settings.XRAY_GRPC_RETRY_INITIAL_BACKOFF
+
+    def delay(self, code: grpc.StatusCode) -> Optional[float]:
+        """Пауза перед следующей попыткой; None — больше не повторяем"""
+        if code != grpc.StatusCode.UNAVAILABLE:
+            return None
+        if self.attempt >= settings.XRAY_GRPC_RETRY_ATTEMPTS:
+            return None
+        delay = random.uniform(0, self.backoff)
+        if self.deadline is not None and time.monotonic() + delay >= self.deadline:
+            return None
+        self.attempt += 1
+        self.backoff = min(
+            self.backoff * settings.XRAY_GRPC_RETRY_BACKOFF_MULTIPLIER,
+            settings.XRAY_GRPC_RETRY_MAX_BACKOFF,
+        )
+        metrics.inc("xray_grpc.retries")
+        metrics.inc(f"xray_grpc.retries.{self.method.rsplit('/', 1)[-1]}")
+        return delay
+
+    def timeout(self) -> Optional[float]:
+        """Остаток дедлайна для очередной попытки"""
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+
+class _MetricsInterceptor(grpc.UnaryUnaryClientInterceptor):
+    def __init__(self, retry: bool):
+        self.retry = retry
+
+    def intercept_unary_unary(self, continuation: Callable, client_call_details, request):
+        method = _method_name(client_call_details.method)
+        if not (self.retry and is_idempotent(method)):
+            outcome = continuation(client_call_details, request)
+            # Колбэк, а не outcome.code(): code() ждал бы ответа и сериализовал .future()-вызовы
+            outcome.add_done_callback(lambda call: _record(method, call.code()))
+            return outcome
+
+        # Идемпотентные методы клиент зовет блокирующе: code() не задерживает вызывающего
+        backoff = _Backoff(method, client_call_details.timeout)
+        while True:
+            outcome = continuation(client_call_details, request)
+            code = outcome.code()
+            delay = backoff.delay(code)
+            if delay is None:
+                break
+            time.sleep(delay)
+            d = client_call_details
+            client_call_details = _CallDetails(
+                d.method,
+                backoff.timeout(),
+                d.metadata,
+                d.credentials,
+                d.wait_for_ready,
+                d.compression,
+            )
+        _record(method, code)
+        return outcome
+
+
+class _AioMetricsInterceptor(grpc.aio.UnaryUnaryClientInterceptor):
+    def __init__(self, retry: bool):
+        self.retry = retry
+
+    async def intercept_unary_unary(self, continuation: Callable, client_call_details, request):
+        method = _method_name(client_call_details.method)
+        backoff = None
+        if self.retry and is_idempotent(method):
+            backoff = _Backoff(method, client_call_details.timeout)
+        while True:
+            call = await continuation(client_call_details, request)
+            try:
+                await call
+                code = grpc.StatusCode.OK
+            except grpc.aio.AioRpcError as e:
+                code = e.code()
+            delay = backoff.delay(code) if backoff else None
+            if backoff is None or delay is None:
+                break
+            await asyncio.sleep(delay)
+            d = client_call_details
+            client_call_details = grpc.aio.ClientCallDetails(
+                d.method, backoff.timeout(), d.metadata, d.credentials, d.wait_for_ready
+            )
+        _record(method, code)
+        # Завершенный call: вызывающий получит из него тот же ответ или ту же ошибку
+        return call
+
+
+def create_channel(target: str, retry: bool = True) -> grpc.Channel:
+    """Блокирующий канал к Xray: keepalive, повторы идемпотентных вызовов и счетчики"""
+    channel = grpc.insecure_channel(target, options=channel_options())
+    return grpc.intercept_channel(channel, _MetricsInterceptor(retry))
+
+
+def create_aio_channel(target: str, retry: bool = True) -> grpc.aio.Channel:
+    """grpc.aio-канал с теми же настройками. Создавать внутри работающего event loop"""
+    return grpc.aio.insecure_channel(
+        target, options=channel_options(), interceptors=[_AioMetricsInterceptor(retry)]
+    )
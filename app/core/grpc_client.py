@@ -1,8 +1,13 @@
-from typing import Any, Optional, cast
+import asyncio
+import re
+import time
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Tuple, cast
 
 import grpc
 
 from app.core.config import settings
+from app.core.grpc_channel import create_aio_channel, create_channel
+from app.core.stats_cache import Stats, stats_cache
 from app.core.xray_api.app.proxyman.command import command_pb2 as proxyman_command
 from app.core.xray_api.app.proxyman.command import command_pb2_grpc as proxyman_service
 from app.core.xray_api.app.stats.command import command_pb2 as stats_command
@@ -12,45 +17,152 @@ from app.core.xray_api.common.serial.typed_message_pb2 import TypedMessage
 from app.core.xray_api.proxy.vless import account_pb2
 
 
+def build_add_user_request(
+    inbound_tag: str, email: str, user_uuid: str
+) -> proxyman_command.AlterInboundRequest:
+    flow = "xtls-rprx-vision" if "vision" in inbound_tag.lower() else ""
+
+    vless_acc = account_pb2.Account(id=user_uuid, flow=flow)
+
+    user = user_pb2.User(
+        email=email,
+        level=0,
+        account=TypedMessage(type="xray.proxy.vless.Account", value=vless_acc.SerializeToString()),
+    )
+
+    op = proxyman_command.AddUserOperation(user=user)
+
+    return proxyman_command.AlterInboundRequest(
+        tag=inbound_tag,
+        operation=TypedMessage(
+            type="xray.app.proxyman.command.AddUserOperation", value=op.SerializeToString()
+        ),
+    )
+
+
+def build_remove_user_request(inbound_tag: str, email: str) -> proxyman_command.AlterInboundRequest:
+    op = proxyman_command.RemoveUserOperation(email=email)
+    return proxyman_command.AlterInboundRequest(
+        tag=inbound_tag,
+        operation=TypedMessage(
+            type="xray.app.proxyman.command.RemoveUserOperation", value=op.SerializeToString()
+        ),
+    )
+
+
+# Тексты ошибок Xray (proxy/vless/inbound): по ним "уже есть"/"уже нет" отличаются от сбоя.
+# "handler not found" (неверный тег) — это настоящая ошибка, поэтому ищем именно "User ... "
+_USER_EXISTS = re.compile(r"user .+ already exists", re.IGNORECASE)
+_USER_NOT_FOUND = re.compile(r"user .+ not found", re.IGNORECASE)
+
+
+class AlterResult(NamedTuple):
+    """Исход AlterInbound по одному тегу: bool() — успех, error — текст отказа от Xray"""
+
+    ok: bool
+    error: str = ""
+
+    def __bool__(self) -> bool:
+        return self.ok
+
+
+def _rpc_error(error: grpc.RpcError) -> str:
+    call = cast(grpc.Call, error)
+    return call.details() or call.code().name
+
+
+def is_already_exists(error: grpc.RpcError) -> bool:
+    """Повторный AddUser: "User <email> already exists." """
+    return bool(_USER_EXISTS.search(cast(grpc.Call, error).details() or ""))
+
+
+def is_not_found(error: grpc.RpcError) -> bool:
+    """RemoveUser для отсутствующего юзера: "User <email> not found." """
+    return bool(_USER_NOT_FOUND.search(cast(grpc.Call, error).details() or ""))
+
+
+# Паттерны QueryStats: Xray отбирает счетчики по подстроке имени (если не regexp)
+INBOUND_STATS = "inbound>>>"
+USER_STATS = "user>>>"
+
+
+def user_stats_pattern(email: str) -> str:
+    """Счетчики одного юзера. Закрывающий '>>>' не дает 'a@x' зацепить 'a@x.pro'"""
+    return f"{USER_STATS}{email}>>>"
+
+
+def user_traffic(stats: Stats, email: str) -> Tuple[int, int]:
+    """(uplink, downlink) юзера из ответа QueryStats"""
+    prefix = user_stats_pattern(email)
+    return stats.get(f"{prefix}traffic>>>uplink", 0), stats.get(f"{prefix}traffic>>>downlink", 0)
+
+
+# SysStatsResponse (runtime Go в Xray) -> наши имена
+SYS_STATS_FIELDS = {
+    "NumGoroutine": "goroutines",
+    "NumGC": "num_gc",
+    "Alloc": "alloc",
+    "TotalAlloc": "total_alloc",
+    "Sys": "sys",
+    "Mallocs": "mallocs",
+    "Frees": "frees",
+    "LiveObjects": "live_objects",
+    "PauseTotalNs": "pause_total_ns",
+    "Uptime": "uptime",
+}
+
+
+def sys_stats_dict(response: stats_command.SysStatsResponse) -> Dict[str, int]:
+    return {name: getattr(response, field) for field, name in SYS_STATS_FIELDS.items()}
+
+
 class AzenordXrayControl:
-    def __init__(self, address: Optional[str] = None):
-        target = address or settings.XRAY_GRPC_ADDR
-        self.channel = grpc.insecure_channel(target)
+    def __init__(self, address: Optional[str] = None, retry: bool = True):
+        self.target = address or settings.XRAY_GRPC_ADDR
+        self.retry = retry
+        self.timeout = settings.XRAY_GRPC_TIMEOUT
+        self.channel = create_channel(self.target, retry)
         self.handler_stub = proxyman_service.HandlerServiceStub(self.channel)
         self.stats_stub = stats_service.StatsServiceStub(self.channel)
+        # (monotonic-время пробы, жив ли Xray)
+        self._health: Optional[Tuple[float, bool]] = None
+
+    def check_connection(self, max_age: Optional[float] = None) -> bool:
+        """Жив ли Xray API. Результат пробы кэшируется на XRAY_HEALTH_TTL секунд"""
+        max_age = settings.XRAY_HEALTH_TTL if max_age is None else max_age
+        if self._health is not None and time.monotonic() - self._health[0] < max_age:
+            return self._health[1]
 
-    def check_connection(self) -> bool:
         try:
-            # QueryStats с пустым паттерном — самый быстрый способ проверить API
-            self.stats_stub.QueryStats(stats_command.QueryStatsRequest(pattern="", reset=False))
-            return True
+            # GetSysStats: ответ фиксированного размера (runtime Go), в отличие от
+            # QueryStats(""), который сериализует все счетчики юзеров
+            self.stats_stub.GetSysStats(
+                stats_command.SysStatsRequest(), timeout=settings.XRAY_HEALTH_TIMEOUT
+            )
+            alive = True
         except grpc.RpcError:
-            return False
-
-    def add_user(self, inbound_tag: str, email: str, user_uuid: str) -> bool:
-        flow = "xtls-rprx-vision" if "vision" in inbound_tag.lower() else ""
-
-        vless_acc = account_pb2.Account(id=user_uuid, flow=flow)
-
-        user = user_pb2.User(
-            email=email,
-            level=0,
-            account=TypedMessage(
-                type="xray.proxy.vless.Account", value=vless_acc.SerializeToString()
-            ),
-        )
+            alive = False
 
-        op = proxyman_command.AddUserOperation(user=user)
+        self._health = (time.monotonic(), alive)
+        return alive
 
-        request = proxyman_command.AlterInboundRequest(
-            tag=inbound_tag,
-            operation=TypedMessage(
-                type="xray.app.proxyman.command.AddUserOperation", value=op.SerializeToString()
-            ),
-        )
+    def get_sys_stats(self) -> Optional[Dict[str, int]]:
+        """Рантайм Xray: горутины, куча (alloc/sys), GC, uptime. None — Xray недоступен"""
+        try:
+            response = self.stats_stub.GetSysStats(
+                stats_command.SysStatsRequest(), timeout=self.timeout
+            )
+        except grpc.RpcError:
+            self._health = (time.monotonic(), False)
+            return None
+        # Ответ — та же проба, что и в check_connection
+        self._health = (time.monotonic(), True)
+        return sys_stats_dict(response)
 
+    def add_user(self, inbound_tag: str, email: str, user_uuid: str) -> bool:
+        request = build_add_user_request(inbound_tag, email, user_uuid)
         try:
-            self.handler_stub.AlterInbound(request)
+            self.handler_stub.AlterInbound(request, timeout=self.timeout)
             return True
         except Exception as e:
             print(f"DEBUG [AddUser]: {e}")
@@ -58,27 +170,184 @@ class AzenordXrayControl:
 
     def remove_user(self, inbound_tag: str, email: str) -> bool:
         """Удаляет пользователя из активного инбаунда Xray по Email"""
-        op = proxyman_command.RemoveUserOperation(email=email)
-        request = proxyman_command.AlterInboundRequest(
-            tag=inbound_tag,
-            operation=TypedMessage(
-                type="xray.app.proxyman.command.RemoveUserOperation", value=op.SerializeToString()
-            ),
-        )
+        request = build_remove_user_request(inbound_tag, email)
         try:
-            self.handler_stub.AlterInbound(request)
+            self.handler_stub.AlterInbound(request, timeout=self.timeout)
             return True
         except Exception as e:
             print(f"DEBUG [RemoveUser]: {e}")
             return False
 
-    def get_traffic_stats(self):
-        """Получает реальные данные о трафике через StatsService"""
+    def _alter_tags(
+        self, requests: Dict[str, proxyman_command.AlterInboundRequest]
+    ) -> Dict[str, AlterResult]:
+        # .future(): все теги в полете разом на этом же канале — один round trip без
+        # event loop, поэтому безопасно и из кода, где loop уже запущен (FastAPI)
+        calls = {
+            tag: self.handler_stub.AlterInbound.future(request, timeout=self.timeout)
+            for tag, request in requests.items()
+        }
+        results = {}
+        for tag, call in calls.items():
+            try:
+                call.result()
+                results[tag] = AlterResult(True)
+            except grpc.RpcError as e:
+                results[tag] = AlterResult(False, _rpc_error(e))
+        return results
+
+    def add_user_to_tags(
+        self, tags: Iterable[str], email: str, user_uuid: str
+    ) -> Dict[str, AlterResult]:
+        """Добавляет юзера во все теги разом: {tag: результат}"""
+        return self._alter_tags(
+            {tag: build_add_user_request(tag, email, user_uuid) for tag in tags}
+        )
+
+    def remove_user_from_tags(self, tags: Iterable[str], email: str) -> Dict[str, AlterResult]:
+        """Удаляет юзера из всех тегов разом: {tag: результат}"""
+        return self._alter_tags({tag: build_remove_user_request(tag, email) for tag in tags})
+
+    def query_stats(self, pattern: str = "", max_age: Optional[float] = None) -> Stats:
+        """QueryStats только по нужным счетчикам (pattern — подстрока имени).
+        Ответ переиспользуется XRAY_STATS_TTL секунд; при ошибке — {} (не кэшируется)"""
+        cached = stats_cache.get(self.target, pattern, max_age)
+        if cached is not None:
+            return cached
         try:
             response = self.stats_stub.QueryStats(
-                stats_command.QueryStatsRequest(pattern="", reset=False)
+                stats_command.QueryStatsRequest(pattern=pattern, reset=False), timeout=self.timeout
             )
-            return {stat.name: stat.value for stat in response.stat}
-        except Exception as e:
+        except grpc.RpcError as e:
             print(f"Stats Error: {e}")
             return {}
+        stats = {stat.name: stat.value for stat in response.stat}
+        stats_cache.put(self.target, pattern, stats)
+        return stats
+
+    def drain_stats(self, pattern: str = "") -> Stats:
+        """QueryStats с reset=True: счетчики с прошлого сброса, Xray обнуляет их.
+
+        Неидемпотентно — вызывать на клиенте с retry=False: повтор после потерянного
+        ответа вернул бы нули, а приращение пропало бы. Ошибки не глотает.
+        """
+        response = self.stats_stub.QueryStats(
+            stats_command.QueryStatsRequest(pattern=pattern, reset=True), timeout=self.timeout
+        )
+        # Кэш теперь опережает живые счетчики
+        stats_cache.clear()
+        return {stat.name: stat.value for stat in response.stat}
+
+    def get_user_traffic(self, email: str) -> Tuple[int, int]:
+        """(uplink, downlink) одного юзера — без выгрузки всей таблицы счетчиков"""
+        return user_traffic(self.query_stats(user_stats_pattern(email)), email)
+
+    def get_inbound_traffic(self) -> Stats:
+        return self.query_stats(INBOUND_STATS)
+
+    def get_traffic_stats(self) -> Stats:
+        """Все счетчики разом. Для одного юзера или инбаундов — query_stats(pattern)"""
+        return self.query_stats("")
+
+
+class AzenordXrayAsyncControl:
+    """grpc.aio-вариант клиента. Операции над юзером уходят во все теги параллельно,
+    так что на юзера тратится один round trip, а не по одному на транспорт.
+
+    Канал aio привязан к event loop, поэтому клиент создается внутри корутины:
+
+        async with AzenordXrayAsyncControl() as client:
+            await client.add_user_to_tags(tags, email, user_uuid)
+    """
+
+    def __init__(self, address: Optional[str] = None, retry: bool = True):
+        self.target = address or settings.XRAY_GRPC_ADDR
+        self.timeout = settings.XRAY_GRPC_TIMEOUT
+        self.channel = create_aio_channel(self.target, retry)
+        self.handler_stub = proxyman_service.HandlerServiceStub(self.channel)
+        self.stats_stub = stats_service.StatsServiceStub(self.channel)
+
+    async def __aenter__(self) -> "AzenordXrayAsyncControl":
+        return self
+
+    async def __aexit__(self, *exc: Any):
+        await self.close()
+
+    async def close(self):
+        await self.channel.close()
+
+    async def check_connection(self) -> bool:
+        try:
+            await self.stats_stub.GetSysStats(
+                stats_command.SysStatsRequest(), timeout=settings.XRAY_HEALTH_TIMEOUT
+            )
+            return True
+        except grpc.aio.AioRpcError:
+            return False
+
+    async def get_sys_stats(self) -> Optional[Dict[str, int]]:
+        try:
+            response = await self.stats_stub.GetSysStats(
+                stats_command.SysStatsRequest(), timeout=self.timeout
+            )
+        except grpc.aio.AioRpcError:
+            return None
+        return sys_stats_dict(response)
+
+    async def _alter(self, request: proxyman_command.AlterInboundRequest) -> AlterResult:
+        try:
+            await self.handler_stub.AlterInbound(request, timeout=self.timeout)
+            return AlterResult(True)
+        except grpc.aio.AioRpcError as e:
+            return AlterResult(False, _rpc_error(e))
+
+    async def add_user(self, inbound_tag: str, email: str, user_uuid: str) -> AlterResult:
+        return await self._alter(build_add_user_request(inbound_tag, email, user_uuid))
+
+    async def remove_user(self, inbound_tag: str, email: str) -> AlterResult:
+        return await self._alter(build_remove_user_request(inbound_tag, email))
+
+    async def query_stats(self, pattern: str = "", max_age: Optional[float] = None) -> Stats:
+        """То же, что AzenordXrayControl.query_stats, с тем же процессным кэшем"""
+        cached = stats_cache.get(self.target, pattern, max_age)
+        if cached is not None:
+            return cached
+        try:
+            response = await self.stats_stub.QueryStats(
+                stats_command.QueryStatsRequest(pattern=pattern, reset=False), timeout=self.timeout
+            )
+        except grpc.aio.AioRpcError:
+            # Без вывода в stdout воркера: сбой уже посчитан интерцептором (xray_grpc.errors)
+            return {}
+        stats = {stat.name: stat.value for stat in response.stat}
+        stats_cache.put(self.target, pattern, stats)
+        return stats
+
+    async def get_user_traffic(self, email: str) -> Tuple[int, int]:
+        return user_traffic(await self.query_stats(user_stats_pattern(email)), email)
+
+    async def get_inbound_users(self, inbound_tag: str) -> Dict[str, str]:
+        """Живой список юзеров инбаунда: {email: uuid}. Ошибку не глотает —
+        по неполным данным нельзя решать, кого удалять"""
+        response = await self.handler_stub.GetInboundUsers(
+            proxyman_command.GetInboundUserRequest(tag=inbound_tag), timeout=self.timeout
+        )
+        users = {}
+        for user in response.users:
+            account = account_pb2.Account.FromString(user.account.value)
+            users[user.email] = account.id
+        return users
+
+    async def add_user_to_tags(
+        self, tags: Iterable[str], email: str, user_uuid: str
+    ) -> Dict[str, AlterResult]:
+        tags = list(tags)
+        results = await asyncio.gather(*(self.add_user(tag, email, user_uuid) for tag in tags))
+        return dict(zip(tags, results))
+
+    async def remove_user_from_tags(
+        self, tags: Iterable[str], email: str
+    ) -> Dict[str, AlterResult]:
+        tags = list(tags)
+        results = await asyncio.gather(*(self.remove_user(tag, email) for tag in tags))
+        return dict(zip(tags, results))
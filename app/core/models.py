@@ -3,6 +3,7 @@ import uuid
 from enum import Enum
 from typing import Optional
 
+from sqlalchemy import BigInteger, Column, LargeBinary, UniqueConstraint
 from sqlmodel import Field, SQLModel
 
 from app.core.config import settings
@@ -13,6 +14,12 @@ class RoutePolicy(str, Enum):
     direct = "direct"
 
 
+class QuotaPeriod(str, Enum):
+    day = "day"
+    week = "week"
+    month = "month"
+
+
 class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     nickname: str = Field(index=True, unique=True)
@@ -51,3 +58,106 @@ class Route(SQLModel, table=True):
     package_name: Optional[str] = None  # for Android (e.g., "com.discord")
 
     comment: Optional[str] = None
+
+
+class MeshState(SQLModel, table=True):
+    """Версия общей части подписки (DNS hosts, routing). Бампается триггерами SQLite."""
+
+    id: int = Field(default=1, primary_key=True)
+    # Случайный идентификатор базы: после пересоздания БД старые версии не совпадут
+    epoch: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    version: int = Field(default=0)
+
+
+class IpPool(SQLModel, table=True):
+    """Индекс занятых адресов подсети для IPAM: бит на адрес (8 KB на /16) + счетчики.
+
+    bitmap пересобирается из user.internal_ip и живых аренд IpLease, только если кто-то
+    менял юзеров в обход IPAM: триггеры SQLite бампают user_seq на каждый INSERT/DELETE/
+    смену internal_ip, а IPAM сдвигает synced_seq на столько же изменений, сколько ждет.
+    """
+
+    subnet: str = Field(primary_key=True)
+    bitmap: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
+    capacity: int = 0  # адресов под юзеров (без сети, шлюза и broadcast)
+    used: int = 0
+    hint: int = 0  # младший бит, который может быть свободен
+    user_seq: int = 0
+    synced_seq: int = -1
+
+
+class IpLease(SQLModel, table=True):
+    """Адрес, зарезервированный под юзера, которого еще нет в таблице user.
+
+    Резерв коммитится сразу (BEGIN IMMEDIATE), до синка с Xray, поэтому параллельные
+    `user add` не получают один и тот же адрес. INSERT юзера снимает аренду в своей
+    транзакции (confirm_ips); незакрытая аренда истекает через IPAM_LEASE_TTL.
+    """
+
+    ip: str = Field(primary_key=True)
+    subnet: str = Field(index=True)
+    expires_at: int = Field(index=True)
+
+
+class TrafficSample(SQLModel, table=True):
+    """Приращения трафика из Xray (QueryStats reset=True), одна строка на (источник, бакет).
+
+    resolution — ширина бакета в секундах: 0 — сырой замер коллектора, 3600 — час,
+    86400 — сутки. Старые замеры сворачиваются в часы, часы — в сутки (см. traffic_collector),
+    бакеты не пересекаются, так что сумма по всем resolution — полный трафик за период.
+    """
+
+    __table_args__ = (UniqueConstraint("kind", "name", "resolution", "ts"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: str  # "user" | "inbound"
+    name: str  # email или тег инбаунда
+    resolution: int = Field(default=0)
+    ts: int = Field(index=True)  # unix-время начала бакета (для сырых — время замера)
+    uplink: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))
+    downlink: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))
+
+
+class UserQuota(SQLModel, table=True):
+    """Лимиты трафика резидента (uplink + downlink, байты); None — без лимита.
+
+    used/period_used ведет QuotaEnforcer по приращениям коллектора, а не пересчетом
+    trafficsample. exceeded_at выставляется при автобане по квоте.
+    """
+
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    total_limit: Optional[int] = Field(default=None, sa_column=Column(BigInteger))
+    period: Optional[QuotaPeriod] = None
+    period_limit: Optional[int] = Field(default=None, sa_column=Column(BigInteger))
+
+    used: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))
+    period_used: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))
+    period_start: int = Field(default=0)  # unix-время начала текущего периода (UTC)
+    exceeded_at: Optional[int] = Field(default=None, index=True)
+
+    def exceeded(self) -> bool:
+        if self.total_limit is not None and self.used >= self.total_limit:
+            return True
+        return (
+            self.period is not None
+            and self.period_limit is not None
+            and self.period_used >= self.period_limit
+        )
+
+
+class XraySysSample(SQLModel, table=True):
+    """Замер рантайма Xray (GetSysStats) рядом с нагрузкой на узел в тот же момент:
+    по этим рядам видно, как память и GC растут с числом юзеров и трафиком"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    ts: int = Field(index=True)
+    goroutines: int = 0
+    alloc: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))
+    sys: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))
+    num_gc: int = 0
+    pause_total_ns: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))
+    live_objects: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))
+    uptime: int = 0
+    # Нагрузка: активные юзеры в БД и трафик узла за прошедший тик коллектора
+    users: int = 0
+    traffic: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, default=0))
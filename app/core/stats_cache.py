@@ -0,0 +1,57 @@
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+Stats = Dict[str, int]
+
+
+class StatsCache:
+    """Короткоживущий кэш ответов QueryStats, общий для CLI и API-воркера.
+
+    Ключ — (адрес Xray, pattern). Xray отбирает счетчики по подстроке имени, поэтому свежий
+    ответ на более широкий pattern ("" или "user>>>") покрывает и узкий ("user>>>{email}>>>"):
+    такой запрос фильтруется из кэша без похода в gRPC.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (target, pattern) -> (monotonic-время ответа, счетчики)
+        self._entries: Dict[Tuple[str, str], Tuple[float, Stats]] = {}
+
+    def get(self, target: str, pattern: str, max_age: Optional[float] = None) -> Optional[Stats]:
+        max_age = settings.XRAY_STATS_TTL if max_age is None else max_age
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((target, pattern))
+            if entry is not None and now - entry[0] < max_age:
+                metrics.inc("stats_cache.hits")
+                return entry[1]
+
+            for (cached_target, cached_pattern), (at, stats) in self._entries.items():
+                if cached_target == target and cached_pattern in pattern and now - at < max_age:
+                    metrics.inc("stats_cache.hits")
+                    return {name: value for name, value in stats.items() if pattern in name}
+
+        metrics.inc("stats_cache.misses")
+        return None
+
+    def put(self, target: str, pattern: str, stats: Stats):
+        now = time.monotonic()
+        with self._lock:
+            # Протухшие записи не копим: email-паттернов столько же, сколько юзеров
+            expired = [
+                k for k, (at, _) in self._entries.items() if now - at >= settings.XRAY_STATS_TTL
+            ]
+            for key in expired:
+                del self._entries[key]
+            self._entries[(target, pattern)] = (now, stats)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+stats_cache = StatsCache()
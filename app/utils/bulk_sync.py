@@ -0,0 +1,135 @@
+import asyncio
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import grpc
+
+from app.core.config import settings
+from app.core.grpc_client import (
+    AzenordXrayAsyncControl,
+    build_add_user_request,
+    build_remove_user_request,
+    is_already_exists,
+    is_not_found,
+)
+
+
+class SyncOp(NamedTuple):
+    action: str  # "add" | "remove"
+    tag: str
+    email: str
+    user_uuid: str = ""
+
+
+@dataclass
+class SyncReport:
+    total: int = 0
+    done: int = 0
+    applied: int = 0
+    # add: юзер уже был в инбаунде; remove: его там уже не было
+    unchanged: int = 0
+    failed: List[Tuple[SyncOp, str]] = field(default_factory=list)
+    by_tag: Dict[str, Counter] = field(default_factory=dict)
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+    @property
+    def rate(self) -> float:
+        return self.done / self.elapsed if self.elapsed else 0.0
+
+    def record(self, op: SyncOp, outcome: str, error: str = ""):
+        self.done += 1
+        self.by_tag.setdefault(op.tag, Counter())[outcome] += 1
+        if outcome == "applied":
+            self.applied += 1
+        elif outcome == "unchanged":
+            self.unchanged += 1
+        else:
+            self.failed.append((op, error))
+
+
+class BulkSyncEngine:
+    """Массовая заливка операций AlterInbound в Xray.
+
+    Воркеров ровно `inflight` — это и есть лимит одновременных RPC на узел; операции
+    берутся из общего итератора, поэтому очередь на 10k+ юзеров не разворачивается в
+    10k+ задач. `exist_ok`: "already exists" на add и "not found" на remove — успех
+    (повторная заливка после рестарта Xray идемпотентна).
+    """
+
+    def __init__(
+        self,
+        client: AzenordXrayAsyncControl,
+        inflight: Optional[int] = None,
+        exist_ok: bool = True,
+        on_progress: Optional[Callable[[SyncReport], None]] = None,
+    ):
+        self.client = client
+        self.inflight = max(1, inflight or settings.XRAY_SYNC_INFLIGHT)
+        self.exist_ok = exist_ok
+        self.on_progress = on_progress
+
+    async def _apply(self, op: SyncOp) -> Tuple[str, str]:
+        if op.action == "add":
+            request = build_add_user_request(op.tag, op.email, op.user_uuid)
+            benign = is_already_exists
+        else:
+            request = build_remove_user_request(op.tag, op.email)
+            benign = is_not_found
+        try:
+            await self.client.handler_stub.AlterInbound(request, timeout=self.client.timeout)
+            return "applied", ""
+        except grpc.aio.AioRpcError as e:
+            if self.exist_ok and benign(e):
+                return "unchanged", ""
+            return "failed", e.details() or e.code().name
+
+    async def run(self, ops: Iterable[SyncOp]) -> SyncReport:
+        ops = list(ops)
+        report = SyncReport(total=len(ops))
+        queue = iter(ops)
+        started = time.perf_counter()
+
+        async def worker():
+            for op in queue:
+                outcome, error = await self._apply(op)
+                report.record(op, outcome, error)
+                if self.on_progress:
+                    self.on_progress(report)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.inflight, len(ops)))))
+        report.elapsed = time.perf_counter() - started
+        return report
+
+
+def add_ops(users: Iterable[Tuple[str, str]], tags: Iterable[str]) -> List[SyncOp]:
+    """(email, uuid) x теги -> операции add"""
+    tags = list(tags)
+    return [SyncOp("add", tag, email, user_uuid) for email, user_uuid in users for tag in tags]
+
+
+def remove_ops(emails: Iterable[str], tags: Iterable[str]) -> List[SyncOp]:
+    tags = list(tags)
+    return [SyncOp("remove", tag, email) for email in emails for tag in tags]
+
+
+def run_bulk_sync(
+    ops: Iterable[SyncOp],
+    address: Optional[str] = None,
+    inflight: Optional[int] = None,
+    exist_ok: bool = True,
+    on_progress: Optional[Callable[[SyncReport], None]] = None,
+) -> SyncReport:
+    """Синхронная обертка для CLI: свой event loop и свой aio-канал на прогон"""
+
+    async def main():
+        async with AzenordXrayAsyncControl(address) as client:
+            engine = BulkSyncEngine(client, inflight, exist_ok, on_progress)
+            return await engine.run(ops)
+
+    return asyncio.run(main())
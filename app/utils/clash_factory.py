@@ -0,0 +1,137 @@
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+from app.utils.xray_config_factory import OutboundFactory
+
+MESH_GROUP = "🚀 Azenord-Mesh"
+
+# Префикс паттерна Xray -> тип правила Clash/Mihomo
+_DOMAIN_RULES = {
+    "domain": "DOMAIN-SUFFIX",
+    "full": "DOMAIN",
+    "keyword": "DOMAIN-KEYWORD",
+    "regexp": "DOMAIN-REGEX",
+    "geosite": "GEOSITE",
+}
+
+
+class ClashFactory:
+    """Clash/Mihomo YAML из тех же фабрик, что и JSON-подписка Xray"""
+
+    @staticmethod
+    def proxy_name(tag: str) -> str:
+        return f"Azenord-{tag}"
+
+    @classmethod
+    def build_proxies(cls, user_uuid: str) -> List[Dict[str, Any]]:
+        """Xray outbounds юзера -> proxies Clash"""
+        proxies = []
+        for outbound in OutboundFactory.create_user_outbounds(user_uuid):
+            stream = outbound["streamSettings"]
+            proxy: Dict[str, Any] = {
+                "name": cls.proxy_name(outbound["tag"]),
+                "type": "vless",
+                "server": settings.XRAY_DOMAIN,
+                "port": outbound["settings"]["vnext"][0]["port"],
+                "uuid": user_uuid,
+                "udp": True,
+                "tls": True,
+                "servername": settings.XRAY_DOMAIN,
+                "alpn": stream["tlsSettings"]["alpn"],
+                "network": stream["network"],
+            }
+            # Handle transport-specific opts
+            if proxy["network"] == "tcp":
+                proxy["flow"] = "xtls-rprx-vision"
+            elif proxy["network"] == "xhttp":
+                proxy["xhttp-opts"] = {
+                    "path": stream["xhttpSettings"]["path"],
+                    "mode": stream["xhttpSettings"]["mode"],
+                }
+            proxies.append(proxy)
+        return proxies
+
+    @classmethod
+    def _target(cls, outbound_tag: str) -> str:
+        if outbound_tag == "direct":
+            return "DIRECT"
+        if outbound_tag == "block":
+            return "REJECT"
+        # proxy и теги транспортов идут через группу выбора
+        return MESH_GROUP
+
+    @staticmethod
+    def _domain_condition(pattern: str) -> Optional[str]:
+        prefix, sep, value = pattern.partition(":")
+        rule_type = _DOMAIN_RULES.get(prefix) if sep else None
+        if not rule_type:
+            return None
+        return f"{rule_type},{value.lstrip('.')}"
+
+    @staticmethod
+    def _ip_condition(pattern: str) -> str:
+        if pattern.startswith("geoip:"):
+            return f"GEOIP,{pattern.removeprefix('geoip:')}"
+        if "/" not in pattern:
+            pattern += "/128" if ":" in pattern else "/32"
+        rule_type = "IP-CIDR6" if ":" in pattern else "IP-CIDR"
+        return f"{rule_type},{pattern},no-resolve"
+
+    @classmethod
+    def build_rules(cls, xray_rules: List[Dict[str, Any]]) -> List[str]:
+        """Правила Xray (RoutingFactory) -> строки rules Clash. Несколько условий -> AND"""
+        rules = []
+        for rule in xray_rules:
+            conditions = []
+
+            domains = rule.get("domain", [])
+            for pattern in [domains] if isinstance(domains, str) else domains:
+                condition = cls._domain_condition(pattern)
+                if condition:
+                    conditions.append(condition)
+            if rule.get("ip"):
+                conditions.append(cls._ip_condition(rule["ip"]))
+            if rule.get("network"):
+                conditions.append(f"NETWORK,{rule['network']}")
+            if rule.get("port"):
+                conditions.append(f"DST-PORT,{rule['port']}")
+            for key in ("process", "packageName"):
+                if rule.get(key):
+                    conditions.append(f"PROCESS-NAME,{rule[key]}")
+
+            if not conditions:
+                continue
+            target = cls._target(rule["outboundTag"])
+            if len(conditions) == 1:
+                rules.append(f"{conditions[0]},{target}")
+            else:
+                joined = ",".join(f"({c})" for c in conditions)
+                rules.append(f"AND,({joined}),{target}")
+
+        rules.append("MATCH,DIRECT")
+        return rules
+
+    @classmethod
+    def assemble(
+        cls,
+        user_uuid: str,
+        email: str,
+        dns_hosts: Dict[str, str],
+        routing_rules: List[Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        proxies = cls.build_proxies(user_uuid)
+        return {
+            "email": email,
+            "proxies": proxies,
+            "proxy-groups": [
+                {"name": MESH_GROUP, "type": "select", "proxies": [p["name"] for p in proxies]}
+            ],
+            "dns": {
+                "enable": True,
+                "enhanced-mode": "fake-ip",
+                "fake-ip-range": "198.18.0.1/16",
+                "nameserver": ["https://1.1.1.1/dns-query", "8.8.8.8"],
+                "hosts": dns_hosts,  # Mesh phonebook
+            },
+            "rules": cls.build_rules(routing_rules),
+        }
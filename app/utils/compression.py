@@ -0,0 +1,99 @@
+import gzip
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import brotli  # requirements.txt; без него (урезанная сборка) отдаем только gzip
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Сжатие идет на каждый промах кэша (не только раз на версию меша): на теле в сотни КБ
+# gzip-9/br-9 стоят десятки мс, а 6/5 дают почти тот же размер в разы быстрее
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def supported_encodings() -> List[str]:
+    """Кодировки в порядке предпочтения сервера"""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> str:
+    """Выбирает кодировку по Accept-Encoding (с учетом q=). identity — если ничего не подошло"""
+    if not accept_encoding:
+        return "identity"
+
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[name.strip().lower()] = q
+
+    best, best_q = "identity", 0.0
+    for encoding in supported_encodings():
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        # mtime=0: одинаковый вход — одинаковые байты (стабильно для кэшей и ETag)
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return body
+
+
+class CompressedBodyCache:
+    """LRU сжатых тел подписок, ключ — (версия меша, ключ юзера, кодировка).
+
+    Ограничен суммарным размером тел, а не числом записей: тело растет вместе с мешем
+    (hosts всех резидентов), и лимит по штукам на большом меше съедает сотни МБ
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[Tuple[str, str, str], bytes]" = OrderedDict()
+        self._version: Optional[str] = None
+
+    def get(self, version: str, key: str, encoding: str) -> Optional[bytes]:
+        entry_key = (version, key, encoding)
+        body = self._entries.get(entry_key)
+        if body is not None:
+            self._entries.move_to_end(entry_key)
+        return body
+
+    def put(self, version: str, key: str, encoding: str, body: bytes):
+        if version != self._version:
+            # Меш сменил версию — старые тела больше никогда не понадобятся
+            self.clear()
+            self._version = version
+        if len(body) > self.max_bytes:
+            return
+        entry_key = (version, key, encoding)
+        old = self._entries.pop(entry_key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._entries[entry_key] = body
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+        self._version = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,20 +1,343 @@
 import ipaddress
+import re
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union, cast
 
-from sqlmodel import Session, select
+from sqlalchemy import CursorResult, delete, func, insert, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlmodel import Session, col, select
 
-from app.core.models import User
+from app.core.config import settings
+from app.core.database import engine
+from app.core.models import IpLease, IpPool, User
 
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
 
-def get_next_free_ip(session: Session, subnet: str = "10.0.8.0/24"):
-    network = ipaddress.ip_network(subnet)
-    # Пропускаем .0 (сеть) и .1 (шлюз)
-    all_hosts = [str(ip) for ip in list(network.hosts())[1:]]
+# Бит на адрес: 2^24 адресов — 2 MB карты (IPv4 /8, IPv6 /104)
+MAX_POOL_ADDRESSES = 1 << 24
 
-    # Получаем список уже занятых IP
-    used_ips = session.exec(select(User.internal_ip)).all()
+# Первый байт битовой карты, в котором есть свободный бит
+_FREE_BYTE = re.compile(rb"[^\xff]")
 
-    for ip in all_hosts:
-        if ip not in used_ips:
-            return ip
 
-    raise ValueError("Mesh subnet is full")
+class PoolUsage(NamedTuple):
+    name: str
+    subnet: str
+    used: int  # юзеры + живые аренды
+    leased: int
+    capacity: int
+    stale: bool  # индекс разошелся с user — пересоберется при следующей выдаче
+
+    @property
+    def free(self) -> int:
+        return self.capacity - self.used
+
+    @property
+    def utilization(self) -> float:
+        return self.used / self.capacity if self.capacity else 1.0
+
+
+def resolve_pool(pool: Optional[str] = None) -> Tuple[str, Network]:
+    """Имя пула из MESH_POOLS или CIDR -> (имя, сеть). None — пул по умолчанию"""
+    pools = settings.mesh_pools
+    if pool is None:
+        if not pools:
+            raise ValueError("MESH_POOLS is empty")
+        pool = next(iter(pools))
+    cidr = pools.get(pool, pool)
+    try:
+        network = ipaddress.ip_network(cidr)
+    except ValueError:
+        raise ValueError(f"Unknown mesh pool: {pool}") from None
+    if network.num_addresses > MAX_POOL_ADDRESSES:
+        raise ValueError(f"Mesh pool {cidr} is too large for the IPAM index")
+    name = pool if pool in pools else _pool_names().get(str(network), str(network))
+    return name, network
+
+
+def _pool_names() -> dict:
+    """CIDR -> имя из MESH_POOLS (для отчетов по пулам из базы)"""
+    return {str(ipaddress.ip_network(c)): name for name, c in settings.mesh_pools.items()}
+
+
+def _reserved(network: Network) -> List[int]:
+    """Смещения, которые не выдаются: сеть и шлюз (::, ::1 в IPv6), в IPv4 — и broadcast"""
+    if network.version == 6:
+        return [0, 1]
+    return sorted({0, 1, network.num_addresses - 1})
+
+
+def _set(bitmap: bytearray, offset: int):
+    bitmap[offset >> 3] |= 1 << (offset & 7)
+
+
+def _clear(bitmap: bytearray, offset: int):
+    bitmap[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+
+
+def _first_free(bitmap: bytearray, start: int) -> int:
+    """Младший нулевой бит не раньше start; -1 — свободных нет.
+    Занятые байты пропускает regex на C-скорости, а с hint'ом поиск начинается
+    сразу у границы занятой части — амортизированно O(1) на адрес"""
+    pos = start >> 3
+    while True:
+        match = _FREE_BYTE.search(bitmap, pos)
+        if match is None:
+            return -1
+        pos = match.start()
+        byte = bitmap[pos]
+        if pos == start >> 3:
+            byte |= (1 << (start & 7)) - 1
+        if byte != 0xFF:
+            free = ~byte & 0xFF
+            return (pos << 3) + (free & -free).bit_length() - 1
+        pos += 1
+
+
+def _offset(ip: str, network: Network) -> int:
+    """Смещение адреса в пуле; -1 — адрес не из этого пула (или не адрес вовсе)"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return -1
+    if address.version != network.version or address not in network:
+        return -1
+    return int(address) - int(network.network_address)
+
+
+@contextmanager
+def _locked(bind: Optional[Engine] = None) -> Iterator[Session]:
+    """Короткая транзакция с блокировкой на запись с первого же чтения.
+
+    SQLite: BEGIN IMMEDIATE — второй писатель ждет (busy timeout), а не читает
+    битовую карту, которую мы вот-вот перепишем. Остальные СУБД — SELECT ... FOR UPDATE
+    в _pool."""
+    bind = bind or engine
+    with Session(bind) as session:
+        if bind.dialect.name == "sqlite":
+            session.connection().exec_driver_sql("BEGIN IMMEDIATE")
+        yield session
+        session.commit()
+
+
+def _retrying(fn):
+    """Повторы при конфликте писателей: busy timeout SQLite истек (database is locked)
+    или аренда на адрес уже есть (индекс разошелся с iplease — следующая попытка
+    пересоберет его)"""
+    rebuild = False
+    for attempt in range(max(1, settings.IPAM_RETRY_ATTEMPTS)):
+        try:
+            return fn(rebuild)
+        except IntegrityError:
+            rebuild = True
+        except OperationalError as e:
+            if "locked" not in str(e) or attempt == settings.IPAM_RETRY_ATTEMPTS - 1:
+                raise
+        time.sleep(0.05 * 2**attempt)
+    return fn(True)
+
+
+def _rebuild(session: Session, pool: IpPool, network: Network, now: int):
+    """Битовая карта заново по user.internal_ip и живым арендам — холодный путь
+    (первый вызов, юзеры менялись в обход IPAM, истекли аренды)"""
+    size = network.num_addresses
+    bitmap = bytearray((size + 7) // 8)
+    for offset in range(size, len(bitmap) * 8):
+        _set(bitmap, offset)  # хвост последнего байта — не адреса
+    for offset in _reserved(network):
+        _set(bitmap, offset)
+
+    leased = select(IpLease.ip).where(IpLease.subnet == pool.subnet, IpLease.expires_at >= now)
+    used = 0
+    for ips in (session.exec(select(User.internal_ip)), session.exec(leased)):
+        for ip in ips:
+            # Адреса других пулов и ручные правки вне пулов индекс не касаются
+            offset = _offset(ip, network)
+            if offset >= 0 and not bitmap[offset >> 3] & (1 << (offset & 7)):
+                _set(bitmap, offset)
+                used += 1
+
+    pool.bitmap = bytes(bitmap)
+    pool.capacity = size - len(_reserved(network))
+    pool.used = used
+    pool.hint = 0
+    pool.synced_seq = pool.user_seq
+
+
+def _pool(
+    session: Session, network: Network, now: int, rebuild: bool = False, lag: int = 0
+) -> Tuple[IpPool, bool]:
+    """Индекс пула, сверенный с таблицей user (вызывать внутри _locked).
+    lag — уже закоммиченные изменения юзеров, которые вызывающий сейчас учтет сам.
+    -> (pool, пересобран ли)"""
+    pool = session.get(IpPool, str(network), with_for_update=True)
+    if pool is None:
+        pool = IpPool(subnet=str(network), bitmap=b"")
+        rebuild = True
+    # Брошенные аренды: их адреса могли достаться юзерам в обход IPAM — пересобираем
+    expired = session.execute(
+        delete(IpLease).where(col(IpLease.subnet) == pool.subnet, col(IpLease.expires_at) < now)
+    )
+    rebuild = (
+        rebuild
+        or bool(cast(CursorResult, expired).rowcount)
+        or pool.synced_seq + lag != pool.user_seq
+    )
+    if rebuild:
+        _rebuild(session, pool, network, now)
+    session.add(pool)
+    return pool, rebuild
+
+
+def reserve_ips(
+    count: int,
+    pool: Optional[str] = None,
+    bind: Optional[Engine] = None,
+    ttl: Optional[int] = None,
+) -> List[str]:
+    """count младших свободных адресов пула за O(count), в своей закоммиченной транзакции.
+
+    Адреса сразу заняты в индексе и закреплены арендой на ttl секунд: INSERT юзеров
+    делается потом, после синка с Xray, и закрывает аренду через confirm_ips (в той же
+    транзакции). Не пригодились — cancel_ips."""
+    _, network = resolve_pool(pool)
+    ttl = settings.IPAM_LEASE_TTL if ttl is None else ttl
+
+    def attempt(rebuild: bool) -> List[str]:
+        now = int(time.time())
+        with _locked(bind) as session:
+            index, _ = _pool(session, network, now, rebuild)
+            # Проверка заполненности — по счетчикам, без сканирования
+            if index.used + count > index.capacity:
+                raise ValueError("Mesh subnet is full")
+
+            bitmap = bytearray(index.bitmap)
+            base = network.network_address
+            ips = []
+            offset = index.hint
+            for _ in range(count):
+                offset = _first_free(bitmap, offset)
+                _set(bitmap, offset)
+                ips.append(str(base + offset))
+            if ips:
+                session.execute(
+                    insert(IpLease),
+                    [{"ip": ip, "subnet": index.subnet, "expires_at": now + ttl} for ip in ips],
+                )
+
+            index.bitmap = bytes(bitmap)
+            index.used += count
+            index.hint = offset + 1 if count else index.hint
+        return ips
+
+    return _retrying(attempt)
+
+
+def confirm_ips(session: Session, ips: Iterable[str]):
+    """Вызывать в транзакции, которая вставляет юзеров с этими адресами: снимает аренды
+    и заранее засчитывает их INSERT'ы. Триггер бампает user_seq всех пулов, поэтому
+    и synced_seq сдвигается у всех: чужой пул от INSERT'а не меняется и остается сверенным.
+    Инкремент — в SQL, без чтения: параллельные транзакции не теряют друг друга"""
+    ips = list(ips)
+    if not ips:
+        return
+    session.execute(delete(IpLease).where(col(IpLease.ip).in_(ips)))
+    session.execute(update(IpPool).values(synced_seq=IpPool.synced_seq + len(ips)))
+
+
+def cancel_ips(ips: Iterable[str], bind: Optional[Engine] = None):
+    """Вернуть в пулы зарезервированные, но так и не занятые адреса"""
+    _free(list(ips), bind, deleted_users=0)
+
+
+def release_ips(ips: Iterable[str], bind: Optional[Engine] = None):
+    """Вернуть в пулы адреса юзеров, удаление которых уже закоммичено"""
+    ips = list(ips)
+    _free(ips, bind, deleted_users=len(ips))
+
+
+def _free(ips: List[str], bind: Optional[Engine], deleted_users: int):
+    def attempt(rebuild: bool):
+        now = int(time.time())
+        with _locked(bind) as session:
+            session.execute(delete(IpLease).where(col(IpLease.ip).in_(ips)))
+            for subnet in session.exec(select(IpPool.subnet)).all():
+                network = ipaddress.ip_network(subnet)
+                pool, rebuilt = _pool(session, network, now, rebuild, lag=deleted_users)
+                if rebuilt:
+                    continue  # карта собрана уже без этих адресов
+                pool.synced_seq += deleted_users
+                bitmap = bytearray(pool.bitmap)
+                for ip in ips:
+                    offset = _offset(ip, network)
+                    if offset < 0 or offset in _reserved(network):
+                        continue
+                    if bitmap[offset >> 3] & (1 << (offset & 7)):
+                        _clear(bitmap, offset)
+                        pool.used -= 1
+                        pool.hint = min(pool.hint, offset)
+                pool.bitmap = bytes(bitmap)
+
+    _retrying(attempt)
+
+
+def session_engine(session: Session) -> Engine:
+    """Engine сессии для IPAM. Сессия может быть привязана к Connection с открытой
+    транзакцией — BEGIN IMMEDIATE в _locked нужен свой коннект, а не этот"""
+    bind = session.get_bind()
+    return bind if isinstance(bind, Engine) else bind.engine
+
+
+def allocate_ips(session: Session, count: int, subnet: Optional[str] = None) -> List[str]:
+    """reserve_ips на той же базе, что и сессия вызывающего (subnet — имя пула или CIDR)"""
+    return reserve_ips(count, subnet, bind=session_engine(session))
+
+
+def get_next_free_ip(session: Session, subnet: Optional[str] = None):
+    return allocate_ips(session, 1, subnet)[0]
+
+
+def pool_usage(session: Session) -> List[PoolUsage]:
+    """Заполненность пулов из MESH_POOLS и всех, что уже есть в индексе. Только счетчики:
+    O(число пулов), без чтения юзеров"""
+    names = _pool_names()
+    leased = dict(
+        session.exec(
+            select(IpLease.subnet, func.count())
+            .where(IpLease.expires_at >= int(time.time()))
+            .group_by(IpLease.subnet)
+        ).all()
+    )
+    indexed = {pool.subnet: pool for pool in session.exec(select(IpPool)).all()}
+
+    usage = []
+    for subnet in [*names, *(s for s in indexed if s not in names)]:
+        pool = indexed.get(subnet)
+        if pool is None:
+            # Пул объявлен, но адресов из него еще не выдавали
+            _, network = resolve_pool(subnet)
+            capacity = network.num_addresses - len(_reserved(network))
+            usage.append(PoolUsage(names[subnet], subnet, 0, 0, capacity, True))
+            continue
+        usage.append(
+            PoolUsage(
+                name=names.get(subnet, subnet),
+                subnet=subnet,
+                used=pool.used,
+                leased=leased.get(subnet, 0),
+                capacity=pool.capacity,
+                stale=pool.synced_seq != pool.user_seq,
+            )
+        )
+    return usage
+
+
+def pool_full(session: Session, pool: Optional[str] = None) -> bool:
+    """Быстрая проверка "пул заполнен" по счетчикам индекса, без пересборки"""
+    _, network = resolve_pool(pool)
+    index = session.get(IpPool, str(network))
+    if index is None:
+        return False
+    return index.used >= index.capacity
@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import json
+import re
+import secrets
+import time
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+import yaml
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.config import settings
+from app.core.database import async_engine
+from app.core.metrics import metrics
+from app.core.models import MeshState, Route, User
+from app.utils.clash_factory import ClashFactory
+from app.utils.dns_factory import DNSFactory
+from app.utils.routing_factory import RoutingFactory
+from app.utils.xray_config_factory import OutboundFactory
+
+# Транспорты зависят от .env (порты, домены, пути) — смена настроек тоже меняет ETag
+_SETTINGS_FINGERPRINT = hashlib.blake2b(
+    settings.model_dump_json().encode(), digest_size=8
+).hexdigest()
+
+# Слоты под поля юзера. Случайный суффикс — чтобы не совпасть с данными из БД (routes)
+_UUID_SLOT = f"__azenord_uuid_{secrets.token_hex(8)}__"
+_EMAIL_SLOT = f"__azenord_email_{secrets.token_hex(8)}__"
+
+
+def _dump_json(value: Any) -> bytes:
+    # Тот же формат, что у JSONResponse в FastAPI
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class SubscriptionTemplate:
+    """Конфиг, заранее сериализованный в байты. На запрос вклеиваются только uuid и email"""
+
+    def __init__(self, raw: bytes, slots: Dict[bytes, str]):
+        pattern = re.compile(b"|".join(re.escape(s) for s in slots))
+
+        # [(кусок байтов, слот после него | None), ...]
+        self._parts: List[Tuple[bytes, Optional[str]]] = []
+        pos = 0
+        for match in pattern.finditer(raw):
+            self._parts.append((raw[pos : match.start()], slots[match.group()]))
+            pos = match.end()
+        self._parts.append((raw[pos:], None))
+
+        # Отпечаток без случайных имен слотов: совпадает между процессами, и при равном
+        # digest тела одинаковых uuid/email совпадают байт в байт
+        digest = hashlib.blake2b(digest_size=16)
+        for chunk, slot in self._parts:
+            digest.update(chunk)
+            digest.update(f"\0{slot}\0".encode())
+        self.digest = digest.hexdigest()
+
+    @classmethod
+    def from_json(cls, config: Dict[str, Any]) -> "SubscriptionTemplate":
+        slots = {_dump_json(_UUID_SLOT): "uuid", _dump_json(_EMAIL_SLOT): "email"}
+        return cls(_dump_json(config), slots)
+
+    @classmethod
+    def from_yaml(cls, config: Dict[str, Any]) -> "SubscriptionTemplate":
+        # Слот ([a-z0-9_]) YAML пишет plain-скаляром, а JSON-строка на его месте —
+        # валидный double-quoted скаляр YAML
+        raw = yaml.dump(config, allow_unicode=True, sort_keys=False).encode("utf-8")
+        return cls(raw, {_UUID_SLOT.encode(): "uuid", _EMAIL_SLOT.encode(): "email"})
+
+    def render(self, user_uuid: str, email: str) -> bytes:
+        values = {"uuid": _dump_json(user_uuid), "email": _dump_json(email)}
+        chunks = []
+        for chunk, slot in self._parts:
+            chunks.append(chunk)
+            if slot:
+                chunks.append(values[slot])
+        return b"".join(chunks)
+
+
+@dataclass(frozen=True)
+class MeshSnapshot:
+    """Общая для всех резидентов часть подписки, собранная под конкретную версию меша"""
+
+    version: Optional[str]
+    dns_hosts: Dict[str, str]
+    routing_rules: List[Dict[str, Any]]
+    standard_outbounds: List[Dict[str, Any]]
+    template: SubscriptionTemplate
+    # Индекс резидентов: мусорные и забаненные UUID отсекаются без запроса в SQLite
+    active_emails: Dict[str, str]  # uuid -> email (только is_active)
+    known_uuids: FrozenSet[str]  # все uuid, включая забаненных
+
+    @classmethod
+    def build(
+        cls, version: Optional[str], users: List[User], routes: List[Route]
+    ) -> "MeshSnapshot":
+        dns_hosts = DNSFactory.build_hosts(users)
+        routing_rules = RoutingFactory.build_rules(routes)
+        standard_outbounds = OutboundFactory.get_standard_outbounds()
+        config = cls.assemble(_UUID_SLOT, _EMAIL_SLOT, dns_hosts, routing_rules, standard_outbounds)
+        return cls(
+            version=version,
+            dns_hosts=dns_hosts,
+            routing_rules=routing_rules,
+            standard_outbounds=standard_outbounds,
+            template=SubscriptionTemplate.from_json(config),
+            active_emails={u.uuid: u.email for u in users if u.is_active},
+            known_uuids=frozenset(u.uuid for u in users),
+        )
+
+    @staticmethod
+    def assemble(
+        user_uuid: str,
+        email: str,
+        dns_hosts: Dict[str, str],
+        routing_rules: List[Dict[str, Any]],
+        standard_outbounds: List[Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        """Полный конфиг: к общей части добавляются только транспорты юзера"""
+        outbounds = OutboundFactory.create_user_outbounds(user_uuid)
+        outbounds.extend(standard_outbounds)
+
+        return {
+            "email": email,
+            "fakedns": [{"ipPool": "198.18.0.0/16", "poolSize": 65535}],
+            "dns": {
+                "hosts": dns_hosts,
+                "servers": DNSFactory.get_default_servers(),
+                "queryStrategy": "UseIPv4",
+            },
+            "outbounds": outbounds,
+            "routing": {"domainStrategy": "IPIfNonMatch", "rules": routing_rules},
+        }
+
+    @cached_property
+    def clash_template(self) -> SubscriptionTemplate:
+        # Лениво: yaml.dump — дорогой, и делается раз на версию меша, только если
+        # версию запросил хотя бы один Clash-клиент
+        config = ClashFactory.assemble(_UUID_SLOT, _EMAIL_SLOT, self.dns_hosts, self.routing_rules)
+        return SubscriptionTemplate.from_yaml(config)
+
+    def etag(self, user_uuid: str, email: str, fmt: str = "json") -> Optional[str]:
+        """Weak ETag подписки: версия меша + юзер + формат + настройки. None — версия неизвестна"""
+        if self.version is None:
+            return None
+        key = f"{self.version}|{user_uuid}|{email}|{fmt}|{_SETTINGS_FINGERPRINT}"
+        # Weak: gzip в nginx все равно ослабляет strong ETag при сжатии ответа
+        return f'W/"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}"'
+
+    def render(self, user_uuid: str, email: str, fmt: str = "json") -> bytes:
+        """Готовое тело подписки (json | clash) без сборки словаря и сериализации"""
+        template = self.clash_template if fmt == "clash" else self.template
+        return template.render(user_uuid, email)
+
+
+def _format_version(state: Optional[MeshState]) -> Optional[str]:
+    # Базы, созданные до появления MeshState, не кэшируются
+    return f"{state.epoch}:{state.version}" if state else None
+
+
+def read_version(session: Session) -> Optional[str]:
+    """Текущая версия меша (синхронный путь: CLI, экспорт)"""
+    return _format_version(session.get(MeshState, 1))
+
+
+class MeshSnapshotCache:
+    """Процессный кэш снапшота: пересборка только при смене MeshState.version.
+
+    Версия сверяется с SQLite не чаще раза в MESH_VERSION_TTL секунд, поэтому горячий путь
+    (включая отказ по мусорным UUID) в SQLite не ходит вовсе. Воркеры gunicorn и CLI
+    согласуются через общую MeshState.version с задержкой не больше TTL.
+
+    Сборка single-flight: конкурентные запросы одной версии ждут одну сборку, а не
+    читают таблицы параллельно.
+    """
+
+    def __init__(self):
+        self._snapshot: Optional[MeshSnapshot] = None
+        self._checked_at = 0.0
+        # version -> (задача сборки, сколько запросов сверх первого ее дожидаются)
+        self._inflight: Dict[str, List[Any]] = {}
+
+    @staticmethod
+    async def read_version(session: AsyncSession) -> Optional[str]:
+        return _format_version(await session.get(MeshState, 1))
+
+    async def get(self, session: AsyncSession) -> MeshSnapshot:
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self._checked_at < settings.MESH_VERSION_TTL:
+            return snapshot
+
+        version = await self.read_version(session)
+        if version is None:
+            return await self._build(session, version)
+
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            self._checked_at = now
+            return snapshot
+
+        inflight = self._inflight.get(version)
+        if inflight is None:
+            # Сборка — отдельная задача со своей сессией: отмена запроса, который ее начал
+            # (клиент отвалился, таймаут воркера), не роняет остальных ожидающих
+            task = asyncio.create_task(self._shared_build(version))
+            # Ошибку сборки может не забрать ни один ожидающий — не шумим в лог asyncio
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            inflight = self._inflight[version] = [task, 0]
+        else:
+            inflight[1] += 1
+            metrics.inc("mesh_snapshot.coalesced")
+        return await asyncio.shield(inflight[0])
+
+    async def _shared_build(self, version: str) -> MeshSnapshot:
+        started = time.perf_counter()
+        try:
+            async with AsyncSession(async_engine) as session:
+                snapshot = await self._build(session, version)
+        finally:
+            inflight = self._inflight.pop(version, None)
+
+        self._snapshot = snapshot
+        self._checked_at = time.monotonic()
+
+        metrics.inc("mesh_snapshot.builds")
+        metrics.set("mesh_snapshot.last_build_coalesced", inflight[1] if inflight else 0)
+        metrics.set("mesh_snapshot.last_build_ms", (time.perf_counter() - started) * 1000)
+        return snapshot
+
+    async def _build(self, session: AsyncSession, version: Optional[str]) -> MeshSnapshot:
+        users = list((await session.exec(select(User))).all())
+        routes = list((await session.exec(select(Route))).all())
+        return MeshSnapshot.build(version, users, routes)
+
+    def expire(self):
+        """Следующий get() сверит версию с SQLite, не дожидаясь TTL"""
+        self._checked_at = 0.0
+
+    def invalidate(self):
+        self._snapshot = None
+        self._checked_at = 0.0
+
+
+mesh_cache = MeshSnapshotCache()
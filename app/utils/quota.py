@@ -0,0 +1,169 @@
+import re
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import update
+from sqlmodel import Session, col, select
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.core.models import QuotaPeriod, User, UserQuota
+from app.utils.bulk_sync import SyncOp, add_ops, remove_ops, run_bulk_sync
+from app.utils.sql import IN_CHUNK, chunks
+from app.utils.sub_export import refresh_static_export
+from app.utils.traffic_collector import DAY, Deltas
+
+_SIZE = re.compile(r"^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$", re.IGNORECASE)
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(value: str) -> int:
+    """'500M', '50G', '1.5T', '1024' -> байты"""
+    match = _SIZE.match(value.strip())
+    if not match:
+        raise ValueError(f"Bad size: {value!r} (expected e.g. 500M, 50G)")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def period_start(period: QuotaPeriod, ts: int) -> int:
+    """Начало календарного периода (UTC), в который попадает ts. Неделя — с понедельника"""
+    if period == QuotaPeriod.day:
+        return ts // DAY * DAY
+    if period == QuotaPeriod.week:
+        days = ts // DAY
+        # 1970-01-01 — четверг
+        return (days - (days + 3) % 7) * DAY
+    moment = datetime.fromtimestamp(ts, timezone.utc)
+    return int(moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+
+@dataclass
+class EnforceReport:
+    counted: int = 0  # юзеров с квотой, чьи счетчики обновлены на этом тике
+    banned: List[str] = field(default_factory=list)
+    released: List[str] = field(default_factory=list)
+    # операции Xray, которые не прошли; БД уже права, добьет `user reconcile`
+    failed: List[Tuple[SyncOp, str]] = field(default_factory=list)
+
+
+class QuotaEnforcer:
+    """Учет квот по приращениям коллектора и автобан.
+
+    На тике трогаются только юзеры из приращений (O(измененных)), а не все квоты. Бан —
+    пачками по QUOTA_BAN_BATCH: сначала is_active=False в БД (источник правды; подписки
+    видят бан через версию меша), затем remove_user во всех тегах через BulkSyncEngine.
+    Забаненные за период возвращаются сами, когда наступает следующий период.
+    """
+
+    def __init__(self, address: Optional[str] = None, tags: Optional[List[str]] = None):
+        self.address = address
+        self.tags = tags or settings.inbound_tags_list
+
+    def __call__(self, session: Session, deltas: Deltas, now: Optional[int] = None):
+        """Хук TrafficCollector.on_deltas"""
+        return self.apply(session, deltas, now)
+
+    def apply(self, session: Session, deltas: Deltas, now: Optional[int] = None) -> EnforceReport:
+        now = int(time.time()) if now is None else now
+        report = EnforceReport()
+
+        exceeded = self.count(session, deltas, now, report)
+        if exceeded:
+            self.ban(session, exceeded, report)
+        self.release(session, now, report)
+
+        if report.banned or report.released:
+            refresh_static_export(session)
+        metrics.inc("quota.banned", len(report.banned))
+        metrics.inc("quota.released", len(report.released))
+        return report
+
+    def count(self, session: Session, deltas: Deltas, now: int, report: EnforceReport) -> List[str]:
+        """Прибавляет приращения к счетчикам квот. Возвращает активных, кто только что вышел
+        за лимит"""
+        used_by_email: Dict[str, int] = {}
+        for (kind, name), (up, down) in deltas.items():
+            if kind == "user":
+                used_by_email[name] = up + down
+
+        exceeded = []
+        for chunk in chunks(list(used_by_email), IN_CHUNK):
+            rows = session.exec(
+                select(UserQuota, User.email, User.is_active)
+                .join(User, col(User.id) == UserQuota.user_id)
+                .where(col(User.email).in_(chunk))
+            ).all()
+            for quota, email, is_active in rows:
+                used = used_by_email[email]
+                if quota.period is not None:
+                    start = period_start(quota.period, now)
+                    if quota.period_start != start:
+                        quota.period_start, quota.period_used = start, 0
+                quota.used += used
+                quota.period_used += used
+                if is_active and quota.exceeded_at is None and quota.exceeded():
+                    quota.exceeded_at = now
+                    exceeded.append(email)
+                session.add(quota)
+                report.counted += 1
+        session.commit()
+        return exceeded
+
+    def ban(self, session: Session, emails: List[str], report: EnforceReport):
+        for batch in chunks(emails, settings.QUOTA_BAN_BATCH):
+            session.execute(update(User).where(col(User.email).in_(batch)).values(is_active=False))
+            session.commit()
+            sync = run_bulk_sync(remove_ops(batch, self.tags), address=self.address)
+            report.banned.extend(batch)
+            report.failed.extend(sync.failed)
+
+    def release(self, session: Session, now: int, report: EnforceReport):
+        """Возвращает забаненных по периодной квоте, если период сменился. Смотрит только
+        на строки с exceeded_at (индекс), а их единицы. exceeded_at ставит только автобан,
+        ручной ban/unban его снимает (forget_auto_ban) — чужие баны здесь не отменяются"""
+        rows = session.exec(
+            select(UserQuota, User)
+            .join(User, col(User.id) == UserQuota.user_id)
+            .where(
+                col(UserQuota.exceeded_at).is_not(None),
+                col(UserQuota.period).is_not(None),
+                col(User.is_active).is_(False),
+            )
+        ).all()
+
+        released = []
+        for quota, user in rows:
+            if quota.period is None:
+                continue
+            start = period_start(quota.period, now)
+            if quota.period_start == start:
+                continue
+            quota.period_start, quota.period_used = start, 0
+            if quota.exceeded():  # общий лимит все еще исчерпан
+                session.add(quota)
+                continue
+            quota.exceeded_at = None
+            user.is_active = True
+            session.add(quota)
+            session.add(user)
+            released.append((user.email, user.uuid))
+        if not released:
+            session.commit()
+            return
+
+        session.commit()
+        for batch in chunks(released, settings.QUOTA_BAN_BATCH):
+            sync = run_bulk_sync(add_ops(batch, self.tags), address=self.address)
+            report.failed.extend(sync.failed)
+        report.released.extend(email for email, _ in released)
+
+
+def forget_auto_ban(session: Session, user_id: Optional[int]):
+    """Ручной ban/unban перекрывает автобан: снимаем exceeded_at, чтобы QuotaEnforcer не
+    разбанил вручную забаненного со сменой периода и снова забанил разбаненного, если
+    лимит все еще превышен. Коммит — на вызывающем"""
+    session.execute(
+        update(UserQuota).where(col(UserQuota.user_id) == user_id).values(exceeded_at=None)
+    )
@@ -0,0 +1,123 @@
+import heapq
+import time
+from array import array
+from typing import Dict, List, NamedTuple, Optional
+
+from app.core.stats_cache import Stats
+from app.utils.traffic_collector import parse_counters
+
+
+class RateRow(NamedTuple):
+    email: str
+    up: float  # байт/с на последнем интервале
+    down: float
+    avg_up: float  # скользящее среднее по окну
+    avg_down: float
+
+    @property
+    def total(self) -> float:
+        return self.up + self.down
+
+
+class RateEngine:
+    """Скорости юзеров (байт/с) по приращениям кумулятивных счетчиков Xray.
+
+    Кольцевые буферы на array('d'): у каждого юзера свой слот из `window` ячеек в одном
+    плоском массиве на направление, курсор кольца общий (все юзеры меряются в одном
+    тике). Память — 2 * 8 * window байт на юзера, без объектов на каждый замер.
+    """
+
+    def __init__(self, window: int = 30):
+        self.window = max(1, window)
+        self._slots: Dict[str, int] = {}
+        self._emails: List[str] = []
+        self._up = array("d")
+        self._down = array("d")
+        # Последние кумулятивные значения счетчиков, по слоту
+        self._last_up = array("q")
+        self._last_down = array("q")
+        self._pos = -1
+        self._filled = 0
+        self._last_at: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._emails)
+
+    def _slot(self, email: str) -> int:
+        slot = self._slots.get(email)
+        if slot is None:
+            slot = self._slots[email] = len(self._emails)
+            self._emails.append(email)
+            self._up.extend(array("d", bytes(8 * self.window)))
+            self._down.extend(array("d", bytes(8 * self.window)))
+            self._last_up.append(-1)
+            self._last_down.append(-1)
+        return slot
+
+    @staticmethod
+    def _delta(current: int, last: int) -> int:
+        if last < 0:
+            return 0  # первый замер юзера — только база
+        # Счетчик уменьшился: рестарт Xray или сброс коллектором — считаем от нуля
+        return current - last if current >= last else current
+
+    def sample(self, stats: Stats, now: Optional[float] = None) -> bool:
+        """Один замер (ответ QueryStats без reset). False — это был базовый замер"""
+        now = time.monotonic() if now is None else now
+        counters = {name: pair for (kind, name), pair in parse_counters(stats).items()}
+        previous, self._last_at = self._last_at, now
+
+        self._pos = (self._pos + 1) % self.window
+        base_pos = self._pos
+        elapsed = (now - previous) if previous is not None else 0.0
+        for email in counters:
+            self._slot(email)
+
+        w = self.window
+        for slot, email in enumerate(self._emails):
+            up, down = counters.get(email, (-1, -1))
+            i = slot * w + base_pos
+            if up < 0:
+                # Нулевые счетчики (сброшены и без трафика) parse_counters не отдает
+                self._up[i] = self._down[i] = 0.0
+                self._last_up[slot] = self._last_down[slot] = 0
+                continue
+            d_up = self._delta(up, self._last_up[slot])
+            d_down = self._delta(down, self._last_down[slot])
+            self._last_up[slot], self._last_down[slot] = up, down
+            self._up[i] = d_up / elapsed if elapsed > 0 else 0.0
+            self._down[i] = d_down / elapsed if elapsed > 0 else 0.0
+
+        if previous is None:
+            self._pos -= 1  # база не занимает ячейку кольца
+            return False
+        self._filled = min(self._filled + 1, w)
+        return True
+
+    def rate(self, email: str) -> Optional[RateRow]:
+        slot = self._slots.get(email)
+        if slot is None or not self._filled:
+            return None
+        return self._row(slot)
+
+    def _row(self, slot: int) -> RateRow:
+        w = self.window
+        base = slot * w
+        i = base + self._pos
+        # Незаполненные ячейки — нули, делим на число реальных замеров
+        avg_up = sum(self._up[base : base + w]) / self._filled
+        avg_down = sum(self._down[base : base + w]) / self._filled
+        return RateRow(self._emails[slot], self._up[i], self._down[i], avg_up, avg_down)
+
+    def top(self, n: int = 10, sort: str = "total") -> List[RateRow]:
+        """Самые тяжелые по текущей скорости: sort = total | up | down | avg"""
+        if not self._filled:
+            return []
+        rows = (self._row(slot) for slot in range(len(self._emails)))
+        keys = {
+            "total": lambda r: r.total,
+            "up": lambda r: r.up,
+            "down": lambda r: r.down,
+            "avg": lambda r: r.avg_up + r.avg_down,
+        }
+        return heapq.nlargest(n, rows, key=keys[sort])
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+
+import grpc
+from sqlmodel import Session, select
+
+from app.core.grpc_client import AzenordXrayAsyncControl
+from app.core.models import User
+from app.utils.bulk_sync import BulkSyncEngine, SyncOp, SyncReport
+
+# tag -> {email: uuid}
+InboundState = Dict[str, Dict[str, str]]
+
+
+class InboundUsersError(grpc.aio.AioRpcError):
+    """AioRpcError GetInboundUsers с тегом инбаунда, на котором вызов упал"""
+
+    def __init__(self, tag: str, error: grpc.aio.AioRpcError):
+        super().__init__(
+            error.code(),
+            error.initial_metadata(),
+            error.trailing_metadata(),
+            error.details(),
+            error.debug_error_string(),
+        )
+        self.tag = tag
+
+
+@dataclass
+class ReconcilePlan:
+    to_remove: List[SyncOp] = field(default_factory=list)
+    to_add: List[SyncOp] = field(default_factory=list)
+    live_counts: Dict[str, int] = field(default_factory=dict)
+    desired_counts: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def in_sync(self) -> bool:
+        return not self.to_remove and not self.to_add
+
+
+@dataclass
+class ReconcileResult:
+    plan: ReconcilePlan
+    removed: Optional[SyncReport] = None
+    added: Optional[SyncReport] = None
+    timings: Dict[str, float] = field(default_factory=dict)  # фаза -> ms
+
+    @property
+    def ok(self) -> bool:
+        return all(r is None or r.ok for r in (self.removed, self.added))
+
+
+def desired_state(users: Iterable[User], tags: Iterable[str]) -> InboundState:
+    """Каким Xray должен быть по БД: все активные юзеры в каждом активном теге"""
+    active = {u.email: u.uuid for u in users if u.is_active}
+    return {tag: dict(active) for tag in tags}
+
+
+def diff(desired: InboundState, live: InboundState) -> ReconcilePlan:
+    """Минимальный набор операций. Смена UUID при том же email — remove + add"""
+    plan = ReconcilePlan()
+    for tag, want in desired.items():
+        have = live.get(tag, {})
+        plan.desired_counts[tag] = len(want)
+        plan.live_counts[tag] = len(have)
+
+        for email, user_uuid in have.items():
+            if want.get(email) != user_uuid:
+                plan.to_remove.append(SyncOp("remove", tag, email))
+        for email, user_uuid in want.items():
+            if have.get(email) != user_uuid:
+                plan.to_add.append(SyncOp("add", tag, email, user_uuid))
+    return plan
+
+
+async def _inbound_users(client: AzenordXrayAsyncControl, tag: str) -> Dict[str, str]:
+    try:
+        return await client.get_inbound_users(tag)
+    except grpc.aio.AioRpcError as e:
+        raise InboundUsersError(tag, e) from e
+
+
+async def fetch_live_state(client: AzenordXrayAsyncControl, tags: Iterable[str]) -> InboundState:
+    """Ошибку не глотает (InboundUsersError — это AioRpcError с тегом): по неполным
+    данным нельзя решать, кого удалять"""
+    tags = list(tags)
+    results = await asyncio.gather(*(_inbound_users(client, tag) for tag in tags))
+    return dict(zip(tags, results))
+
+
+def _elapsed_ms(started: float) -> float:
+    return (time.perf_counter() - started) * 1000
+
+
+async def reconcile(
+    users: Iterable[User],
+    tags: Iterable[str],
+    client: AzenordXrayAsyncControl,
+    dry_run: bool = False,
+    inflight: Optional[int] = None,
+) -> ReconcileResult:
+    tags = list(tags)
+    timings = {}
+
+    started = time.perf_counter()
+    live = await fetch_live_state(client, tags)
+    timings["fetch"] = _elapsed_ms(started)
+
+    started = time.perf_counter()
+    plan = diff(desired_state(users, tags), live)
+    timings["diff"] = _elapsed_ms(started)
+
+    result = ReconcileResult(plan=plan, timings=timings)
+    if dry_run or plan.in_sync:
+        return result
+
+    sync = BulkSyncEngine(client, inflight=inflight)
+    # Сначала remove: при смене UUID add того же email иначе упрется в "already exists"
+    started = time.perf_counter()
+    result.removed = await sync.run(plan.to_remove)
+    timings["remove"] = _elapsed_ms(started)
+
+    started = time.perf_counter()
+    result.added = await sync.run(plan.to_add)
+    timings["add"] = _elapsed_ms(started)
+    return result
+
+
+def run_reconcile(
+    session: Session,
+    tags: Iterable[str],
+    address: Optional[str] = None,
+    dry_run: bool = False,
+    inflight: Optional[int] = None,
+) -> ReconcileResult:
+    """Синхронная обертка для CLI: БД -> живое состояние Xray -> diff -> применение"""
+    started = time.perf_counter()
+    users = list(session.exec(select(User)).all())
+    db_ms = _elapsed_ms(started)
+
+    async def main():
+        async with AzenordXrayAsyncControl(address) as client:
+            return await reconcile(users, tags, client, dry_run, inflight)
+
+    result = asyncio.run(main())
+    result.timings = {"db": db_ms, **result.timings}
+    return result
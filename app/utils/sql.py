@@ -0,0 +1,9 @@
+from typing import Iterable, Sequence
+
+# SQLite ограничивает число параметров запроса; IN (...) режем на куски
+IN_CHUNK = 500
+
+
+def chunks(items: Sequence, size: int) -> Iterable[Sequence]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
@@ -0,0 +1,136 @@
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from sqlmodel import Session, select
+
+from app.core.config import settings
+from app.core.models import Route, User
+from app.utils.mesh_snapshot import MeshSnapshot, read_version
+
+# Схема раскладки:
+#   objects/<blake2b>.json(.gz)  — тела подписок, имя = хэш содержимого
+#   <uuid>.json(.gz)             — симлинк на объект; его и ищет nginx через try_files
+#   .manifest.json               — отпечаток шаблона и digest каждого юзера прошлого прогона
+#   .export.lock                 — flock: два экспорта (CLI + квоты) не чистят объекты друг друга
+OBJECTS_DIR = "objects"
+MANIFEST = ".manifest.json"
+LOCK = ".export.lock"
+# UUID становится именем файла — пропускаем только то, что матчит и location в nginx
+_SAFE_UUID = re.compile(r"^[0-9A-Za-z-]{1,64}$")
+
+
+@dataclass
+class ExportReport:
+    exported: int = 0  # активных юзеров со ссылкой на актуальный объект
+    rendered: int = 0  # тел, собранных заново (остальные взяты из манифеста)
+    written: int = 0  # новых объектов (остальные переиспользованы без записи)
+    removed: int = 0  # ссылок забаненных/удаленных юзеров
+    collected: int = 0  # осиротевших объектов
+    elapsed_ms: float = 0.0
+
+
+def _write_atomic(path: Path, data: bytes):
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _link_atomic(link: Path, target: str):
+    # Новый симлинк рядом + rename: nginx никогда не видит полуготовую ссылку
+    tmp = link.with_name(f".{link.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    os.symlink(target, tmp)
+    os.replace(tmp, link)
+
+
+def _read_manifest(path: Path) -> Dict[str, Any]:
+    try:
+        return json.loads(path.read_bytes())
+    except (OSError, ValueError):
+        return {}
+
+
+def export_subscriptions(session: Session, out_dir: Optional[Path] = None) -> ExportReport:
+    """Рендерит подписки всех активных юзеров в файлы для прямой раздачи через nginx"""
+    out_dir = out_dir or settings.sub_export_path
+    (out_dir / OBJECTS_DIR).mkdir(parents=True, exist_ok=True)
+    with open(out_dir / LOCK, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _export(session, out_dir)
+
+
+def _export(session: Session, out_dir: Path) -> ExportReport:
+    started = time.perf_counter()
+    objects = out_dir / OBJECTS_DIR
+
+    users = list(session.exec(select(User)).all())
+    routes = list(session.exec(select(Route)).all())
+    snapshot = MeshSnapshot.build(read_version(session), users, routes)
+
+    # Шаблон не изменился (бан, квота, тот же набор хостов) — тела прежних юзеров тоже:
+    # берем digest из манифеста и не рендерим/хэшируем N подписок ради одной
+    manifest = _read_manifest(out_dir / MANIFEST)
+    template = snapshot.template.digest
+    previous = manifest.get("users", {}) if manifest.get("template") == template else {}
+
+    report = ExportReport()
+    live_links = set()
+    live_objects = set()
+    digests: Dict[str, List[str]] = {}
+
+    for user_uuid, email in snapshot.active_emails.items():
+        if not _SAFE_UUID.match(user_uuid):
+            continue
+        known = previous.get(user_uuid)
+        if known and known[0] == email and (objects / f"{known[1]}.json").exists():
+            digest = known[1]
+        else:
+            body = snapshot.render(user_uuid, email)
+            digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+            report.rendered += 1
+
+            obj = objects / f"{digest}.json"
+            if not obj.exists():
+                # .gz пишется первым: объект без пары для gzip_static не появляется
+                _write_atomic(obj.with_name(f"{obj.name}.gz"), gzip.compress(body, mtime=0))
+                _write_atomic(obj, body)
+                report.written += 1
+        digests[user_uuid] = [email, digest]
+
+        for suffix in (".json", ".json.gz"):
+            link = out_dir / f"{user_uuid}{suffix}"
+            target = f"{OBJECTS_DIR}/{digest}{suffix}"
+            if not link.is_symlink() or os.readlink(link) != target:
+                _link_atomic(link, target)
+            live_links.add(link.name)
+            live_objects.add(f"{digest}{suffix}")
+        report.exported += 1
+
+    # Ссылки юзеров, которые больше не активны, — убираем (иначе nginx отдаст бан-юзеру конфиг)
+    for link in out_dir.iterdir():
+        if link.is_symlink() and link.name not in live_links:
+            link.unlink()
+            report.removed += 1
+
+    for obj in objects.iterdir():
+        if obj.name not in live_objects and not obj.name.startswith("."):
+            obj.unlink()
+            report.collected += 1
+
+    _write_atomic(out_dir / MANIFEST, json.dumps({"template": template, "users": digests}).encode())
+    report.elapsed_ms = (time.perf_counter() - started) * 1000
+    return report
+
+
+def refresh_static_export(session: Session):
+    """Перегенерирует экспорт после изменений из CLI, если включен SUB_STATIC_EXPORT"""
+    if settings.SUB_STATIC_EXPORT:
+        export_subscriptions(session)
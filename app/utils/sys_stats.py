@@ -0,0 +1,114 @@
+from typing import Dict, List, NamedTuple, Optional, cast
+
+from sqlalchemy import CursorResult, delete, func, select
+from sqlalchemy.orm import Session
+from sqlmodel import col
+
+from app.core.config import settings
+from app.core.models import User, XraySysSample
+
+
+class SysBucket(NamedTuple):
+    ts: int  # начало бакета
+    max_alloc: int
+    max_sys: int
+    max_goroutines: int
+    gc_runs: int  # сколько циклов GC прошло за бакет
+    avg_users: float
+    traffic: int
+
+
+def store_sys_sample(session: Session, stats: Dict[str, int], ts: int, traffic: int = 0) -> int:
+    """Замер GetSysStats + нагрузка в тот же момент (активные юзеры, трафик за тик)"""
+    users = session.execute(select(func.count()).where(col(User.is_active))).scalar_one()
+    session.add(
+        XraySysSample(
+            ts=ts,
+            goroutines=stats["goroutines"],
+            alloc=stats["alloc"],
+            sys=stats["sys"],
+            num_gc=stats["num_gc"],
+            pause_total_ns=stats["pause_total_ns"],
+            live_objects=stats["live_objects"],
+            uptime=stats["uptime"],
+            users=users,
+            traffic=traffic,
+        )
+    )
+    return users
+
+
+def prune_sys_samples(session: Session, now: int) -> int:
+    cutoff = now - settings.SYS_STATS_RETENTION
+    result = session.execute(delete(XraySysSample).where(col(XraySysSample.ts) < cutoff))
+    return cast(CursorResult, result).rowcount
+
+
+def _gc_runs(session: Session, since: int, until: Optional[int], step: int) -> Dict[int, int]:
+    """Циклы GC по бакетам: сумма приращений num_gc между соседними замерами (приращение
+    идет в бакет более позднего замера). Рестарт Xray обнуляет счетчики — если num_gc или
+    uptime уменьшились, приращением считается само значение (GC с момента рестарта)"""
+    ts_col = col(XraySysSample.ts)
+    query = select(ts_col, col(XraySysSample.num_gc), col(XraySysSample.uptime)).where(
+        ts_col >= since
+    )
+    if until is not None:
+        query = query.where(ts_col < until)
+    # Базовый замер до окна: иначе GC между ним и первым замером окна потерялись бы
+    previous = session.execute(
+        select(col(XraySysSample.num_gc), col(XraySysSample.uptime))
+        .where(ts_col < since)
+        .order_by(ts_col.desc())
+        .limit(1)
+    ).first()
+
+    runs: Dict[int, int] = {}
+    for ts, num_gc, uptime in session.execute(query.order_by(ts_col)):
+        key = ts // step * step
+        if previous is None:
+            runs.setdefault(key, 0)
+        elif num_gc < previous[0] or uptime < previous[1]:
+            runs[key] = runs.get(key, 0) + num_gc
+        else:
+            runs[key] = runs.get(key, 0) + num_gc - previous[0]
+        previous = (num_gc, uptime)
+    return runs
+
+
+def sys_series(
+    session: Session, since: int, until: Optional[int] = None, step: int = 3600
+) -> List[SysBucket]:
+    """Ряд по бакетам: пики памяти/горутин, число GC (с учетом рестартов Xray, см.
+    _gc_runs), средние юзеры и суммарный трафик"""
+    bucket = (col(XraySysSample.ts) // step) * step
+    query = (
+        select(
+            bucket,
+            func.max(XraySysSample.alloc),
+            func.max(XraySysSample.sys),
+            func.max(XraySysSample.goroutines),
+            func.avg(XraySysSample.users),
+            func.sum(XraySysSample.traffic),
+        )
+        .where(col(XraySysSample.ts) >= since)
+        .group_by(bucket)
+        .order_by(bucket)
+    )
+    if until is not None:
+        query = query.where(col(XraySysSample.ts) < until)
+
+    gc_runs = _gc_runs(session, since, until, step)
+    series = []
+    for ts, alloc, sys, goroutines, users, traffic in session.execute(query):
+        series.append(
+            SysBucket(
+                int(ts),
+                alloc,
+                sys,
+                goroutines,
+                gc_runs.get(int(ts), 0),
+                float(users),
+                int(traffic or 0),
+            )
+        )
+    return series
@@ -0,0 +1,254 @@
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, cast
+
+import grpc
+from sqlalchemy import CursorResult, func, orm, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, col, select
+
+from app.core.config import settings
+from app.core.grpc_client import AzenordXrayControl
+from app.core.metrics import metrics
+from app.core.models import TrafficSample
+from app.utils.sys_stats import prune_sys_samples, store_sys_sample
+
+RAW, HOUR, DAY = 0, 3600, 86_400
+
+# Функции запросов берут sqlalchemy.orm.Session: API зовет их через AsyncSession.run_sync,
+# а sqlmodel.Session (CLI, коллектор) — ее подкласс
+
+# (kind, name) -> (uplink, downlink)
+Deltas = Dict[Tuple[str, str], Tuple[int, int]]
+
+# user>>>{email}>>>traffic>>>uplink, inbound>>>{tag}>>>traffic>>>downlink
+_COUNTER = re.compile(r"^(user|inbound)>>>(.+)>>>traffic>>>(uplink|downlink)$")
+# Служебный инбаунд gRPC API — не трафик резидентов
+_SKIP = {("inbound", "api")}
+
+_DURATION = re.compile(r"^(\d+)([smhdw])$")
+_UNITS = {"s": 1, "m": 60, "h": HOUR, "d": DAY, "w": 7 * DAY}
+
+
+def parse_duration(value: str) -> int:
+    """'90s', '15m', '24h', '7d', '2w' -> секунды"""
+    match = _DURATION.match(value.strip().lower())
+    if not match:
+        raise ValueError(f"Bad duration: {value!r} (expected e.g. 15m, 24h, 7d)")
+    return int(match.group(1)) * _UNITS[match.group(2)]
+
+
+def parse_counters(stats: Dict[str, int]) -> Deltas:
+    """Ответ QueryStats -> приращения по источникам. Нулевые не возвращаются"""
+    deltas: Dict[Tuple[str, str], List[int]] = {}
+    for counter, value in stats.items():
+        match = _COUNTER.match(counter)
+        if not match or not value:
+            continue
+        kind, name, direction = match.groups()
+        if (kind, name) in _SKIP:
+            continue
+        pair = deltas.setdefault((kind, name), [0, 0])
+        pair[0 if direction == "uplink" else 1] += value
+    return {key: (up, down) for key, (up, down) in deltas.items()}
+
+
+def merge_deltas(*parts: Deltas) -> Deltas:
+    merged: Dict[Tuple[str, str], Tuple[int, int]] = {}
+    for deltas in parts:
+        for key, (up, down) in deltas.items():
+            old_up, old_down = merged.get(key, (0, 0))
+            merged[key] = (old_up + up, old_down + down)
+    return merged
+
+
+def store_samples(session: orm.Session, deltas: Deltas, ts: int) -> int:
+    """Пачкой одной транзакции: один executemany на тик, а не INSERT на каждого юзера"""
+    if not deltas:
+        return 0
+    rows = [
+        {"kind": kind, "name": name, "resolution": RAW, "ts": ts, "uplink": up, "downlink": down}
+        for (kind, name), (up, down) in deltas.items()
+    ]
+    stmt = insert(TrafficSample)
+    # Два замера в одну секунду (повторный запуск) складываются, а не падают на UNIQUE
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["kind", "name", "resolution", "ts"],
+        set_={
+            "uplink": TrafficSample.uplink + stmt.excluded.uplink,
+            "downlink": TrafficSample.downlink + stmt.excluded.downlink,
+        },
+    )
+    session.execute(stmt, rows)
+    return len(rows)
+
+
+_ROLLUP = text(
+    """
+    INSERT INTO trafficsample (kind, name, resolution, ts, uplink, downlink)
+    SELECT kind, name, :target, (ts / :target) * :target, SUM(uplink), SUM(downlink)
+    FROM trafficsample
+    WHERE resolution = :source AND ts < :cutoff
+    GROUP BY kind, name, ts / :target
+    ON CONFLICT (kind, name, resolution, ts) DO UPDATE SET
+        uplink = uplink + excluded.uplink,
+        downlink = downlink + excluded.downlink
+    """
+)
+
+
+def rollup(session: orm.Session, now: Optional[int] = None) -> Dict[str, int]:
+    """Сворачивает старые замеры: сырые -> часы, часы -> сутки. Сколько строк свернуто.
+
+    Сворачиваются только целые бакеты (граница выровнена по ширине бакета), поэтому
+    повторный запуск ничего не задваивает.
+    """
+    now = int(time.time()) if now is None else now
+    folded = {}
+    for source, target, retention in (
+        (RAW, HOUR, settings.TRAFFIC_RAW_RETENTION),
+        (HOUR, DAY, settings.TRAFFIC_HOURLY_RETENTION),
+    ):
+        cutoff = (now - retention) // target * target
+        params = {"source": source, "target": target, "cutoff": cutoff}
+        session.execute(_ROLLUP, params)
+        deleted = session.execute(
+            text("DELETE FROM trafficsample WHERE resolution = :source AND ts < :cutoff"), params
+        )
+        folded["hour" if target == HOUR else "day"] = cast(CursorResult, deleted).rowcount
+    return folded
+
+
+def traffic_totals(
+    session: orm.Session,
+    kind: str,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    name: Optional[str] = None,
+) -> Dict[str, Tuple[int, int]]:
+    """Сумма (uplink, downlink) по источникам за [since, until) по всем разрешениям"""
+    query = (
+        select(
+            TrafficSample.name,
+            func.sum(TrafficSample.uplink),
+            func.sum(TrafficSample.downlink),
+        )
+        .where(TrafficSample.kind == kind)
+        .group_by(TrafficSample.name)
+    )
+    if name is not None:
+        query = query.where(TrafficSample.name == name)
+    if since is not None:
+        query = query.where(TrafficSample.ts >= since)
+    if until is not None:
+        query = query.where(TrafficSample.ts < until)
+    return {row[0]: (int(row[1]), int(row[2])) for row in session.execute(query)}
+
+
+def traffic_series(
+    session: orm.Session,
+    kind: str,
+    name: str,
+    since: int,
+    until: Optional[int] = None,
+    step: int = HOUR,
+) -> List[Tuple[int, int, int]]:
+    """[(начало бакета, uplink, downlink)] с шагом step. Шаг мельче хранимого разрешения
+    (минута по свернутым суткам) честно покажет весь трафик в начале бакета"""
+    bucket = (col(TrafficSample.ts) // step) * step
+    query = (
+        select(bucket, func.sum(TrafficSample.uplink), func.sum(TrafficSample.downlink))
+        .where(TrafficSample.kind == kind, TrafficSample.name == name)
+        .where(TrafficSample.ts >= since)
+        .group_by(bucket)
+        .order_by(bucket)
+    )
+    if until is not None:
+        query = query.where(TrafficSample.ts < until)
+    return [(int(ts), int(up), int(down)) for ts, up, down in session.execute(query)]
+
+
+class TrafficCollector:
+    """Опрос QueryStats(reset=True) -> приращения в trafficsample.
+
+    Клиент создается с retry=False: сброс счетчиков неидемпотентен. Свертка в часы/сутки —
+    раз в час, на тике, который пересек границу часа. `on_deltas(session, deltas, ts)`
+    вызывается на каждом тике уже после коммита (так QuotaEnforcer считает квоты по
+    приращениям, а не по всей таблице). `sample_sys` — заодно писать GetSysStats
+    в xraysyssample.
+
+    Xray обнуляет счетчики до записи в SQLite: если запись не прошла (database is locked
+    от `user import` или IPAM), приращения остаются в памяти и уходят следующим тиком.
+    Ошибка хука на запись истории не влияет.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        address: Optional[str] = None,
+        on_deltas: Optional[Callable[[Session, Deltas, int], Any]] = None,
+        sample_sys: bool = True,
+    ):
+        self.session_factory = session_factory
+        self.client = AzenordXrayControl(address, retry=False)
+        self.on_deltas = on_deltas
+        self.sample_sys = sample_sys
+        self._rolled_hour: Optional[int] = None
+        # Уже снятые с Xray, но еще не записанные приращения
+        self._pending: Deltas = {}
+
+    def collect_once(self, now: Optional[float] = None) -> Deltas:
+        started = time.perf_counter()
+        ts = int(time.time() if now is None else now)
+        self._pending = merge_deltas(self._pending, parse_counters(self.client.drain_stats()))
+        deltas = self._pending
+        # Рантайм Xray в тот же момент; недоступен — тик трафика от этого не страдает
+        sys_stats = self.client.get_sys_stats() if self.sample_sys else None
+
+        with self.session_factory() as session:
+            stored = store_samples(session, deltas, ts)
+            if sys_stats is not None:
+                traffic = sum(
+                    up + down for (kind, _), (up, down) in deltas.items() if kind == "inbound"
+                )
+                store_sys_sample(session, sys_stats, ts, traffic)
+            if self._rolled_hour != ts // HOUR:
+                rollup(session, ts)
+                prune_sys_samples(session, ts)
+                self._rolled_hour = ts // HOUR
+            session.commit()
+        self._pending = {}
+
+        # После коммита: хук может ходить в Xray, а держать при этом запись в SQLite нельзя
+        if self.on_deltas:
+            try:
+                with self.session_factory() as session:
+                    self.on_deltas(session, deltas, ts)
+            except Exception as e:
+                # Повторять хук нельзя (QuotaEnforcer мог успеть прибавить квоты) — только учет
+                metrics.inc("traffic_collector.hook_errors")
+                print(f"Collector Hook Error: {e!r}")
+
+        metrics.inc("traffic_collector.ticks")
+        metrics.set("traffic_collector.last_rows", stored)
+        metrics.set("traffic_collector.last_tick_ms", (time.perf_counter() - started) * 1000)
+        return deltas
+
+    def run_forever(self, interval: Optional[float] = None):
+        interval = interval or settings.TRAFFIC_COLLECT_INTERVAL
+        while True:
+            started = time.monotonic()
+            try:
+                self.collect_once()
+            except grpc.RpcError as e:
+                # Xray перезапускается — счетчики и так обнулены, ждем следующий тик
+                metrics.inc("traffic_collector.errors")
+                print(f"Collector Error: {cast(grpc.Call, e).details()}")
+            except Exception as e:
+                # SQLite занята и т.п.: демон живет, приращения ждут в памяти следующего тика
+                metrics.inc("traffic_collector.errors")
+                print(f"Collector Error: {e!r} ({len(self._pending)} sources pending)")
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    def close(self):
+        self.client.channel.close()
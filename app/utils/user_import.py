@@ -0,0 +1,294 @@
+import asyncio
+import csv
+import json
+import re
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import IO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Union
+
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel import Session, col, select
+
+from app.core.config import settings
+from app.core.grpc_client import AzenordXrayAsyncControl
+from app.core.models import User
+from app.utils.bulk_sync import BulkSyncEngine, SyncOp, add_ops
+from app.utils.ipam import cancel_ips, confirm_ips, reserve_ips, resolve_pool, session_engine
+from app.utils.sql import IN_CHUNK, chunks
+
+FORMATS = ("csv", "jsonl", "json")
+
+# Ник уходит в DNS-имя (<ник>.MESH_DOMAIN) — только то, что переживет hosts и Clash
+_NICKNAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9_-]{0,62}")
+_EMAIL = re.compile(r"[^@\s]+@[^@\s]+")
+
+
+class ImportRow(NamedTuple):
+    line: int  # строка файла (CSV, JSON Lines) или номер записи (JSON-массив)
+    nickname: str
+    email: str
+    pool: Optional[str] = None
+
+
+class RowError(NamedTuple):
+    line: int
+    nickname: str
+    email: str
+    error: str
+
+
+@dataclass
+class ImportReport:
+    rows: int = 0
+    created: int = 0
+    batches: int = 0
+    failed_batches: int = 0
+    errors: List[RowError] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    def fail(self, rows: Iterable[ImportRow], error: str):
+        self.errors.extend(RowError(r.line, r.nickname, r.email, error) for r in rows)
+
+
+def detect_format(filename: str) -> str:
+    suffix = filename.rsplit(".", 1)[-1].lower()
+    if suffix in ("jsonl", "ndjson"):
+        return "jsonl"
+    return "json" if suffix == "json" else "csv"
+
+
+def _row(line: int, record) -> Union[ImportRow, RowError]:
+    if not isinstance(record, dict):
+        return RowError(line, "", "", "expected an object with nickname and email")
+    nickname = str(record.get("nickname") or "").strip()
+    email = str(record.get("email") or "").strip()
+    pool = str(record.get("pool") or "").strip() or None
+    if not _NICKNAME.fullmatch(nickname):
+        return RowError(line, nickname, email, "invalid nickname")
+    if not _EMAIL.fullmatch(email):
+        return RowError(line, nickname, email, "invalid email")
+    if pool is not None:
+        try:
+            resolve_pool(pool)
+        except ValueError as e:
+            return RowError(line, nickname, email, str(e))
+    return ImportRow(line, nickname, email, pool)
+
+
+def read_rows(stream: IO[str], fmt: str) -> Iterator[Union[ImportRow, RowError]]:
+    """Строки файла по одной: CSV и JSON Lines читаются потоково, файл целиком в памяти
+    не держится. JSON-массив парсится сразу (json не умеет читать массив по частям)"""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        reader.fieldnames = [name.strip().lower() for name in reader.fieldnames or []]
+        if not {"nickname", "email"} <= set(reader.fieldnames):
+            raise ValueError("CSV header must contain nickname and email")
+        for record in reader:
+            yield _row(reader.line_num, record)
+    elif fmt == "jsonl":
+        for line, text in enumerate(stream, start=1):
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text)
+            except json.JSONDecodeError as e:
+                yield RowError(line, "", "", f"invalid JSON: {e.msg}")
+                continue
+            yield _row(line, record)
+    elif fmt == "json":
+        records = json.load(stream)
+        if isinstance(records, dict):
+            records = records.get("users", [])
+        for line, record in enumerate(records, start=1):
+            yield _row(line, record)
+    else:
+        raise ValueError(f"Unknown import format: {fmt}")
+
+
+def _db_error(error: SQLAlchemyError) -> str:
+    return f"database: {getattr(error, 'orig', None) or error}"
+
+
+class UserImporter:
+    """Импорт юзеров батчами: проверка -> IP на весь батч -> Xray -> один INSERT.
+
+    Батч — все или ничего: если хоть одна операция AlterInbound или INSERT не прошла,
+    уже добавленные в Xray операции батча откатываются, IP возвращаются в пул, в БД
+    не попадает ни одна строка батча. Невалидные строки (формат, дубли в файле, ник или
+    email уже заняты) в батч не попадают и только отмечаются в отчете.
+    client=None — без Xray (аналог `user add --no-sync`).
+    """
+
+    def __init__(
+        self,
+        session: Session,
+        tags: Iterable[str],
+        client: Optional[AzenordXrayAsyncControl] = None,
+        pool: Optional[str] = None,
+        batch_size: Optional[int] = None,
+        inflight: Optional[int] = None,
+        on_batch: Optional[Callable[[ImportReport], None]] = None,
+    ):
+        self.session = session
+        # IPAM резервирует в своих транзакциях — ему нужен Engine, а не соединение сессии
+        self.bind = session_engine(session)
+        self.tags = list(tags)
+        self.client = client
+        self.pool = pool
+        self.batch_size = max(1, batch_size or settings.IMPORT_BATCH_SIZE)
+        self.inflight = inflight
+        self.on_batch = on_batch
+        self.report = ImportReport()
+
+    async def run(self, rows: Iterable[Union[ImportRow, RowError]]) -> ImportReport:
+        started = time.perf_counter()
+        seen_nicknames, seen_emails = set(), set()
+        batch: List[ImportRow] = []
+        for row in rows:
+            self.report.rows += 1
+            if isinstance(row, RowError):
+                self.report.errors.append(row)
+                continue
+            if row.nickname in seen_nicknames or row.email in seen_emails:
+                self.report.fail([row], "duplicate in file")
+                continue
+            seen_nicknames.add(row.nickname)
+            seen_emails.add(row.email)
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                await self._flush(batch)
+                batch = []
+        if batch:
+            await self._flush(batch)
+        self.report.elapsed = time.perf_counter() - started
+        return self.report
+
+    async def _flush(self, batch: List[ImportRow]):
+        self.report.batches += 1
+        if not await self._import_batch(batch):
+            self.report.failed_batches += 1
+        if self.on_batch:
+            self.on_batch(self.report)
+
+    def _fresh(self, batch: List[ImportRow]) -> List[ImportRow]:
+        """Строки, чьих ника и email еще нет в базе: IN-запросы кусками по IN_CHUNK"""
+        taken_nicknames, taken_emails = set(), set()
+        for chunk in chunks(batch, IN_CHUNK):
+            nicknames = [r.nickname for r in chunk]
+            emails = [r.email for r in chunk]
+            taken_nicknames.update(
+                self.session.exec(select(User.nickname).where(col(User.nickname).in_(nicknames)))
+            )
+            taken_emails.update(
+                self.session.exec(select(User.email).where(col(User.email).in_(emails)))
+            )
+        fresh = []
+        for row in batch:
+            if row.nickname in taken_nicknames:
+                self.report.fail([row], "nickname already exists")
+            elif row.email in taken_emails:
+                self.report.fail([row], "email already exists")
+            else:
+                fresh.append(row)
+        return fresh
+
+    def _reserve(self, rows: List[ImportRow]) -> Dict[int, str]:
+        """IP на весь батч: один резерв на пул. line -> ip"""
+        by_pool: Dict[Optional[str], List[ImportRow]] = defaultdict(list)
+        for row in rows:
+            by_pool[row.pool or self.pool].append(row)
+        ips: Dict[int, str] = {}
+        try:
+            for pool, group in by_pool.items():
+                reserved = reserve_ips(len(group), pool, bind=self.bind)
+                ips.update((row.line, ip) for row, ip in zip(group, reserved))
+        except (ValueError, SQLAlchemyError):
+            # Адреса, уже взятые из других пулов, возвращаем сразу, а не через IPAM_LEASE_TTL
+            cancel_ips(ips.values(), bind=self.bind)
+            raise
+        return ips
+
+    async def _undo(self, ops: List[SyncOp], failed: Iterable[SyncOp] = ()):
+        """Убрать из Xray то, что батч успел добавить"""
+        if self.client is None:
+            return
+        skip = set(failed)
+        undo = [SyncOp("remove", op.tag, op.email) for op in ops if op not in skip]
+        await BulkSyncEngine(self.client, self.inflight, exist_ok=True).run(undo)
+
+    async def _import_batch(self, batch: List[ImportRow]) -> bool:
+        rows = self._fresh(batch)
+        if not rows:
+            return True
+        try:
+            ips = self._reserve(rows)
+        except ValueError as e:
+            self.report.fail(rows, str(e))
+            return False
+        except SQLAlchemyError as e:
+            # Повторы IPAM исчерпаны (database is locked) — батч не импортирован, идем дальше
+            self.report.fail(rows, _db_error(e))
+            return False
+        # Поля по умолчанию (uuid, dns_name, papers_token) — из модели, как у `user add`
+        users = [
+            User(nickname=row.nickname, email=row.email, internal_ip=ips[row.line]) for row in rows
+        ]
+
+        ops: List[SyncOp] = []
+        if self.client is not None:
+            ops = add_ops([(user.email, user.uuid) for user in users], self.tags)
+            # exist_ok=False: у нового юзера в Xray ничего быть не должно
+            sync = await BulkSyncEngine(self.client, self.inflight, exist_ok=False).run(ops)
+            if not sync.ok:
+                await self._undo(ops, [op for op, _ in sync.failed])
+                cancel_ips(ips.values(), bind=self.bind)
+                errors = {op.email: f"{op.tag}: {error}" for op, error in sync.failed}
+                for row in rows:
+                    self.report.fail([row], errors.get(row.email, "batch rolled back"))
+                return False
+
+        try:
+            self.session.execute(insert(User), [user.model_dump(exclude={"id"}) for user in users])
+            confirm_ips(self.session, ips.values())
+            self.session.commit()
+        except SQLAlchemyError as e:
+            # Ник/email заняли между проверкой и INSERT'ом, база залочена, упал confirm_ips —
+            # батч уже в Xray, поэтому откатываем его и там
+            self.session.rollback()
+            await self._undo(ops)
+            cancel_ips(ips.values(), bind=self.bind)
+            self.report.fail(rows, _db_error(e))
+            return False
+
+        self.report.created += len(rows)
+        return True
+
+
+def run_import(
+    session: Session,
+    rows: Iterable[Union[ImportRow, RowError]],
+    tags: Iterable[str],
+    address: Optional[str] = None,
+    sync: bool = True,
+    pool: Optional[str] = None,
+    batch_size: Optional[int] = None,
+    inflight: Optional[int] = None,
+    on_batch: Optional[Callable[[ImportReport], None]] = None,
+) -> ImportReport:
+    """Синхронная обертка для CLI: один aio-канал к Xray на весь импорт"""
+
+    async def main():
+        if not sync:
+            importer = UserImporter(session, tags, None, pool, batch_size, inflight, on_batch)
+            return await importer.run(rows)
+        async with AzenordXrayAsyncControl(address) as client:
+            importer = UserImporter(session, tags, client, pool, batch_size, inflight, on_batch)
+            return await importer.run(rows)
+
+    return asyncio.run(main())
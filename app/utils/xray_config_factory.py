@@ -95,6 +95,12 @@ class OutboundFactory:
             return {}
         return {}
 
+    @classmethod
+    def create_user_outbounds(cls, user_uuid: str) -> List[Dict[str, Any]]:
+        """Все транспорты юзера по ACTIVE_INBOUND_TAGS (пустые отбрасываются)"""
+        outbounds = [cls.create_outbound(tag, user_uuid) for tag in settings.inbound_tags_list]
+        return [o for o in outbounds if o]
+
     @classmethod
     def get_standard_outbounds(cls) -> List[Dict[str, Any]]:
         return [
@@ -0,0 +1,279 @@
+"""In-process двойник Xray gRPC API: HandlerService + StatsService на сгенерированных стабах.
+
+Юзеры инбаундов — в памяти, счетчики трафика синтетические, на каждый вызов — задержка
+(RTT до узла) и инъекция ошибок. Достаточно, чтобы гонять клиента, `user sync`,
+reconcile и коллекторы без Xray и без сети:
+
+    with FakeXray(latency=0.005, error_rate=0.01) as xray:
+        run_bulk_sync(ops, address=xray.address)
+
+Тексты ошибок — как у настоящего Xray (proxy/vless/inbound), поэтому классификация
+"already exists"/"not found" в клиенте работает так же.
+"""
+
+import random
+import threading
+import time
+from concurrent import futures
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional, Tuple
+
+import grpc
+
+from app.core.xray_api.app.proxyman.command import command_pb2 as proxyman_command
+from app.core.xray_api.app.proxyman.command import command_pb2_grpc as proxyman_service
+from app.core.xray_api.app.stats.command import command_pb2 as stats_command
+from app.core.xray_api.app.stats.command import command_pb2_grpc as stats_service
+from app.core.xray_api.common.protocol import user_pb2
+from app.core.xray_api.common.serial.typed_message_pb2 import TypedMessage
+from app.core.xray_api.proxy.vless import account_pb2
+
+DEFAULT_TAGS = ("vless-vision", "vless-h2", "vless-h3")
+
+
+class FakeXray:
+    """Состояние узла + сервер. Все методы потокобезопасны (сервер многопоточный).
+
+    latency/jitter — секунды на любой вызов; method_latency — поверх них для отдельных
+    методов ({"QueryStats": 0.05}). error_rate — доля вызовов, падающих с error_code;
+    fail_next() — детерминированные сбои для тестов. traffic_rate — синтетический
+    трафик на юзера, байт/с: копится лениво, между вызовами, без фоновых потоков.
+    """
+
+    def __init__(
+        self,
+        tags: Iterable[str] = DEFAULT_TAGS,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        method_latency: Optional[Dict[str, float]] = None,
+        error_rate: float = 0.0,
+        error_code: grpc.StatusCode = grpc.StatusCode.UNAVAILABLE,
+        traffic_rate: float = 0.0,
+        seed: Optional[int] = None,
+        max_workers: int = 256,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.method_latency = method_latency or {}
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.traffic_rate = traffic_rate
+        self.max_workers = max_workers
+
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        # tag -> {email: uuid}
+        self.users: Dict[str, Dict[str, str]] = {tag: {} for tag in tags}
+        self.counters: Dict[str, int] = {}
+        # Вес юзера в синтетическом трафике: у кого-то больше, у кого-то меньше
+        self.weights: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        # Одновременных вызовов сейчас и пик — проверка лимита in-flight у клиента
+        self.active = 0
+        self.peak = 0
+        self.injected = 0
+        self.num_gc = 0
+        self._failures: Dict[str, list] = {}
+        self._started = time.monotonic()
+        self._accrued_at = time.monotonic()
+        self._server: Optional[grpc.Server] = None
+        self.address = ""
+
+    # --- Жизненный цикл ---
+
+    def start(self, host: str = "127.0.0.1") -> str:
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=self.max_workers))
+        proxyman_service.add_HandlerServiceServicer_to_server(_Handler(self), server)
+        stats_service.add_StatsServiceServicer_to_server(_Stats(self), server)
+        port = server.add_insecure_port(f"{host}:0")
+        server.start()
+        self._server = server
+        self.address = f"{host}:{port}"
+        return self.address
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop(None)
+            self._server = None
+
+    def __enter__(self) -> "FakeXray":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # --- Управление из теста/бенчмарка ---
+
+    def fail_next(self, method: str, times: int = 1, code: Optional[grpc.StatusCode] = None):
+        """Следующие `times` вызовов метода падают с code (по умолчанию error_code)"""
+        with self.lock:
+            self._failures.setdefault(method, []).extend([code or self.error_code] * times)
+
+    def seed_users(self, users: Iterable[Tuple[str, str]], tags: Optional[Iterable[str]] = None):
+        """Юзеры, которые уже есть в инбаундах (например, устаревшие — для reconcile)"""
+        users = list(users)
+        with self.lock:
+            for tag in tags or list(self.users):
+                for email, user_uuid in users:
+                    self.users[tag][email] = user_uuid
+
+    def add_traffic(self, email: str, uplink: int = 0, downlink: int = 0, tag: str = ""):
+        with self.lock:
+            self._bump(email, tag or next(iter(self.users)), uplink, downlink)
+
+    def emails(self) -> set:
+        with self.lock:
+            return {email for users in self.users.values() for email in users}
+
+    # --- Внутреннее ---
+
+    def _bump(self, email: str, tag: str, uplink: int, downlink: int):
+        for name, value in (
+            (f"user>>>{email}>>>traffic>>>uplink", uplink),
+            (f"user>>>{email}>>>traffic>>>downlink", downlink),
+            (f"inbound>>>{tag}>>>traffic>>>uplink", uplink),
+            (f"inbound>>>{tag}>>>traffic>>>downlink", downlink),
+        ):
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def _accrue(self):
+        """Синтетический трафик за время с прошлого вызова (под self.lock)"""
+        now = time.monotonic()
+        elapsed, self._accrued_at = now - self._accrued_at, now
+        if not self.traffic_rate or elapsed <= 0:
+            return
+        for tag, users in self.users.items():
+            for email in users:
+                weight = self.weights.setdefault(email, self.random.uniform(0.1, 2.0))
+                volume = self.traffic_rate * weight * elapsed / len(self.users)
+                # Типичный профиль: скачивают в разы больше, чем отдают
+                self._bump(email, tag, int(volume * 0.1), int(volume * 0.9))
+
+    @contextmanager
+    def _serving(self, method: str, context: grpc.ServicerContext):
+        """Обертка обработчика: учет одновременных вызовов + задержка и инъекция ошибок"""
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            self._enter(method, context)
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def _enter(self, method: str, context: grpc.ServicerContext):
+        """Задержка и инъекция ошибок перед любой обработкой"""
+        delay = self.latency + self.method_latency.get(method, 0.0)
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.jitter:
+                delay += self.random.uniform(0, self.jitter)
+            queued = self._failures.get(method)
+            code = queued.pop(0) if queued else None
+            if code is None and self.error_rate and self.random.random() < self.error_rate:
+                code = self.error_code
+            if code is not None:
+                self.injected += 1
+        if delay > 0:
+            time.sleep(delay)
+        if code is not None:
+            context.abort(code, f"fake xray: injected {code.name}")
+
+
+class _Handler(proxyman_service.HandlerServiceServicer):
+    def __init__(self, xray: FakeXray):
+        self.xray = xray
+
+    def _inbound(self, tag: str, context) -> Dict[str, str]:
+        users = self.xray.users.get(tag)
+        if users is None:
+            context.abort(grpc.StatusCode.UNKNOWN, f"handler not found: {tag}")
+        return users
+
+    def AlterInbound(self, request, context):  # noqa: N802 — имя из proto
+        with self.xray._serving("AlterInbound", context):
+            with self.xray.lock:
+                users = self._inbound(request.tag, context)
+                if request.operation.type.endswith("AddUserOperation"):
+                    op = proxyman_command.AddUserOperation.FromString(request.operation.value)
+                    if op.user.email in users:
+                        context.abort(
+                            grpc.StatusCode.UNKNOWN, f"User {op.user.email} already exists."
+                        )
+                    account = account_pb2.Account.FromString(op.user.account.value)
+                    users[op.user.email] = account.id
+                elif request.operation.type.endswith("RemoveUserOperation"):
+                    op = proxyman_command.RemoveUserOperation.FromString(request.operation.value)
+                    if op.email not in users:
+                        context.abort(grpc.StatusCode.UNKNOWN, f"User {op.email} not found.")
+                    del users[op.email]
+                else:
+                    context.abort(grpc.StatusCode.UNIMPLEMENTED, request.operation.type)
+            return proxyman_command.AlterInboundResponse()
+
+    def GetInboundUsers(self, request, context):  # noqa: N802 — имя из proto
+        with self.xray._serving("GetInboundUsers", context):
+            with self.xray.lock:
+                users = dict(self._inbound(request.tag, context))
+            if request.email:
+                users = {request.email: users[request.email]} if request.email in users else {}
+            return proxyman_command.GetInboundUserResponse(
+                users=[
+                    user_pb2.User(
+                        email=email,
+                        account=TypedMessage(
+                            type="xray.proxy.vless.Account",
+                            value=account_pb2.Account(id=user_uuid).SerializeToString(),
+                        ),
+                    )
+                    for email, user_uuid in users.items()
+                ]
+            )
+
+    def GetInboundUsersCount(self, request, context):  # noqa: N802 — имя из proto
+        with self.xray._serving("GetInboundUsersCount", context):
+            with self.xray.lock:
+                count = len(self._inbound(request.tag, context))
+            return proxyman_command.GetInboundUsersCountResponse(count=count)
+
+
+class _Stats(stats_service.StatsServiceServicer):
+    def __init__(self, xray: FakeXray):
+        self.xray = xray
+
+    def QueryStats(self, request, context):  # noqa: N802 — имя из proto
+        with self.xray._serving("QueryStats", context):
+            with self.xray.lock:
+                self.xray._accrue()
+                # Как в Xray без regexp: отбор по подстроке имени счетчика
+                stat = [
+                    stats_command.Stat(name=name, value=value)
+                    for name, value in self.xray.counters.items()
+                    if request.pattern in name
+                ]
+                if request.reset:
+                    for item in stat:
+                        self.xray.counters[item.name] = 0
+            return stats_command.QueryStatsResponse(stat=stat)
+
+    def GetSysStats(self, request, context):  # noqa: N802 — имя из proto
+        with self.xray._serving("GetSysStats", context):
+            with self.xray.lock:
+                users = sum(len(u) for u in self.xray.users.values())
+                counters = len(self.xray.counters)
+                self.xray.num_gc += 1
+                num_gc = self.xray.num_gc
+            # Грубая модель рантайма Go: база + память на юзера и на счетчик
+            alloc = 8 * 1024**2 + users * 4096 + counters * 256
+            return stats_command.SysStatsResponse(
+                NumGoroutine=20 + users // 100,
+                NumGC=num_gc,
+                Alloc=alloc,
+                TotalAlloc=alloc * (num_gc + 1),
+                Sys=alloc * 2,
+                LiveObjects=users * 12 + counters,
+                PauseTotalNs=num_gc * 150_000,
+                Uptime=int(time.monotonic() - self.xray._started),
+            )
@@ -0,0 +1,499 @@
+"""Нагрузочный бенчмарк раздачи подписок (/v1/sub/{uuid} и /papers).
+
+Сидирует SQLite заданным числом юзеров и маршрутов, гоняет запросы через httpx
+ASGITransport (in-process) и через настоящий uvicorn, пишет p50/p99, RPS и RSS в JSON.
+
+    python make.py bench --users 100,1000,10000,50000 --routes 10,100,1000,5000
+    python make.py bench compare output/bench/old.json output/bench/new.json
+
+ВНИМАНИЕ: сидирование пересоздает таблицы. Запускать только на отдельной базе —
+make.py подставляет DATABASE_URL=BENCH_DATABASE_URL сам.
+"""
+
+import asyncio
+import ipaddress
+import json
+import os
+import platform
+import resource
+import secrets
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+import typer
+from rich.console import Console
+from rich.table import Table
+from sqlalchemy import insert
+from sqlmodel import SQLModel
+
+from app.core.config import settings
+from app.core.database import async_engine, engine, init_db
+from app.core.metrics import metrics
+from app.core.models import Route, User
+
+BENCH_DATABASE_URL = "sqlite:///./output/bench/bench.db"
+RESULTS_DIR = Path("output/bench")
+
+# Юзеры сидируются в 10.64.0.0/10 — до 4M адресов, с запасом на любой масштаб
+_SEED_NET = ipaddress.ip_network("10.64.0.0/10")
+# Каждый 50-й юзер забанен: промахи индекса тоже попадают в выборку
+_BANNED_EVERY = 50
+_ROUTE_KINDS = (
+    lambda i: {"pattern": f"domain:site{i}.example", "policy": "proxy"},
+    lambda i: {"pattern": f"geosite:category-{i}", "policy": "direct"},
+    lambda i: {"pattern": str(ipaddress.ip_address(0x5DB80000 + i)), "policy": "direct"},
+    lambda i: {"network": "udp", "port": f"{1024 + i % 60000}", "policy": "proxy"},
+    lambda i: {"pattern": f"keyword:kw{i}", "policy": "proxy", "process_name": f"app{i}.exe"},
+)
+
+# httpx по умолчанию шлет Accept-Encoding: gzip — сжатие меряет только сценарий sub_gzip
+CLIENT_HEADERS = {"Accept-Encoding": "identity"}
+
+cli = typer.Typer(help="Бенчмарк раздачи подписок")
+console = Console()
+
+
+@dataclass
+class BenchUser:
+    uuid: str
+    papers_token: str
+
+
+@dataclass
+class BenchResult:
+    transport: str  # asgi | uvicorn
+    scenario: str
+    users: int
+    routes: int
+    requests: int
+    concurrency: int
+    errors: int
+    p50_ms: float
+    p99_ms: float
+    mean_ms: float
+    rps: float
+    rss_mb: float
+
+
+# --- Сидирование ---
+
+
+def seed(users: int, routes: int) -> List[BenchUser]:
+    """Пересоздает таблицы и заливает их bulk-insert'ом (ORM на 50k строк — минуты)"""
+    SQLModel.metadata.drop_all(engine)
+    init_db()
+
+    user_rows = []
+    for i in range(users):
+        nickname = f"bench{i}"
+        user_rows.append(
+            {
+                "nickname": nickname,
+                "email": f"{nickname}@bench.mesh",
+                "uuid": str(uuid.UUID(int=i + 1)),
+                "internal_ip": str(_SEED_NET.network_address + i + 2),
+                "is_active": i % _BANNED_EVERY != _BANNED_EVERY - 1,
+                "dns_name": f"{nickname}.{settings.MESH_DOMAIN}",
+                "papers_token": secrets.token_hex(64),
+            }
+        )
+    route_rows = [_ROUTE_KINDS[i % len(_ROUTE_KINDS)](i) for i in range(routes)]
+    for row in route_rows:
+        row.setdefault("pattern", None)
+
+    with engine.begin() as conn:
+        if user_rows:
+            conn.execute(insert(User), user_rows)
+        if route_rows:
+            conn.execute(insert(Route), route_rows)
+
+    return [BenchUser(row["uuid"], row["papers_token"]) for row in user_rows if row["is_active"]]
+
+
+# --- Измерения ---
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _rss_kb(pid: int) -> int:
+    """VmRSS процесса из /proc (Linux). 0 — если /proc недоступен"""
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid: int) -> List[int]:
+    try:
+        tasks = Path(f"/proc/{pid}/task").iterdir()
+        found = []
+        for task in tasks:
+            found.extend(int(c) for c in (task / "children").read_text().split())
+        return found
+    except OSError:
+        return []
+
+
+def rss_mb(pid: Optional[int] = None) -> float:
+    """RSS процесса (и его воркеров) в MB. Без /proc — пиковый RSS текущего процесса"""
+    if pid is None:
+        kb = _rss_kb(os.getpid())
+        if not kb:
+            kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return kb / 1024
+    pids = [pid]
+    for p in pids:
+        pids.extend(_children(p))
+    return sum(_rss_kb(p) for p in pids) / 1024
+
+
+async def drive(
+    client: httpx.AsyncClient,
+    make_request: Callable[[int], Dict[str, Any]],
+    requests: int,
+    concurrency: int,
+    ok_status: int = 200,
+) -> Dict[str, Any]:
+    """Гоняет `requests` запросов в `concurrency` потоков, возвращает латентности и RPS"""
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            spec = make_request(i)
+            started = time.perf_counter()
+            try:
+                response = await client.get(spec["url"], headers=spec.get("headers"))
+                if response.status_code != ok_status:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "errors": errors,
+        "p50_ms": round(_percentile(latencies, 0.50), 3),
+        "p99_ms": round(_percentile(latencies, 0.99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+async def run_scenarios(
+    client: httpx.AsyncClient,
+    users: List[BenchUser],
+    requests: int,
+    concurrency: int,
+) -> Dict[str, Dict[str, Any]]:
+    """Сценарии опроса подписки. Прогрев (холодная сборка снапшота) в замер не входит"""
+    if not users:
+        return {}
+
+    def sub_url(i: int) -> str:
+        return f"/v1/sub/{users[i % len(users)].uuid}"
+
+    await client.get(sub_url(0))
+
+    # ETag'и для сценария 304: клиенты опрашивают подписку по таймеру
+    etags = {}
+    for i in range(min(requests, len(users))):
+        response = await client.get(sub_url(i))
+        etags[users[i].uuid] = response.headers.get("etag", "")
+
+    def revalidate(i: int) -> Dict[str, Any]:
+        user = users[i % len(etags)]
+        return {"url": f"/v1/sub/{user.uuid}", "headers": {"If-None-Match": etags[user.uuid]}}
+
+    # name -> (запрос по номеру, ожидаемый статус)
+    scenarios: Dict[str, Any] = {
+        "sub_json": (lambda i: {"url": sub_url(i)}, 200),
+        "sub_gzip": (lambda i: {"url": sub_url(i), "headers": {"Accept-Encoding": "gzip"}}, 200),
+        "sub_clash": (lambda i: {"url": f"{sub_url(i)}?format=clash"}, 200),
+        "sub_304": (revalidate, 304),
+        "sub_unknown": (lambda i: {"url": f"/v1/sub/{uuid.UUID(int=2**64 + i)}"}, 404),
+    }
+
+    results = {}
+    for name, (make_request, ok_status) in scenarios.items():
+        stats = await drive(client, make_request, requests, concurrency, ok_status)
+        results[name] = {**stats, "requests": requests}
+
+    # /papers сжигает токен на каждом заходе — каждый юзер участвует один раз
+    papers_requests = min(requests, len(users))
+    stats = await drive(
+        client,
+        lambda i: {"url": f"/v1/sub/{users[i].uuid}/papers?pls={users[i].papers_token}"},
+        papers_requests,
+        concurrency,
+    )
+    results["papers"] = {**stats, "requests": papers_requests}
+    return results
+
+
+# --- Транспорты ---
+
+
+async def bench_asgi(users: List[BenchUser], requests: int, concurrency: int):
+    from app.api.main import app, body_cache
+    from app.utils.mesh_snapshot import mesh_cache
+
+    # Новая база — новый epoch, но TTL версии и старые сжатые тела сбрасываем явно
+    mesh_cache.invalidate()
+    body_cache.clear()
+    metrics.reset()
+
+    # Исключения приложения считаем ошибками (500), как их увидел бы клиент uvicorn
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    try:
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", headers=CLIENT_HEADERS
+        ) as client:
+            results = await run_scenarios(client, users, requests, concurrency)
+        return results, rss_mb()
+    finally:
+        # Пул aiosqlite привязан к event loop этого прогона, а каждый масштаб — свой asyncio.run
+        await async_engine.dispose()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def bench_uvicorn(users: List[BenchUser], requests: int, concurrency: int, workers: int):
+    port = _free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "app.api.main:app",
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+            "--no-access-log",
+        ],
+        env={**os.environ, "DATABASE_URL": settings.DATABASE_URL},
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(
+            base_url=base_url, limits=limits, timeout=30, headers=CLIENT_HEADERS
+        ) as client:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    await client.get("/metrics")
+                    break
+                except httpx.TransportError:
+                    if server.poll() is not None or time.monotonic() > deadline:
+                        raise RuntimeError("uvicorn did not start") from None
+                    await asyncio.sleep(0.1)
+
+            results = await run_scenarios(client, users, requests, concurrency)
+        return results, rss_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+
+# --- Отчет ---
+
+
+def _scales(users: str, routes: str) -> List[tuple]:
+    user_counts = [int(x) for x in users.split(",")]
+    route_counts = [int(x) for x in routes.split(",")]
+    if len(route_counts) == 1:
+        route_counts *= len(user_counts)
+    if len(route_counts) != len(user_counts):
+        raise typer.BadParameter("--routes: одно значение или столько же, сколько --users")
+    return list(zip(user_counts, route_counts))
+
+
+def _git_commit() -> Optional[str]:
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=False
+    )
+    return result.stdout.strip() or None
+
+
+def build_report(results: List[BenchResult]) -> Dict[str, Any]:
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": [asdict(r) for r in results],
+    }
+
+
+def print_results(results: List[BenchResult]):
+    table = Table(title="Subscription benchmark")
+    for column in ("transport", "scenario", "users", "routes", "p50 ms", "p99 ms", "rps"):
+        table.add_column(column, justify="right" if column[0] in "urp" else "left")
+    table.add_column("rss MB", justify="right")
+    table.add_column("err", justify="right")
+    for r in results:
+        table.add_row(
+            r.transport,
+            r.scenario,
+            str(r.users),
+            str(r.routes),
+            f"{r.p50_ms:.2f}",
+            f"{r.p99_ms:.2f}",
+            f"{r.rps:.0f}",
+            f"{r.rss_mb:.0f}",
+            f"[red]{r.errors}[/red]" if r.errors else "0",
+        )
+    console.print(table)
+
+
+def compare_reports(old: Dict[str, Any], new: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Дельты p50/p99/RPS по совпадающим (transport, scenario, users, routes)"""
+
+    def key(r):
+        return (r["transport"], r["scenario"], r["users"], r["routes"])
+
+    baseline = {key(r): r for r in old["results"]}
+    rows = []
+    for r in new["results"]:
+        before = baseline.get(key(r))
+        if not before:
+            continue
+        row = dict(zip(("transport", "scenario", "users", "routes"), key(r)))
+        for metric in ("p50_ms", "p99_ms", "rps", "rss_mb"):
+            row[metric] = (before[metric], r[metric])
+        rows.append(row)
+    return rows
+
+
+def _delta(before: float, after: float, lower_is_better: bool = True) -> str:
+    if not before:
+        return f"{after:.2f}"
+    change = (after - before) / before * 100
+    worse = change > 0 if lower_is_better else change < 0
+    color = "red" if worse and abs(change) >= 5 else "green" if abs(change) >= 5 else "dim"
+    return f"{after:.2f} [{color}]({change:+.0f}%)[/{color}]"
+
+
+@cli.command()
+def run(
+    users: str = typer.Option("100,1000,10000,50000", help="Число юзеров, через запятую"),
+    routes: str = typer.Option("10,100,1000,5000", help="Число маршрутов (в пару к --users)"),
+    requests: int = typer.Option(2000, help="Запросов на сценарий"),
+    concurrency: int = typer.Option(32, help="Параллельных клиентов"),
+    transport: str = typer.Option("asgi,uvicorn", help="asgi, uvicorn или оба"),
+    workers: int = typer.Option(1, help="Воркеров uvicorn"),
+    out: Optional[Path] = typer.Option(None, help="Файл результатов (JSON)"),
+):
+    """🏎️ Прогнать бенчмарк и сохранить результаты в JSON"""
+    if "bench" not in settings.DATABASE_URL:
+        console.print(
+            f"[red]❌ Бенчмарк пересоздает таблицы. Запустите с "
+            f"DATABASE_URL={BENCH_DATABASE_URL} (make.py bench делает это сам).[/red]"
+        )
+        raise typer.Exit(code=1)
+
+    transports = [t.strip() for t in transport.split(",") if t.strip()]
+    results: List[BenchResult] = []
+
+    for user_count, route_count in _scales(users, routes):
+        for name in transports:
+            # Свежая база на каждый транспорт: /papers сжигает токены предыдущего прогона
+            started = time.perf_counter()
+            bench_users = seed(user_count, route_count)
+            console.print(
+                f"[cyan]🌱 {name}: {user_count} юзеров / {route_count} маршрутов "
+                f"({(time.perf_counter() - started) * 1000:.0f} ms)[/cyan]"
+            )
+
+            if name == "asgi":
+                scenario_results, rss = asyncio.run(bench_asgi(bench_users, requests, concurrency))
+            elif name == "uvicorn":
+                scenario_results, rss = asyncio.run(
+                    bench_uvicorn(bench_users, requests, concurrency, workers)
+                )
+            else:
+                raise typer.BadParameter(f"Неизвестный транспорт: {name}")
+
+            for scenario, stats in scenario_results.items():
+                results.append(
+                    BenchResult(
+                        transport=name,
+                        scenario=scenario,
+                        users=user_count,
+                        routes=route_count,
+                        concurrency=concurrency,
+                        rss_mb=round(rss, 1),
+                        **stats,
+                    )
+                )
+
+    print_results(results)
+
+    report = build_report(results)
+    if out is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        out = RESULTS_DIR / f"bench-{stamp}-{report['meta']['commit'] or 'nogit'}.json"
+    out.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    console.print(f"[bold green]✅ Результаты: {out}[/bold green]")
+
+
+@cli.command()
+def compare(old: Path, new: Path):
+    """📊 Сравнить два прогона (p50/p99/RPS/RSS)"""
+    rows = compare_reports(
+        json.loads(old.read_text(encoding="utf-8")), json.loads(new.read_text(encoding="utf-8"))
+    )
+    table = Table(title=f"{old.name} → {new.name}")
+    for column in ("transport", "scenario", "users", "routes", "p50 ms", "p99 ms", "rps", "rss"):
+        table.add_column(column)
+    for row in rows:
+        table.add_row(
+            row["transport"],
+            row["scenario"],
+            str(row["users"]),
+            str(row["routes"]),
+            _delta(*row["p50_ms"]),
+            _delta(*row["p99_ms"]),
+            _delta(*row["rps"], lower_is_better=False),
+            _delta(*row["rss_mb"]),
+        )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    cli()
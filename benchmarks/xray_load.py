@@ -0,0 +1,226 @@
+"""Бенчмарк путей к Xray API на FakeXray: без Xray, без сети, с заданным RTT до узла.
+
+Сценарии:
+    bulk_sync   — user sync: N юзеров x теги через aio-канал с окном in-flight
+    reconcile   — БД vs живое состояние (часть юзеров устарела, часть отсутствует)
+    stats_user  — QueryStats по одному юзеру (pattern) против всей таблицы (stats_full)
+    collect     — один тик TrafficCollector: drain + GetSysStats + запись в SQLite
+
+    python make.py bench-xray --users 100,1000,10000 --latency 0,0.005,0.05
+
+База — SQLite в памяти на каждый масштаб: боевую и bench.db не трогает.
+"""
+
+import json
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, List, Optional
+
+import typer
+from rich.console import Console
+from rich.table import Table
+from sqlalchemy import insert
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine
+
+from app.core.config import settings
+from app.core.grpc_client import AzenordXrayControl, user_stats_pattern
+from app.core.models import User
+from app.utils.bulk_sync import add_ops, run_bulk_sync
+from app.utils.reconcile import run_reconcile
+from app.utils.traffic_collector import TrafficCollector
+from benchmarks.fake_xray import DEFAULT_TAGS, FakeXray
+from benchmarks.sub_load import RESULTS_DIR, _percentile, build_report
+
+cli = typer.Typer(help="Бенчмарк Xray API на FakeXray")
+console = Console()
+
+# Доля юзеров, которых reconcile должен добавить, и число «чужих» юзеров на узле
+_RECONCILE_MISSING = 0.1
+_RECONCILE_STALE = 0.05
+
+
+@dataclass
+class XrayBenchResult:
+    scenario: str
+    users: int
+    latency_ms: float
+    ops: int
+    errors: int
+    elapsed_ms: float
+    p50_ms: float
+    p99_ms: float
+    rate: float  # операций (RPC или юзеров) в секунду
+
+
+def _emails(users: int) -> List[tuple]:
+    return [(f"bench{i}@bench.mesh", f"00000000-0000-0000-0000-{i:012d}") for i in range(users)]
+
+
+def _memory_session_factory(users: List[tuple]) -> Callable[[], Session]:
+    """Отдельная SQLite в памяти: StaticPool — одно соединение на все сессии"""
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as conn:
+        if users:
+            conn.execute(
+                insert(User),
+                [
+                    {
+                        "nickname": email.split("@")[0],
+                        "dns_name": f"{email.split('@')[0]}.{settings.MESH_DOMAIN}",
+                        "email": email,
+                        "uuid": user_uuid,
+                        "internal_ip": f"10.{64 + i // 65536}.{i // 256 % 256}.{i % 256}",
+                    }
+                    for i, (email, user_uuid) in enumerate(users)
+                ],
+            )
+    return lambda: Session(engine)
+
+
+def _timed(fn: Callable[[], Any], repeat: int) -> List[float]:
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return sorted(latencies)
+
+
+def _result(scenario: str, users: int, latency: float, ops: int, errors: int, samples: List[float]):
+    elapsed = sum(samples)
+    return XrayBenchResult(
+        scenario=scenario,
+        users=users,
+        latency_ms=latency * 1000,
+        ops=ops,
+        errors=errors,
+        elapsed_ms=round(elapsed, 3),
+        p50_ms=round(_percentile(samples, 0.50), 3),
+        p99_ms=round(_percentile(samples, 0.99), 3),
+        rate=round(ops / elapsed * 1000, 1) if elapsed else 0.0,
+    )
+
+
+def bench_scale(
+    users: int, latency: float, inflight: int, repeat: int, error_rate: float
+) -> List[XrayBenchResult]:
+    tags = list(DEFAULT_TAGS)
+    people = _emails(users)
+    results = []
+
+    with FakeXray(tags, latency=latency, error_rate=error_rate, seed=1) as xray:
+        # --- bulk_sync: пустой узел -> все юзеры во всех тегах ---
+        ops = add_ops(people, tags)
+        report = run_bulk_sync(ops, address=xray.address, inflight=inflight)
+        results.append(
+            _result(
+                "bulk_sync", users, latency, len(ops), len(report.failed), [report.elapsed * 1000]
+            )
+        )
+
+        # --- reconcile: часть юзеров выпала, на узле есть чужие ---
+        missing = people[: int(users * _RECONCILE_MISSING)]
+        for tag in tags:
+            for email, _ in missing:
+                xray.users[tag].pop(email, None)
+        xray.seed_users(
+            [(f"stale{i}@bench.mesh", f"s{i}") for i in range(int(users * _RECONCILE_STALE))]
+        )
+        session_factory = _memory_session_factory(people)
+        with session_factory() as session:
+            started = time.perf_counter()
+            reconciled = run_reconcile(session, tags, address=xray.address, inflight=inflight)
+            elapsed = (time.perf_counter() - started) * 1000
+        changed = len(reconciled.plan.to_add) + len(reconciled.plan.to_remove)
+        results.append(
+            _result("reconcile", users, latency, changed, int(not reconciled.ok), [elapsed])
+        )
+
+        # --- Счетчики: немного трафика каждому юзеру ---
+        for i, (email, _) in enumerate(people):
+            xray.add_traffic(email, uplink=i + 1, downlink=10 * (i + 1), tag=tags[i % len(tags)])
+
+        client = AzenordXrayControl(address=xray.address)
+        try:
+            probe = people[len(people) // 2][0] if people else "nobody@bench.mesh"
+            for scenario, call in (
+                ("stats_user", lambda: client.query_stats(user_stats_pattern(probe), max_age=0)),
+                ("stats_full", lambda: client.query_stats("", max_age=0)),
+            ):
+                samples = _timed(call, repeat)
+                results.append(_result(scenario, users, latency, repeat, 0, samples))
+        finally:
+            client.channel.close()
+
+        # --- collect: один тик коллектора на свежих приращениях ---
+        collector = TrafficCollector(session_factory, address=xray.address)
+        try:
+            samples = []
+            for _ in range(repeat):
+                for email, _ in people[:: max(1, users // 100)]:
+                    xray.add_traffic(email, downlink=1)
+                samples.extend(_timed(collector.collect_once, 1))
+        finally:
+            collector.close()
+        results.append(_result("collect", users, latency, repeat, 0, sorted(samples)))
+
+    return results
+
+
+def print_results(results: List[XrayBenchResult]):
+    table = Table(title="Xray API benchmark (FakeXray)")
+    for column in ("scenario", "users", "rtt ms", "ops", "p50 ms", "p99 ms", "ops/s", "err"):
+        table.add_column(column, justify="left" if column == "scenario" else "right")
+    for r in results:
+        table.add_row(
+            r.scenario,
+            str(r.users),
+            f"{r.latency_ms:g}",
+            str(r.ops),
+            f"{r.p50_ms:.2f}",
+            f"{r.p99_ms:.2f}",
+            f"{r.rate:.0f}",
+            f"[red]{r.errors}[/red]" if r.errors else "0",
+        )
+    console.print(table)
+
+
+@cli.command()
+def run(
+    users: str = typer.Option("100,1000,10000", help="Число юзеров, через запятую"),
+    latency: str = typer.Option("0,0.005,0.05", help="RTT до узла в секундах, через запятую"),
+    inflight: int = typer.Option(64, help="Окно in-flight для sync/reconcile"),
+    repeat: int = typer.Option(20, help="Повторов для stats/collect"),
+    error_rate: float = typer.Option(0.0, help="Доля RPC, падающих с UNAVAILABLE"),
+    out: Optional[Path] = typer.Option(None, help="Файл результатов (JSON)"),
+):
+    """🏎️ Прогнать сценарии Xray API и сохранить результаты в JSON"""
+    results: List[XrayBenchResult] = []
+    for rtt in [float(x) for x in latency.split(",")]:
+        for user_count in [int(x) for x in users.split(",")]:
+            started = time.perf_counter()
+            results.extend(bench_scale(user_count, rtt, inflight, repeat, error_rate))
+            console.print(
+                f"[cyan]⏱️ {user_count} юзеров, RTT {rtt * 1000:g} ms "
+                f"({time.perf_counter() - started:.1f} s)[/cyan]"
+            )
+
+    print_results(results)
+
+    report = build_report([])
+    report["results"] = [asdict(r) for r in results]
+    if out is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        out = RESULTS_DIR / f"xray-{stamp}-{report['meta']['commit'] or 'nogit'}.json"
+    out.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    console.print(f"[bold green]✅ Результаты: {out}[/bold green]")
+
+
+if __name__ == "__main__":
+    cli()
@@ -166,6 +166,57 @@ def config():
         )
 
 
+@app.command()
+def export():
+    """📦 Статический экспорт подписок для nginx (output/sub)"""
+    from sqlmodel import Session
+
+    from app.core.database import engine
+    from app.utils.sub_export import export_subscriptions
+
+    with Session(engine) as session:
+        report = export_subscriptions(session)
+    console.print(
+        f"[bold green]✅ Подписок: {report.exported}, новых объектов: {report.written}, "
+        f"убрано: {report.removed}[/bold green] ({report.elapsed_ms:.0f} ms)"
+    )
+
+
+@app.command(context_settings={"allow_extra_args": True, "ignore_unknown_options": True})
+def bench(ctx: typer.Context):
+    """🏎️ Бенчмарк подписок на отдельной базе (output/bench). Аргументы -> benchmarks.sub_load"""
+    Path("output/bench").mkdir(parents=True, exist_ok=True)
+
+    env_vars = os.environ.copy()
+    env_vars["PYTHONPATH"] = os.getcwd()
+    # Сидирование пересоздает таблицы — боевую базу не трогаем
+    env_vars["DATABASE_URL"] = "sqlite:///./output/bench/bench.db"
+
+    args = ctx.args if ctx.args and ctx.args[0] in ("run", "compare") else ["run", *ctx.args]
+    result = subprocess.run(
+        [sys.executable, "-m", "benchmarks.sub_load", *args], env=env_vars, check=False
+    )
+    if result.returncode != 0:
+        sys.exit(result.returncode)
+
+
+@app.command(
+    name="bench-xray",
+    context_settings={"allow_extra_args": True, "ignore_unknown_options": True},
+)
+def bench_xray(ctx: typer.Context):
+    """🛰️ Бенчмарк Xray API на FakeXray (sync, reconcile, stats). -> benchmarks.xray_load"""
+    env_vars = os.environ.copy()
+    env_vars["PYTHONPATH"] = os.getcwd()
+
+    args = ctx.args if ctx.args and ctx.args[0] == "run" else ["run", *ctx.args]
+    result = subprocess.run(
+        [sys.executable, "-m", "benchmarks.xray_load", *args], env=env_vars, check=False
+    )
+    if result.returncode != 0:
+        sys.exit(result.returncode)
+
+
 @app.command()
 def init():
     """🐣 Первичная инициализация проекта (Папки, БД, Прото)"""
@@ -2,13 +2,46 @@ import pytest
 from sqlmodel import Session, SQLModel
 
 from app.core.database import engine, init_db
+from app.core.grpc_client import AlterResult
+from app.utils.mesh_snapshot import mesh_cache
+from benchmarks.fake_xray import FakeXray
 
 
 @pytest.fixture(name="session")
 def session_fixture():
     # Создаем таблицы перед каждым тестом
     init_db()
+    mesh_cache.invalidate()
     with Session(engine) as session:
         yield session
     # Чистим после себя (опционально)
     SQLModel.metadata.drop_all(engine)
+
+
+def _result(ok) -> AlterResult:
+    return AlterResult(True) if ok else AlterResult(False, "mocked failure")
+
+
+@pytest.fixture
+def wire_fanout():
+    """Мок xray: fan-out по тегам раскладывается в поштучные add_user/remove_user,
+    поэтому тесты по-прежнему видят по вызову на каждый транспорт"""
+
+    def wire(mocked):
+        mocked.add_user_to_tags.side_effect = lambda tags, email, user_uuid: {
+            tag: _result(mocked.add_user(tag, email, user_uuid)) for tag in tags
+        }
+        mocked.remove_user_from_tags.side_effect = lambda tags, email: {
+            tag: _result(mocked.remove_user(tag, email)) for tag in tags
+        }
+        return mocked
+
+    return wire
+
+
+@pytest.fixture
+def inbounds():
+    """FakeXray с тремя инбаундами: юзеры в памяти ({tag: {email: uuid}}), пик
+    одновременных вызовов — в .peak"""
+    with FakeXray(["vless-vision", "vless-h2", "vless-h3"], latency=0.002) as xray:
+        yield xray
@@ -2,7 +2,9 @@ import pytest
 from httpx import ASGITransport, AsyncClient
 from sqlmodel import Session
 
-from app.api.main import app
+from app.api.main import app, get_xray
+from app.core.models import Route, RoutePolicy, User
+from app.utils.mesh_snapshot import mesh_cache
 
 
 @pytest.mark.asyncio
@@ -13,3 +15,78 @@ async def test_api_health(session: Session):
 
     assert response.status_code == 404
     assert response.json()["detail"] == "Azenord: Invalid subscription"
+
+
+@pytest.mark.asyncio
+async def test_api_etag_not_modified(session: Session):
+    """Повторный опрос с тем же ETag получает 304 без тела"""
+    session.add(User(nickname="neo", email="n@a.pro", uuid="etag-uuid", internal_ip="10.0.8.2"))
+    session.commit()
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        first = await ac.get("/v1/sub/etag-uuid")
+        etag = first.headers["etag"]
+
+        cached = await ac.get("/v1/sub/etag-uuid", headers={"If-None-Match": etag})
+
+        session.add(Route(pattern="domain:new.com", policy=RoutePolicy.proxy))
+        session.commit()
+        mesh_cache.expire()
+        changed = await ac.get("/v1/sub/etag-uuid", headers={"If-None-Match": etag})
+
+    assert first.status_code == 200
+    assert cached.status_code == 304
+    assert cached.content == b""
+    assert cached.headers["etag"] == etag
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+
+
+@pytest.mark.asyncio
+async def test_api_papers_token_rotation(session: Session):
+    """Papers: токен одноразовый — после просмотра старая ссылка дает 403"""
+    user = User(nickname="neo", email="n@a.pro", uuid="papers-uuid", internal_ip="10.0.8.2")
+    session.add(user)
+    session.commit()
+    token = user.papers_token
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        first = await ac.get(f"/v1/sub/papers-uuid/papers?pls={token}")
+        reused = await ac.get(f"/v1/sub/papers-uuid/papers?pls={token}")
+
+    session.refresh(user)
+    assert first.status_code == 200
+    assert "neo" in first.text
+    assert reused.status_code == 403
+    assert user.papers_token != token
+
+
+class _StubXray:
+    def __init__(self):
+        self.emails = []
+
+    async def get_user_traffic(self, email):
+        self.emails.append(email)
+        return 7, 42
+
+
+@pytest.mark.asyncio
+async def test_api_user_stats_scoped_to_one_user(session: Session):
+    session.add(User(nickname="neo", email="n@a.pro", uuid="stats-uuid", internal_ip="10.0.8.2"))
+    session.commit()
+
+    stub = _StubXray()
+    app.dependency_overrides[get_xray] = lambda: stub
+    try:
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://test") as ac:
+            found = await ac.get("/stats/users/stats-uuid")
+            missing = await ac.get("/stats/users/nope")
+    finally:
+        app.dependency_overrides.clear()
+
+    assert found.json() == {"email": "n@a.pro", "uplink": 7, "downlink": 42}
+    assert missing.status_code == 404
+    assert stub.emails == ["n@a.pro"]
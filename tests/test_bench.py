@@ -0,0 +1,31 @@
+import pytest
+from sqlmodel import Session, select
+
+from app.core.models import Route, User
+from benchmarks.sub_load import BenchResult, bench_asgi, build_report, compare_reports, seed
+
+
+@pytest.mark.asyncio
+async def test_bench_smoke(session: Session):
+    """Бенчмарк не гниет: сид, все сценарии без ошибок, отчет сравнивается сам с собой"""
+    users = seed(60, 12)
+    assert len(session.exec(select(User)).all()) == 60
+    assert len(session.exec(select(Route)).all()) == 12
+    assert len(users) == 59  # каждый 50-й забанен
+
+    results, rss = await bench_asgi(users, requests=20, concurrency=4)
+
+    assert set(results) == {"sub_json", "sub_gzip", "sub_clash", "sub_304", "sub_unknown", "papers"}
+    assert all(stats["errors"] == 0 for stats in results.values())
+    assert results["sub_json"]["p99_ms"] >= results["sub_json"]["p50_ms"] > 0
+    assert rss > 0
+
+    report = build_report(
+        [
+            BenchResult("asgi", name, 60, 12, concurrency=4, rss_mb=rss, **stats)
+            for name, stats in results.items()
+        ]
+    )
+    rows = compare_reports(report, report)
+    assert len(rows) == len(results)
+    assert rows[0]["p50_ms"][0] == rows[0]["p50_ms"][1]
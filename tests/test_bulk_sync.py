@@ -0,0 +1,142 @@
+from unittest.mock import patch
+
+from sqlmodel import Session
+from typer.testing import CliRunner
+
+from app.cli.__main__ import app
+from app.core.config import settings
+from app.core.models import User
+from app.utils.bulk_sync import add_ops, remove_ops, run_bulk_sync
+from app.utils.reconcile import run_reconcile
+from benchmarks.fake_xray import FakeXray
+
+runner = CliRunner()
+
+
+def test_bulk_push_bounded_and_idempotent(inbounds):
+    """Заливка с лимитом in-flight; повторная заливка — 'already exists' как успех"""
+    users = [(f"u{i}@a.pro", f"uuid-{i}") for i in range(200)]
+    ops = add_ops(users, inbounds.users)
+
+    first = run_bulk_sync(ops, address=inbounds.address, inflight=16)
+    assert first.ok
+    assert first.applied == 600
+    assert all(len(emails) == 200 for emails in inbounds.users.values())
+    assert 1 < inbounds.peak <= 16
+
+    again = run_bulk_sync(ops, address=inbounds.address, inflight=16)
+    assert again.ok
+    assert again.unchanged == 600
+
+    strict = run_bulk_sync(ops[:3], address=inbounds.address, exist_ok=False)
+    assert len(strict.failed) == 3
+
+
+def test_bulk_remove_reports_per_op_errors(inbounds):
+    """remove отсутствующего — не ошибка; неверный тег — ошибка с текстом от Xray"""
+    inbounds.seed_users([("gone@a.pro", "g1")], tags=["vless-h2"])
+    report = run_bulk_sync(
+        remove_ops(["gone@a.pro"], ["vless-vision", "vless-h2", "vless-bogus"]),
+        address=inbounds.address,
+    )
+
+    assert report.applied == 1
+    assert report.unchanged == 1
+    assert [(op.tag, error) for op, error in report.failed] == [
+        ("vless-bogus", "handler not found: vless-bogus")
+    ]
+    assert report.by_tag["vless-h2"]["applied"] == 1
+
+
+def test_cli_sync_pushes_only_active_users(session: Session, inbounds, monkeypatch):
+    """`user sync`: активные юзеры во все теги, сводка вместо строки на каждый вызов"""
+    monkeypatch.setattr(settings, "XRAY_GRPC_ADDR", inbounds.address)
+    session.add(User(nickname="neo", email="n@a.pro", uuid="s1", internal_ip="10.0.8.2"))
+    session.add(
+        User(nickname="cy", email="c@a.pro", uuid="s2", internal_ip="10.0.8.3", is_active=False)
+    )
+    session.commit()
+
+    with patch("app.cli.commands.user.xray") as mocked:
+        mocked.check_connection.return_value = True
+        result = runner.invoke(app, ["user", "sync"])
+
+    assert result.exit_code == 0, result.stdout
+    assert "Full sync complete" in result.stdout
+    assert all(set(emails) == {"n@a.pro"} for emails in inbounds.users.values())
+
+
+def _drift(inbounds, session: Session):
+    """БД: neo (активен), cy (забанен), trin (UUID перевыпущен). Xray: рассинхрон"""
+    session.add(User(nickname="neo", email="n@a.pro", uuid="s1", internal_ip="10.0.8.2"))
+    session.add(
+        User(nickname="cy", email="c@a.pro", uuid="s2", internal_ip="10.0.8.3", is_active=False)
+    )
+    session.add(User(nickname="trin", email="t@a.pro", uuid="s3-new", internal_ip="10.0.8.4"))
+    session.commit()
+
+    inbounds.seed_users([("c@a.pro", "s2"), ("t@a.pro", "s3-old"), ("x@a.pro", "s9")])
+
+
+def test_reconcile_dry_run_plans_minimal_diff(session: Session, inbounds):
+    _drift(inbounds, session)
+    tags = list(inbounds.users)
+
+    result = run_reconcile(session, tags, address=inbounds.address, dry_run=True)
+    plan = result.plan
+
+    assert sorted(op.email for op in plan.to_add if op.tag == "vless-h2") == ["n@a.pro", "t@a.pro"]
+    assert sorted(op.email for op in plan.to_remove if op.tag == "vless-h2") == [
+        "c@a.pro",
+        "t@a.pro",
+        "x@a.pro",
+    ]
+    assert plan.live_counts["vless-h2"] == 3
+    assert plan.desired_counts["vless-h2"] == 2
+    assert set(result.timings) == {"db", "fetch", "diff"}
+    # dry run ничего не трогает
+    assert set(inbounds.users["vless-h2"]) == {"c@a.pro", "t@a.pro", "x@a.pro"}
+
+
+def test_reconcile_applies_and_converges(session: Session, inbounds):
+    _drift(inbounds, session)
+    tags = list(inbounds.users)
+
+    result = run_reconcile(session, tags, address=inbounds.address)
+
+    assert result.ok
+    assert set(result.timings) == {"db", "fetch", "diff", "remove", "add"}
+    for tag in tags:
+        assert set(inbounds.users[tag]) == {"n@a.pro", "t@a.pro"}
+        assert inbounds.users[tag]["t@a.pro"] == "s3-new"
+
+    again = run_reconcile(session, tags, address=inbounds.address)
+    assert again.plan.in_sync
+    assert again.added is None
+
+
+def test_cli_reconcile_dry_run(session: Session, inbounds, monkeypatch):
+    monkeypatch.setattr(settings, "XRAY_GRPC_ADDR", inbounds.address)
+    _drift(inbounds, session)
+
+    with patch("app.cli.commands.user.xray") as mocked:
+        mocked.check_connection.return_value = True
+        result = runner.invoke(app, ["user", "reconcile", "--dry-run"])
+
+    assert result.exit_code == 0, result.stdout
+    assert "Dry run: 6 adds, 9 removes pending" in result.stdout
+    assert set(inbounds.users["vless-vision"]) == {"c@a.pro", "t@a.pro", "x@a.pro"}
+
+
+def test_cli_reconcile_reports_unknown_tag(session: Session, monkeypatch):
+    with FakeXray(["vless-vision"]) as xray:
+        monkeypatch.setattr(settings, "XRAY_GRPC_ADDR", xray.address)
+        with patch("app.cli.commands.user.xray") as mocked:
+            mocked.check_connection.return_value = True
+            result = runner.invoke(app, ["user", "reconcile", "--dry-run"])
+
+    # Вместо трейсбека — тег и ответ Xray (vless-h2 и vless-h3 падают параллельно)
+    assert result.exit_code == 1
+    assert isinstance(result.exception, SystemExit)
+    assert "GetInboundUsers failed for vless-h" in result.stdout
+    assert "handler not found" in result.stdout
@@ -0,0 +1,60 @@
+import pytest
+import yaml
+from httpx import ASGITransport, AsyncClient
+from sqlmodel import Session
+
+from app.api.main import app
+from app.core.config import settings
+from app.core.models import Route, RoutePolicy, User
+from app.utils.clash_factory import MESH_GROUP, ClashFactory
+from app.utils.mesh_snapshot import MeshSnapshot
+from app.utils.routing_factory import RoutingFactory
+
+
+def test_clash_rules_from_xray_rules():
+    """Правила Xray конвертируются в строки Clash, составные — через AND"""
+    routes = [
+        Route(pattern="domain:google.com", policy=RoutePolicy.proxy),
+        Route(pattern="1.1.1.1", policy=RoutePolicy.direct),
+        Route(policy=RoutePolicy.direct, network="udp", port="50000-65535"),
+    ]
+    rules = ClashFactory.build_rules(RoutingFactory.build_rules(routes))
+
+    assert rules[0] == f"DOMAIN-SUFFIX,{settings.MESH_DOMAIN},{MESH_GROUP}"
+    assert f"DOMAIN-SUFFIX,google.com,{MESH_GROUP}" in rules
+    assert "IP-CIDR,1.1.1.1/32,no-resolve,DIRECT" in rules
+    assert "AND,((NETWORK,udp),(DST-PORT,50000-65535)),DIRECT" in rules
+    assert rules[-1] == "MATCH,DIRECT"
+
+
+def test_clash_template_is_built_once_per_snapshot():
+    """yaml.dump выполняется один раз на версию меша"""
+    user = User(nickname="neo", email="n@a.pro", uuid="clash-uuid", internal_ip="10.0.8.2")
+    snapshot = MeshSnapshot.build("v1", [user], [])
+
+    assert snapshot.clash_template is snapshot.clash_template
+    config = yaml.safe_load(snapshot.render("clash-uuid", "n@a.pro", "clash"))
+    assert {p["uuid"] for p in config["proxies"]} == {"clash-uuid"}
+    assert config["email"] == "n@a.pro"
+
+
+@pytest.mark.asyncio
+async def test_api_format_negotiation(session: Session):
+    """?format=clash и User-Agent Clash-клиента дают YAML, по умолчанию — JSON"""
+    session.add(User(nickname="neo", email="n@a.pro", uuid="fmt-uuid", internal_ip="10.0.8.2"))
+    session.commit()
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        by_query = await ac.get("/v1/sub/fmt-uuid?format=clash")
+        by_agent = await ac.get("/v1/sub/fmt-uuid", headers={"User-Agent": "mihomo/1.18"})
+        default = await ac.get("/v1/sub/fmt-uuid")
+        unknown = await ac.get("/v1/sub/fmt-uuid?format=toml")
+
+    assert by_query.headers["content-type"].startswith("text/yaml")
+    assert by_agent.content == by_query.content
+    assert by_query.headers["etag"] != default.headers["etag"]
+    config = yaml.safe_load(by_query.text)
+    assert f"neo.{settings.MESH_DOMAIN}" in config["dns"]["hosts"]
+    assert default.json()["email"] == "n@a.pro"
+    assert unknown.status_code == 400
@@ -19,7 +19,14 @@ def mock_xray_mesh():
 
 def test_mesh_status_online(session, mock_xray_mesh):  # Added session
     """Тест: Статус системы, когда Xray доступен"""
-    mock_xray_mesh.check_connection.return_value = True
+    mock_xray_mesh.get_sys_stats.return_value = {
+        "uptime": 90_061,
+        "goroutines": 42,
+        "alloc": 64 * 1024**2,
+        "sys": 128 * 1024**2,
+        "num_gc": 7,
+        "pause_total_ns": 3_500_000,
+    }
 
     # Убеждаемся, что база инициализирована (через фикстуру session)
     result = runner.invoke(app, ["mesh", "status"], color=False)
@@ -27,11 +34,13 @@ def test_mesh_status_online(session, mock_xray_mesh):  # Added session
     assert result.exit_code == 0
     assert "ONLINE" in result.stdout
     assert "Database: OK" in result.stdout
+    assert "1d 01h 01m" in result.stdout
+    assert "heap: 64.0 MB" in result.stdout
 
 
 def test_mesh_status_offline(mock_xray_mesh):
     """Тест: Статус системы, когда gRPC упал"""
-    mock_xray_mesh.check_connection.return_value = False
+    mock_xray_mesh.get_sys_stats.return_value = None
 
     result = runner.invoke(app, ["mesh", "status"])
 
@@ -39,12 +48,12 @@ def test_mesh_status_offline(mock_xray_mesh):
     assert "OFFLINE" in result.stdout
 
 
-def test_mesh_stats_calculation(mock_xray_mesh):
+def test_mesh_stats_calculation(session, mock_xray_mesh):
     """Тест: Расчет суммарного трафика всей сети"""
     # Имитируем ответ от StatsService
-    mock_xray_mesh.get_traffic_stats.return_value = {
-        "user>>>neo@a.pro>>>traffic>>>downlink": 1073741824,  # 1 GB
-        "user>>>trinity@a.pro>>>traffic>>>uplink": 536870912,  # 0.5 GB
+    mock_xray_mesh.get_inbound_traffic.return_value = {
+        "inbound>>>vless-vision>>>traffic>>>downlink": 1073741824,  # 1 GB
+        "inbound>>>vless-h2>>>traffic>>>uplink": 536870912,  # 0.5 GB
         "inbound>>>api>>>traffic>>>downlink": 1024,  # Служебный трафик
     }
 
@@ -89,3 +98,15 @@ def test_mesh_scan_logic(session):
         # Проверяем, что сканируются только АКТИВНЫЕ юзеры
         assert "smith" not in result.stdout
         assert mocked_ping.called
+
+
+def test_mesh_pools_utilization(session):
+    from app.utils.ipam import allocate_ips
+
+    allocate_ips(session, 5)
+
+    result = runner.invoke(app, ["mesh", "pools"], color=False)
+
+    assert result.exit_code == 0, result.stdout
+    assert "10.0.8.0/24" in result.stdout
+    assert "2.0%" in result.stdout  # 5 из 253
@@ -62,3 +62,12 @@ def test_sub_link_banned_warning(session, test_resident):
 
     assert result.exit_code == 0
     assert "Внимание: Пользователь neo заблокирован" in result.stdout
+
+
+def test_sub_export_command(session, test_resident, tmp_path):
+    """Test: `sub export` writes one link per active resident"""
+    result = runner.invoke(app, ["sub", "export", "--out", str(tmp_path)])
+
+    assert result.exit_code == 0
+    assert "Экспортировано: 1" in result.stdout
+    assert (tmp_path / f"{test_resident.uuid}.json").exists()
@@ -11,13 +11,13 @@ runner = CliRunner()
 
 
 @pytest.fixture
-def mock_xray_user():
+def mock_xray_user(wire_fanout):
     """Фикстура для патчинга gRPC клиента в модуле user"""
     with patch("app.cli.commands.user.xray") as mocked:
         mocked.check_connection.return_value = True
         mocked.add_user.return_value = True
         mocked.remove_user.return_value = True
-        yield mocked
+        yield wire_fanout(mocked)
 
 
 def test_user_add_full_cycle(session, mock_xray_user):
@@ -61,15 +61,15 @@ def test_user_info_with_stats(session, mock_xray_user):
     session.commit()
 
     # Имитируем данные статистики от Xray
-    mock_xray_user.get_traffic_stats.return_value = {
-        "user>>>t@a.pro>>>traffic>>>downlink": 104857600  # 100 MB
-    }
+    mock_xray_user.get_user_traffic.return_value = (0, 104857600)  # (up, down): 100 MB
 
     result = runner.invoke(app, ["user", "info", "trinity"])
 
     assert result.exit_code == 0
     assert "100.00 MB" in result.stdout
     assert "10.0.8.3" in result.stdout
+    mock_xray_user.get_user_traffic.assert_called_once_with("t@a.pro")
+    mock_xray_user.get_traffic_stats.assert_not_called()
 
 
 def test_user_ban_unban_logic(session, mock_xray_user):
@@ -0,0 +1,63 @@
+import gzip
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlmodel import Session
+
+from app.api.main import app, body_cache
+from app.core.models import User
+from app.utils.compression import CompressedBodyCache, negotiate_encoding
+
+
+def test_negotiate_encoding_respects_q_values():
+    """Выбор кодировки по Accept-Encoding"""
+    assert negotiate_encoding(None) == "identity"
+    assert negotiate_encoding("identity") == "identity"
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("gzip;q=0") == "identity"
+    assert negotiate_encoding("*") in ("gzip", "br")
+
+
+def test_body_cache_drops_old_versions():
+    """Смена версии меша вычищает старые тела, LRU ограничивает суммарный размер в байтах"""
+    cache = CompressedBodyCache(max_bytes=4)
+    cache.put("v1", "a", "gzip", b"11")
+    cache.put("v1", "b", "gzip", b"2")
+    cache.put("v1", "c", "gzip", b"3")
+    assert cache.get("v1", "b", "gzip") == b"2"
+    cache.put("v1", "d", "gzip", b"44")
+    assert cache.get("v1", "a", "gzip") is None
+    assert (len(cache), cache.size) == (3, 4)
+
+    # Тело больше всего лимита не кэшируется и не выталкивает остальные
+    cache.put("v1", "e", "gzip", b"55555")
+    assert (len(cache), cache.size) == (3, 4)
+
+    cache.put("v2", "a", "gzip", b"4")
+    assert cache.get("v1", "b", "gzip") is None
+    assert cache.get("v2", "a", "gzip") == b"4"
+    assert cache.size == 1
+
+
+@pytest.mark.asyncio
+async def test_api_serves_cached_gzip(session: Session):
+    """Gzip-тело сжимается один раз и дальше берется из кэша"""
+    session.add(User(nickname="neo", email="n@a.pro", uuid="gz-uuid", internal_ip="10.0.8.2"))
+    session.commit()
+    body_cache.clear()
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        plain = await ac.get("/v1/sub/gz-uuid", headers={"Accept-Encoding": "identity"})
+        first = await ac.get("/v1/sub/gz-uuid", headers={"Accept-Encoding": "gzip"})
+        second = await ac.get("/v1/sub/gz-uuid", headers={"Accept-Encoding": "gzip"})
+
+    assert "content-encoding" not in plain.headers
+    assert first.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in first.headers["vary"]
+    assert first.json() == plain.json()
+    assert second.content == first.content
+    assert len(body_cache) == 1
+
+    (cached,) = body_cache._entries.values()
+    assert gzip.decompress(cached) == plain.content
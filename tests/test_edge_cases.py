@@ -149,10 +149,11 @@ async def test_api_route_priority_order(session: Session):
     assert rules[0]["outboundTag"] == settings.DEFAULT_MESH_OUTBOUND.value
 
 
-def test_cli_add_user_partial_grpc_failure(session):
+def test_cli_add_user_partial_grpc_failure(session, wire_fanout):
     """Edge Case: Откат (Rollback) при частичном сбое gRPC (например, 2 из 3 Ок)"""
 
     with patch("app.cli.commands.user.xray") as mocked_xray:
+        wire_fanout(mocked_xray)
         mocked_xray.check_connection.return_value = True
         # 1-й транспорт Ок, 2-й падает
         mocked_xray.add_user.side_effect = [True, False, True]
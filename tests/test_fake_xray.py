@@ -0,0 +1,165 @@
+import asyncio
+import time
+import uuid
+
+import grpc
+import pytest
+from sqlmodel import Session, select
+
+from app.core.database import engine
+from app.core.grpc_client import (
+    AzenordXrayAsyncControl,
+    AzenordXrayControl,
+    build_remove_user_request,
+    is_not_found,
+)
+from app.core.models import TrafficSample, User
+from app.utils.bulk_sync import add_ops, run_bulk_sync
+from app.utils.reconcile import run_reconcile
+from app.utils.traffic_collector import TrafficCollector, traffic_totals
+from benchmarks.fake_xray import FakeXray
+
+
+@pytest.fixture
+def fake():
+    with FakeXray(seed=7) as xray:
+        yield xray
+
+
+def test_user_lifecycle_offline(fake):
+    """То же, что test_integration_xray, но без живого Xray"""
+    client = AzenordXrayControl(address=fake.address)
+    email, user_uuid = f"test-{uuid.uuid4().hex[:6]}@a.pro", str(uuid.uuid4())
+
+    assert client.check_connection() is True
+    assert client.add_user("vless-h2", email, user_uuid) is True
+    assert fake.users["vless-h2"] == {email: user_uuid}
+    assert client.add_user("vless-h2", email, user_uuid) is False  # already exists
+    assert client.remove_user("vless-h2", email) is True
+    assert client.add_user("vless-main", email, user_uuid) is False  # handler not found
+    client.channel.close()
+
+
+def test_stats_and_runtime_offline(fake):
+    fake.seed_users([("n@a.pro", "u1")])
+    fake.add_traffic("n@a.pro", uplink=10, downlink=90, tag="vless-h2")
+    client = AzenordXrayControl(address=fake.address, retry=False)
+
+    assert client.get_user_traffic("n@a.pro") == (10, 90)
+    assert client.get_inbound_traffic()["inbound>>>vless-h2>>>traffic>>>downlink"] == 90
+    drained = client.drain_stats("user>>>")
+    assert drained["user>>>n@a.pro>>>traffic>>>downlink"] == 90
+    assert client.query_stats("user>>>", max_age=0)["user>>>n@a.pro>>>traffic>>>downlink"] == 0
+
+    runtime = client.get_sys_stats()
+    assert runtime["goroutines"] >= 20 and runtime["alloc"] > 0
+    client.channel.close()
+
+
+def test_latency_and_error_injection():
+    with FakeXray(latency=0.05, seed=1) as xray:
+        xray.fail_next("AlterInbound", times=2)
+        report = run_bulk_sync(
+            add_ops([(f"u{i}@a.pro", f"id{i}") for i in range(10)], ["vless-h2"]),
+            address=xray.address,
+            inflight=10,
+        )
+
+        async def timed_fanout():
+            async with AzenordXrayAsyncControl(xray.address) as client:
+                loop = asyncio.get_running_loop()
+                started = loop.time()
+                results = await client.add_user_to_tags(xray.users, "fan@a.pro", "f1")
+                return results, loop.time() - started
+
+        results, elapsed = asyncio.run(timed_fanout())
+
+    # AlterInbound не ретраится: инъекция видна как отказ двух операций
+    assert len(report.failed) == 2
+    assert all("injected UNAVAILABLE" in error for _, error in report.failed)
+    assert report.applied == 8
+    # 10 операций по 50 ms при 10 in-flight — одна волна, а не 0.5 s
+    assert report.elapsed < 0.3
+    assert all(results.values())
+    assert elapsed < 0.15  # три тега параллельно, один RTT
+
+
+def test_sync_fanout_inside_running_loop():
+    """Синхронный fan-out не заводит свой event loop: работает и из async-кода (FastAPI)"""
+    with FakeXray(latency=0.05, seed=2) as xray:
+        client = AzenordXrayControl(address=xray.address)
+
+        async def from_handler():
+            started = time.perf_counter()
+            results = client.add_user_to_tags([*xray.users, "vless-bogus"], "f@a.pro", "f1")
+            return results, time.perf_counter() - started
+
+        results, elapsed = asyncio.run(from_handler())
+        removed = client.remove_user_from_tags(xray.users, "f@a.pro")
+        client.channel.close()
+
+    assert [tag for tag, result in results.items() if not result] == ["vless-bogus"]
+    assert results["vless-bogus"].error == "handler not found: vless-bogus"
+    assert all(removed.values())
+    assert elapsed < 0.15  # четыре тега параллельно, один RTT
+
+
+def test_error_rate_retried_for_idempotent_calls():
+    with FakeXray(error_rate=0.3, seed=3) as xray:
+        xray.add_traffic("n@a.pro", downlink=1)
+        client = AzenordXrayControl(address=xray.address)
+        results = [client.query_stats("user>>>", max_age=0) for _ in range(20)]
+        client.channel.close()
+
+    # UNAVAILABLE на QueryStats гасится retryPolicy канала: до клиента сбои не доходят
+    assert xray.injected > 0
+    assert all(result.get("user>>>n@a.pro>>>traffic>>>downlink") == 1 for result in results)
+    assert xray.calls["QueryStats"] == 20 + xray.injected
+
+
+def test_reconcile_and_collector_offline(session: Session):
+    session.add(User(nickname="neo", email="n@a.pro", uuid="s1", internal_ip="10.0.8.2"))
+    session.commit()
+
+    with FakeXray(traffic_rate=1_000_000, seed=5) as xray:
+        xray.seed_users([("ghost@a.pro", "g1")])
+        result = run_reconcile(session, list(xray.users), address=xray.address)
+        assert result.ok
+        assert xray.emails() == {"n@a.pro"}
+
+        collector = TrafficCollector(lambda: Session(engine), address=xray.address)
+        try:
+            collector.collect_once()
+            asyncio.run(asyncio.sleep(0.05))
+            collector.collect_once()
+        finally:
+            collector.close()
+
+    up, down = traffic_totals(session, "user")["n@a.pro"]
+    assert down > up > 0
+    assert session.exec(select(TrafficSample)).first() is not None
+
+
+def test_unknown_tag_is_real_error(fake):
+    client = AzenordXrayControl(address=fake.address)
+    with pytest.raises(grpc.RpcError) as error:
+        client.handler_stub.AlterInbound(build_remove_user_request("nope", "n@a.pro"))
+    client.channel.close()
+
+    assert not is_not_found(error.value)
+
+
+def test_xray_bench_smoke():
+    from benchmarks.xray_load import bench_scale
+
+    results = bench_scale(users=20, latency=0.0, inflight=8, repeat=2, error_rate=0.0)
+
+    assert [r.scenario for r in results] == [
+        "bulk_sync",
+        "reconcile",
+        "stats_user",
+        "stats_full",
+        "collect",
+    ]
+    assert all(r.errors == 0 for r in results)
+    assert results[0].ops == 60  # 20 юзеров x 3 тега
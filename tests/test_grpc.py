@@ -1,6 +1,17 @@
+import asyncio
+import time
+
+import grpc
 import pytest
 
-from app.core.grpc_client import AzenordXrayControl
+from app.core.config import settings
+from app.core.grpc_channel import is_idempotent
+from app.core.grpc_client import AzenordXrayAsyncControl, AzenordXrayControl
+from app.core.metrics import metrics
+from app.core.xray_api.app.proxyman.command import command_pb2 as proxyman_command
+from app.core.xray_api.app.proxyman.command import command_pb2_grpc as proxyman_service
+from app.core.xray_api.app.stats.command import command_pb2 as stats_command
+from app.core.xray_api.app.stats.command import command_pb2_grpc as stats_service
 
 
 @pytest.mark.integration  # Помечаем тест как интеграционный
@@ -11,3 +22,244 @@ async def test_xray_grpc_connection():
     is_alive = client.check_connection()
 
     assert is_alive is True, "Xray gRPC недоступен! Проверь порт 10085."
+
+
+class SlowHandler(proxyman_service.HandlerServiceServicer):
+    """AlterInbound с задержкой; тег "broken" отвечает ошибкой"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.tags = []
+
+    async def AlterInbound(self, request, context):  # noqa: N802 — имя из proto
+        self.tags.append(request.tag)
+        await asyncio.sleep(self.delay)
+        if request.tag == "broken":
+            await context.abort(grpc.StatusCode.NOT_FOUND, "handler not found")
+        return proxyman_command.AlterInboundResponse()
+
+
+@pytest.mark.asyncio
+async def test_async_client_fans_out_across_tags():
+    """Операции над юзером идут во все теги параллельно: ~1 RTT, результат по каждому тегу"""
+    handler = SlowHandler(delay=0.2)
+    server = grpc.aio.server()
+    proxyman_service.add_HandlerServiceServicer_to_server(handler, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    await server.start()
+
+    try:
+        async with AzenordXrayAsyncControl(f"127.0.0.1:{port}") as client:
+            tags = ["vless-vision", "vless-h2", "broken"]
+            started = time.perf_counter()
+            added = await client.add_user_to_tags(tags, "n@a.pro", "fan-uuid")
+            elapsed = time.perf_counter() - started
+
+            removed = await client.remove_user_from_tags(["vless-vision", "vless-h2"], "n@a.pro")
+    finally:
+        await server.stop(None)
+
+    assert {tag: bool(result) for tag, result in added.items()} == {
+        "vless-vision": True,
+        "vless-h2": True,
+        "broken": False,
+    }
+    assert added["broken"].error == "handler not found"
+    assert all(removed.values()) and list(removed) == ["vless-vision", "vless-h2"]
+    assert sorted(handler.tags[:3]) == sorted(tags)
+    # Последовательно было бы >= 0.6s
+    assert elapsed < 0.5
+
+
+class FlakyStats(stats_service.StatsServiceServicer):
+    """QueryStats: первые `failures` попыток — UNAVAILABLE, дальше — ответ через `delay`"""
+
+    def __init__(self, failures: int = 0, delay: float = 0.0):
+        self.failures = failures
+        self.delay = delay
+        self.attempts = 0
+        self.sys_probes = 0
+        self.patterns = []
+
+    async def GetSysStats(self, request, context):  # noqa: N802 — имя из proto
+        self.sys_probes += 1
+        await asyncio.sleep(self.delay)
+        return stats_command.SysStatsResponse(NumGoroutine=12, Uptime=3600)
+
+    async def QueryStats(self, request, context):  # noqa: N802 — имя из proto
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "xray restarting")
+        await asyncio.sleep(self.delay)
+        self.patterns.append(request.pattern)
+        counters = {
+            "user>>>n@a.pro>>>traffic>>>downlink": 42,
+            "user>>>t@a.pro>>>traffic>>>uplink": 7,
+            "inbound>>>vless-h2>>>traffic>>>downlink": 49,
+        }
+        return stats_command.QueryStatsResponse(
+            stat=[
+                stats_command.Stat(name=name, value=value)
+                for name, value in counters.items()
+                if request.pattern in name
+            ]
+        )
+
+
+async def _start_stats_server(servicer):
+    server = grpc.aio.server()
+    stats_service.add_StatsServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    await server.start()
+    return server, f"127.0.0.1:{port}"
+
+
+@pytest.mark.asyncio
+async def test_idempotent_calls_retried_on_unavailable():
+    """UNAVAILABLE на идемпотентном вызове повторяется по retryPolicy, до клиента не доходит"""
+    metrics.reset()
+    servicer = FlakyStats(failures=2)
+    server, address = await _start_stats_server(servicer)
+    try:
+        client = AzenordXrayControl(address=address)
+        stats = await asyncio.to_thread(client.get_traffic_stats)
+        client.channel.close()
+    finally:
+        await server.stop(None)
+
+    assert stats["user>>>n@a.pro>>>traffic>>>downlink"] == 42
+    assert servicer.attempts == 3
+    assert metrics.get("xray_grpc.retries") == 2
+    assert metrics.get("xray_grpc.retries.QueryStats") == 2
+    assert metrics.get("xray_grpc.calls") == 1
+    assert metrics.get("xray_grpc.errors") == 0
+
+
+@pytest.mark.asyncio
+async def test_aio_retries_counted_and_bounded(monkeypatch):
+    """aio-клиент повторяет так же; попыток не больше XRAY_GRPC_RETRY_ATTEMPTS"""
+    monkeypatch.setattr(settings, "XRAY_GRPC_RETRY_ATTEMPTS", 3)
+    metrics.reset()
+    servicer = FlakyStats(failures=5)
+    server, address = await _start_stats_server(servicer)
+    try:
+        async with AzenordXrayAsyncControl(address=address) as client:
+            stats = await client.query_stats("user>>>", max_age=0)
+        async with AzenordXrayAsyncControl(address=address, retry=False) as client:
+            await client.query_stats("user>>>", max_age=0)
+    finally:
+        await server.stop(None)
+
+    assert stats == {}
+    assert servicer.attempts == 3 + 1
+    assert metrics.get("xray_grpc.retries") == 2
+    assert metrics.get("xray_grpc.errors") == 2
+
+
+@pytest.mark.asyncio
+async def test_wedged_xray_hits_deadline(monkeypatch):
+    """Зависший Xray не вешает клиента: вызов обрывается по XRAY_GRPC_TIMEOUT"""
+    monkeypatch.setattr(settings, "XRAY_GRPC_TIMEOUT", 0.2)
+    metrics.reset()
+    server, address = await _start_stats_server(FlakyStats(delay=2))
+    try:
+        client = AzenordXrayControl(address=address)
+        started = time.perf_counter()
+        stats = await asyncio.to_thread(client.get_traffic_stats)
+        elapsed = time.perf_counter() - started
+        client.channel.close()
+    finally:
+        await server.stop(None)
+
+    assert stats == {}
+    assert elapsed < 1
+    assert metrics.get("xray_grpc.timeouts") == 1
+    assert metrics.get("xray_grpc.timeouts.QueryStats") == 1
+
+
+def test_only_idempotent_methods_are_retried():
+    """AlterInbound не повторяется: повторный add вернул бы already exists"""
+    assert is_idempotent("/xray.app.stats.command.StatsService/QueryStats")
+    assert is_idempotent("/xray.app.proxyman.command.HandlerService/GetInboundUsers")
+    assert not is_idempotent("/xray.app.proxyman.command.HandlerService/AlterInbound")
+
+
+@pytest.mark.asyncio
+async def test_health_probe_is_cheap_and_cached():
+    """Проба здоровья — GetSysStats (не дамп счетчиков) и кэшируется на XRAY_HEALTH_TTL"""
+    servicer = FlakyStats()
+    server, address = await _start_stats_server(servicer)
+    try:
+        client = AzenordXrayControl(address=address)
+        probes = [await asyncio.to_thread(client.check_connection) for _ in range(5)]
+        fresh = await asyncio.to_thread(client.check_connection, 0)
+        client.channel.close()
+    finally:
+        await server.stop(None)
+
+    assert probes == [True] * 5
+    assert fresh is True
+    assert servicer.sys_probes == 2
+    assert servicer.attempts == 0  # QueryStats не вызывался
+
+
+def test_health_probe_offline_is_cached_too(monkeypatch):
+    """Недоступный Xray тоже кэшируется: pre-flight в цикле не долбит мертвый адрес"""
+    monkeypatch.setattr(settings, "XRAY_GRPC_RETRY_ATTEMPTS", 1)
+    client = AzenordXrayControl(address="127.0.0.1:1")
+
+    assert client.check_connection() is False
+    started = time.perf_counter()
+    assert client.check_connection() is False
+    assert time.perf_counter() - started < 0.01
+    client.channel.close()
+
+
+@pytest.mark.asyncio
+async def test_pattern_scoped_stats_share_cache():
+    """Юзер — отдельный узкий запрос; ответ на широкий pattern обслуживает узкие из кэша"""
+    servicer = FlakyStats()
+    server, address = await _start_stats_server(servicer)
+    try:
+        client = AzenordXrayControl(address=address)
+        first = await asyncio.to_thread(client.get_user_traffic, "n@a.pro")
+        again = await asyncio.to_thread(client.get_user_traffic, "n@a.pro")
+        everything = await asyncio.to_thread(client.get_traffic_stats)
+        other = await asyncio.to_thread(client.get_user_traffic, "t@a.pro")
+        inbounds = await asyncio.to_thread(client.get_inbound_traffic)
+        client.channel.close()
+
+        # aio-клиент (API) видит тот же кэш
+        async with AzenordXrayAsyncControl(address) as aio_client:
+            shared = await aio_client.get_user_traffic("n@a.pro")
+    finally:
+        await server.stop(None)
+
+    assert first == again == shared == (0, 42)
+    assert other == (7, 0)
+    assert inbounds == {"inbound>>>vless-h2>>>traffic>>>downlink": 49}
+    assert len(everything) == 3
+    assert servicer.patterns == ["user>>>n@a.pro>>>", ""]
+
+
+@pytest.mark.asyncio
+async def test_sys_stats_exposed_and_count_as_probe():
+    servicer = FlakyStats()
+    server, address = await _start_stats_server(servicer)
+    try:
+        client = AzenordXrayControl(address=address)
+        runtime = await asyncio.to_thread(client.get_sys_stats)
+        alive = await asyncio.to_thread(client.check_connection)
+        client.channel.close()
+
+        async with AzenordXrayAsyncControl(address) as aio_client:
+            aio_runtime = await aio_client.get_sys_stats()
+    finally:
+        await server.stop(None)
+
+    assert runtime["goroutines"] == 12
+    assert runtime["uptime"] == 3600
+    assert aio_runtime == runtime
+    # check_connection взял результат последнего GetSysStats
+    assert alive is True
+    assert servicer.sys_probes == 2
@@ -1,8 +1,25 @@
+import ipaddress
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import pytest
-from sqlmodel import Session
+from jinja2 import Template
+from sqlmodel import Session, select
 
-from app.core.models import User
-from app.utils.ipam import get_next_free_ip
+from app.core.config import settings
+from app.core.database import engine
+from app.core.models import IpLease, IpPool, User
+from app.utils.ipam import (
+    allocate_ips,
+    cancel_ips,
+    confirm_ips,
+    get_next_free_ip,
+    pool_full,
+    pool_usage,
+    release_ips,
+    reserve_ips,
+)
 
 
 def test_ipam_sequential_assignment(session: Session):
@@ -44,3 +61,127 @@ def test_ipam_subnet_overflow(session: Session):
         get_next_free_ip(session)
 
     assert "Mesh subnet is full" in str(excinfo.value)
+
+
+def _commit_users(session: Session, ips):
+    """INSERT юзеров на зарезервированные адреса — как это делает `user add`"""
+    for ip in ips:
+        name = ip.replace(".", "-").replace(":", "-")
+        session.add(User(nickname=name, email=f"{name}@a.pro", internal_ip=ip, uuid=name))
+    confirm_ips(session, ips)
+    session.commit()
+
+
+def _pool(session: Session, subnet: str = "10.0.8.0/24") -> IpPool:
+    session.expire_all()
+    return session.get(IpPool, subnet)
+
+
+def test_ipam_index_tracks_own_changes_without_rebuild(session: Session):
+    _commit_users(session, allocate_ips(session, 3))
+    pool = _pool(session)
+    assert (pool.used, pool.synced_seq) == (3, pool.user_seq)
+    assert session.exec(select(IpLease)).all() == []
+
+    # Удаление через IPAM: индекс остается сверенным, дырка отдается первой
+    user = session.exec(select(User).where(User.internal_ip == "10.0.8.3")).one()
+    session.delete(user)
+    session.commit()
+    release_ips(["10.0.8.3"])
+    pool = _pool(session)
+    assert (pool.used, pool.synced_seq) == (2, pool.user_seq)
+
+    assert get_next_free_ip(session) == "10.0.8.3"
+
+
+def test_ipam_slash16_bulk_and_full(session: Session):
+    subnet = "10.1.0.0/16"
+    _commit_users(session, ["10.1.0.5"])
+
+    ips = allocate_ips(session, 300, subnet)
+    assert ips[:4] == ["10.1.0.2", "10.1.0.3", "10.1.0.4", "10.1.0.6"]
+    # .255 и .0 внутри /16 — обычные адреса, резерв только у сети, шлюза и broadcast
+    assert "10.1.0.255" in ips and "10.1.1.0" in ips
+    _commit_users(session, ips)
+
+    # Аренды без юзеров тоже занимают адреса: повторный резерв их не выдаст
+    rest = allocate_ips(session, 65533 - 301, subnet)
+    assert rest[-1] == "10.1.255.254"
+    with pytest.raises(ValueError, match="Mesh subnet is full"):
+        get_next_free_ip(session, subnet)
+
+
+def test_ipam_parallel_reservations_never_collide(session: Session):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        batches = list(pool.map(lambda _: reserve_ips(5), range(16)))
+
+    ips = [ip for batch in batches for ip in batch]
+    assert len(set(ips)) == 80
+    assert sorted(ips, key=ipaddress.ip_address)[-1] == "10.0.8.81"
+
+
+def test_ipam_cancel_and_expired_lease_return_address(session: Session):
+    first = get_next_free_ip(session)
+    assert get_next_free_ip(session) == "10.0.8.3"
+
+    cancel_ips([first])
+    assert get_next_free_ip(session) == first
+
+    # `user add` упал, не закрыв аренду: адрес вернется, когда она истечет
+    stale = reserve_ips(1, ttl=-1)[0]
+    assert stale == "10.0.8.4"
+    assert get_next_free_ip(session) == stale
+
+
+def test_ipam_retries_after_lease_conflict(session: Session):
+    get_next_free_ip(session)
+    # Аренда в обход индекса: резерв упрется в PK, пересоберет карту и возьмет следующий
+    session.add(IpLease(ip="10.0.8.3", subnet="10.0.8.0/24", expires_at=2**40))
+    session.commit()
+
+    assert get_next_free_ip(session) == "10.0.8.4"
+
+
+def test_ipam_with_session_bound_to_open_connection(session: Session):
+    """Сессия на Connection с открытой транзакцией: IPAM берет Engine, а не этот коннект"""
+    with engine.connect() as conn:
+        conn.begin()
+        bound = Session(bind=conn)
+        assert get_next_free_ip(bound) == "10.0.8.2"
+        assert get_next_free_ip(bound) == "10.0.8.3"
+        bound.close()
+
+
+def test_ipam_named_pools_with_ipv6_ula(session: Session, monkeypatch):
+    monkeypatch.setattr(settings, "MESH_POOLS", "main=10.0.8.0/24, v6=fd8a:2e00:8::/112")
+
+    for _ in range(3):
+        # Чередование пулов: каждый INSERT бампает user_seq обоих, но ни один не пересобирается
+        _commit_users(session, [get_next_free_ip(session), get_next_free_ip(session, "v6")])
+
+    main, v6 = _pool(session), _pool(session, "fd8a:2e00:8::/112")
+    assert (main.used, main.synced_seq) == (3, main.user_seq)
+    assert (v6.used, v6.synced_seq) == (3, v6.user_seq)
+    assert session.get(User, 6).internal_ip == "fd8a:2e00:8::4"
+
+    usage = {u.name: u for u in pool_usage(session)}
+    assert (usage["v6"].used, usage["v6"].capacity) == (3, 65534)
+    assert usage["main"].free == 250
+    assert not pool_full(session, "v6")
+
+    with pytest.raises(ValueError, match="Unknown mesh pool"):
+        get_next_free_ip(session, "nope")
+    with pytest.raises(ValueError, match="too large"):
+        get_next_free_ip(session, "fd00::/64")
+
+
+def test_xray_config_renders_mesh_pools(monkeypatch):
+    monkeypatch.setattr(settings, "MESH_POOLS", "main=10.0.8.0/22,v6=fd8a:2e00:8::/112")
+    template = Template(Path("app/templates/xray_config.json.j2").read_text(encoding="utf-8"))
+    config = json.loads(template.render(settings=settings))
+
+    assert config["dns"]["fakedns"] == [
+        {"ipPool": "10.0.8.0/22", "poolSize": 1024},
+        {"ipPool": "fd8a:2e00:8::/112", "poolSize": 65535},
+    ]
+    assert config["routing"]["rules"][-1]["ip"] == ["10.0.8.0/22", "fd8a:2e00:8::/112"]
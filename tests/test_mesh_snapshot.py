@@ -0,0 +1,182 @@
+import asyncio
+import json
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import event
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.api.main import app
+from app.core.database import async_engine
+from app.core.metrics import metrics
+from app.core.models import Route, RoutePolicy, User
+from app.utils.mesh_snapshot import MeshSnapshot, MeshSnapshotCache, mesh_cache, read_version
+
+
+def test_mesh_version_bumps_on_mesh_changes(session: Session):
+    """Триггеры бампают версию на User/Route, но не на ротацию papers_token"""
+    v0 = read_version(session)
+
+    user = User(nickname="neo", email="n@a.pro", uuid="u1", internal_ip="10.0.8.2")
+    session.add(user)
+    session.commit()
+    v1 = read_version(session)
+    assert v1 != v0
+
+    user.papers_token = "rotated"
+    session.add(user)
+    session.commit()
+    assert read_version(session) == v1
+
+    session.add(Route(pattern="domain:a.com", policy=RoutePolicy.direct))
+    session.commit()
+    assert read_version(session) != v1
+
+
+@pytest.mark.asyncio
+async def test_snapshot_reused_until_version_changes(session: Session):
+    """Снапшот пересобирается только при смене версии меша"""
+    cache = MeshSnapshotCache()
+    session.add(User(nickname="neo", email="n@a.pro", uuid="u1", internal_ip="10.0.8.2"))
+    session.commit()
+
+    async with AsyncSession(async_engine) as async_session:
+        first = await cache.get(async_session)
+        assert await cache.get(async_session) is first
+
+    session.add(User(nickname="trinity", email="t@a.pro", uuid="u2", internal_ip="10.0.8.3"))
+    session.commit()
+    cache.expire()  # как будто истек MESH_VERSION_TTL
+
+    async with AsyncSession(async_engine) as async_session:
+        second = await cache.get(async_session)
+
+    assert second is not first
+    assert len(second.dns_hosts) == 2
+
+
+@pytest.mark.asyncio
+async def test_api_sees_new_route_after_change(session: Session):
+    """API отдает новое правило сразу после изменения таблицы маршрутов"""
+    session.add(User(nickname="neo", email="n@a.pro", uuid="snap-uuid", internal_ip="10.0.8.2"))
+    session.commit()
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        before = (await ac.get("/v1/sub/snap-uuid")).json()
+
+        session.add(Route(pattern="domain:fresh.com", policy=RoutePolicy.proxy))
+        session.commit()
+        mesh_cache.expire()
+
+        after = (await ac.get("/v1/sub/snap-uuid")).json()
+
+    assert len(after["routing"]["rules"]) == len(before["routing"]["rules"]) + 1
+    assert after["routing"]["rules"][-1]["domain"] == "domain:fresh.com"
+
+
+def test_template_render_matches_full_config(session: Session):
+    """Байтовый шаблон дает ровно тот же JSON, что и сборка словаря целиком"""
+    user = User(nickname="neo", email='n"eo@a.pro', uuid="tmpl-uuid", internal_ip="10.0.8.2")
+    route = Route(pattern="domain:a.com", policy=RoutePolicy.proxy)
+    snapshot = MeshSnapshot.build("v1", [user], [route])
+
+    expected = MeshSnapshot.assemble(
+        user.uuid,
+        user.email,
+        snapshot.dns_hosts,
+        snapshot.routing_rules,
+        snapshot.standard_outbounds,
+    )
+    assert json.loads(snapshot.render(user.uuid, user.email)) == expected
+
+
+@pytest.mark.asyncio
+async def test_unknown_uuid_rejected_without_sqlite(session: Session):
+    """Мусорный UUID отсекается по индексу снапшота, без обращения к SQLite"""
+    session.add(User(nickname="neo", email="n@a.pro", uuid="idx-uuid", internal_ip="10.0.8.2"))
+    session.commit()
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        assert (await ac.get("/v1/sub/idx-uuid")).status_code == 200
+
+        event.listen(async_engine.sync_engine, "before_cursor_execute", count)
+        try:
+            garbage = await ac.get("/v1/sub/not-a-uuid-at-all")
+            papers = await ac.get("/v1/sub/not-a-uuid-at-all/papers?pls=x")
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", count)
+
+    assert garbage.status_code == 404
+    assert papers.status_code == 404
+    assert statements == []
+
+
+@pytest.mark.asyncio
+async def test_concurrent_rebuilds_are_coalesced(session: Session, monkeypatch):
+    """Single-flight: 10 конкурентных запросов новой версии — одна сборка снапшота"""
+    session.add(User(nickname="neo", email="n@a.pro", uuid="sf-uuid", internal_ip="10.0.8.2"))
+    session.commit()
+
+    cache = MeshSnapshotCache()
+    original_build = cache._build
+    builds = []
+
+    async def slow_build(async_session, version):
+        builds.append(version)
+        await asyncio.sleep(0.05)
+        return await original_build(async_session, version)
+
+    monkeypatch.setattr(cache, "_build", slow_build)
+    metrics.reset()
+
+    async def fetch():
+        async with AsyncSession(async_engine) as async_session:
+            return await cache.get(async_session)
+
+    snapshots = await asyncio.gather(*(fetch() for _ in range(10)))
+
+    assert len(builds) == 1
+    assert all(s is snapshots[0] for s in snapshots)
+    assert metrics.get("mesh_snapshot.builds") == 1
+    assert metrics.get("mesh_snapshot.coalesced") == 9
+    assert metrics.get("mesh_snapshot.last_build_coalesced") == 9
+
+
+@pytest.mark.asyncio
+async def test_cancelled_leader_does_not_fail_waiters(session: Session, monkeypatch):
+    """Запрос, начавший сборку, отменен — остальные все равно получают снапшот"""
+    session.add(User(nickname="neo", email="n@a.pro", uuid="sf-uuid", internal_ip="10.0.8.2"))
+    session.commit()
+
+    cache = MeshSnapshotCache()
+    original_build = cache._build
+
+    async def slow_build(async_session, version):
+        await asyncio.sleep(0.05)
+        return await original_build(async_session, version)
+
+    monkeypatch.setattr(cache, "_build", slow_build)
+
+    async def fetch():
+        async with AsyncSession(async_engine) as async_session:
+            return await cache.get(async_session)
+
+    leader = asyncio.create_task(fetch())
+    await asyncio.sleep(0.01)
+    waiters = [asyncio.create_task(fetch()) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    leader.cancel()
+
+    snapshots = await asyncio.gather(*waiters)
+
+    assert leader.cancelled()
+    assert all(s.active_emails == {"sf-uuid": "n@a.pro"} for s in snapshots)
+    assert cache._inflight == {}
@@ -0,0 +1,70 @@
+from unittest.mock import patch
+
+from typer.testing import CliRunner
+
+from app.cli.__main__ import app
+from app.core.models import User
+from app.utils.rates import RateEngine
+
+runner = CliRunner()
+
+
+def _stats(**down):
+    """{'n': 100} -> счетчики QueryStats для n@a.pro"""
+    return {f"user>>>{name}@a.pro>>>traffic>>>downlink": value for name, value in down.items()}
+
+
+def test_rates_from_cumulative_counters():
+    rates = RateEngine(window=3)
+
+    assert rates.sample(_stats(n=1000), now=0) is False
+    assert rates.top() == []
+
+    rates.sample(_stats(n=3000), now=2)  # 1000 B/s
+    row = rates.rate("n@a.pro")
+    assert (row.down, row.avg_down, row.up) == (1000, 1000, 0)
+
+    rates.sample(_stats(n=3000), now=4)  # простой
+    assert rates.rate("n@a.pro").down == 0
+    assert rates.rate("n@a.pro").avg_down == 500
+
+
+def test_ring_buffer_wraps_and_survives_reset():
+    rates = RateEngine(window=3)
+    rates.sample(_stats(n=0), now=0)
+    for t, counter in enumerate([100, 200, 300, 400, 500], start=1):
+        rates.sample(_stats(n=counter), now=t)
+
+    # Окно — последние 3 замера по 100 B/s; старые вытеснены
+    assert rates.rate("n@a.pro").avg_down == 100
+
+    # Коллектор сбросил счетчик: 500 -> 40 — это 40 байт, а не минус 460
+    rates.sample(_stats(n=40), now=6)
+    assert rates.rate("n@a.pro").down == 40
+
+
+def test_top_orders_by_current_rate():
+    rates = RateEngine(window=5)
+    rates.sample(_stats(a=0, b=0, c=0), now=0)
+    rates.sample(_stats(a=10, b=500, c=50), now=1)
+    # Юзер, появившийся позже, не ломает остальные слоты
+    rates.sample(_stats(a=20, b=500, c=5050, d=7), now=2)
+
+    assert [r.email for r in rates.top(2)] == ["c@a.pro", "a@a.pro"]
+    assert [r.email for r in rates.top(1, sort="avg")] == ["c@a.pro"]
+    assert len(rates) == 4
+    assert rates.rate("d@a.pro").down == 0
+
+
+def test_cli_mesh_top_live(session):
+    session.add(User(nickname="neo", email="n@a.pro", uuid="u1", internal_ip="10.0.8.2"))
+    session.commit()
+    samples = iter([_stats(n=0), _stats(n=1_000_000), _stats(n=3_000_000)])
+
+    with patch("app.cli.commands.mesh.xray") as mocked:
+        mocked.query_stats.side_effect = lambda *a, **kw: next(samples)
+        result = runner.invoke(app, ["mesh", "top", "--interval", "0", "--count", "2"])
+
+    assert result.exit_code == 0, result.stdout
+    assert "neo" in result.stdout
+    assert mocked.query_stats.call_count == 3
@@ -0,0 +1,77 @@
+import gzip
+import json
+
+from sqlmodel import Session
+
+from app.core.models import User
+from app.utils.sub_export import export_subscriptions
+
+
+def test_export_links_active_users_only(session: Session, tmp_path):
+    """Экспорт: ссылка на объект для каждого активного, забаненных нет"""
+    session.add_all(
+        [
+            User(nickname="neo", email="n@a.pro", uuid="exp-1", internal_ip="10.0.8.2"),
+            User(
+                nickname="smith",
+                email="s@a.pro",
+                uuid="exp-2",
+                internal_ip="10.0.8.3",
+                is_active=False,
+            ),
+        ]
+    )
+    session.commit()
+
+    report = export_subscriptions(session, tmp_path)
+
+    assert report.exported == 1
+    assert (tmp_path / "exp-1.json").is_symlink()
+    assert not (tmp_path / "exp-2.json").exists()
+
+    config = json.loads((tmp_path / "exp-1.json").read_bytes())
+    assert config["email"] == "n@a.pro"
+    assert (
+        gzip.decompress((tmp_path / "exp-1.json.gz").read_bytes())
+        == (tmp_path / "exp-1.json").read_bytes()
+    )
+
+
+def test_export_is_incremental_and_prunes(session: Session, tmp_path):
+    """Повторный экспорт без изменений ничего не пишет; бан убирает ссылку"""
+    neo = User(nickname="neo", email="n@a.pro", uuid="exp-1", internal_ip="10.0.8.2")
+    session.add(neo)
+    session.commit()
+
+    assert export_subscriptions(session, tmp_path).written == 1
+    assert export_subscriptions(session, tmp_path).written == 0
+
+    neo.is_active = False
+    session.add(neo)
+    session.commit()
+
+    report = export_subscriptions(session, tmp_path)
+    assert report.removed == 2  # .json и .json.gz
+    assert report.collected == 2
+    assert not (tmp_path / "exp-1.json").exists()
+
+
+def test_export_skips_render_when_template_unchanged(session: Session, tmp_path):
+    """Бан не меняет общую часть: тела остальных берутся из манифеста, без рендера"""
+    neo = User(nickname="neo", email="n@a.pro", uuid="exp-1", internal_ip="10.0.8.2")
+    trin = User(nickname="trin", email="t@a.pro", uuid="exp-2", internal_ip="10.0.8.3")
+    session.add_all([neo, trin])
+    session.commit()
+    assert export_subscriptions(session, tmp_path).rendered == 2
+
+    trin.is_active = False
+    session.add(trin)
+    session.commit()
+    report = export_subscriptions(session, tmp_path)
+    assert (report.rendered, report.exported, report.removed) == (0, 1, 2)
+    assert json.loads((tmp_path / "exp-1.json").read_bytes())["email"] == "n@a.pro"
+
+    # Новый хост в телефонной книге меняет шаблон — тела пересобираются
+    session.add(User(nickname="cy", email="c@a.pro", uuid="exp-3", internal_ip="10.0.8.4"))
+    session.commit()
+    assert export_subscriptions(session, tmp_path).rendered == 2
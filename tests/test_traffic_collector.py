@@ -0,0 +1,286 @@
+import threading
+import time
+from concurrent import futures
+
+import grpc
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, select
+from typer.testing import CliRunner
+
+from app.api.main import app as api
+from app.cli.__main__ import app
+from app.core.database import engine
+from app.core.metrics import metrics
+from app.core.models import TrafficSample, User, XraySysSample
+from app.core.xray_api.app.stats.command import command_pb2 as stats_command
+from app.core.xray_api.app.stats.command import command_pb2_grpc as stats_service
+from app.utils import traffic_collector
+from app.utils.sys_stats import sys_series
+from app.utils.traffic_collector import (
+    DAY,
+    HOUR,
+    TrafficCollector,
+    parse_counters,
+    rollup,
+    store_samples,
+    traffic_series,
+    traffic_totals,
+)
+
+runner = CliRunner()
+
+T0 = 1_700_000_000 // DAY * DAY  # полночь UTC
+
+
+class LiveCounters(stats_service.StatsServiceServicer):
+    """Счетчики Xray в памяти: QueryStats(reset=True) отдает и обнуляет"""
+
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.resets = 0
+
+    def add(self, name: str, value: int):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def QueryStats(self, request, context):  # noqa: N802 — имя из proto
+        with self.lock:
+            stat = [
+                stats_command.Stat(name=name, value=value)
+                for name, value in self.counters.items()
+                if request.pattern in name
+            ]
+            if request.reset:
+                self.resets += 1
+                for item in stat:
+                    self.counters[item.name] = 0
+        return stats_command.QueryStatsResponse(stat=stat)
+
+    def GetSysStats(self, request, context):  # noqa: N802 — имя из proto
+        return stats_command.SysStatsResponse(
+            NumGoroutine=30, Alloc=50 * 1024**2, Sys=90 * 1024**2, NumGC=4, Uptime=600
+        )
+
+
+@pytest.fixture
+def xray_stats():
+    servicer = LiveCounters()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    stats_service.add_StatsServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    servicer.address = f"127.0.0.1:{port}"
+    yield servicer
+    server.stop(None)
+
+
+def test_parse_counters_skips_api_and_zero():
+    deltas = parse_counters(
+        {
+            "user>>>n@a.pro>>>traffic>>>uplink": 10,
+            "user>>>n@a.pro>>>traffic>>>downlink": 20,
+            "user>>>idle@a.pro>>>traffic>>>downlink": 0,
+            "inbound>>>api>>>traffic>>>downlink": 99,
+            "inbound>>>vless-h2>>>traffic>>>downlink": 5,
+            "outbound>>>direct>>>traffic>>>downlink": 7,
+        }
+    )
+
+    assert deltas == {("user", "n@a.pro"): (10, 20), ("inbound", "vless-h2"): (0, 5)}
+
+
+def test_collector_appends_deltas_with_reset(session: Session, xray_stats):
+    collector = TrafficCollector(lambda: Session(engine), address=xray_stats.address)
+    try:
+        xray_stats.add("user>>>n@a.pro>>>traffic>>>downlink", 100)
+        xray_stats.add("inbound>>>vless-h2>>>traffic>>>downlink", 100)
+        collector.collect_once(now=T0 + 60)
+
+        xray_stats.add("user>>>n@a.pro>>>traffic>>>downlink", 30)
+        xray_stats.add("user>>>n@a.pro>>>traffic>>>uplink", 4)
+        second = collector.collect_once(now=T0 + 120)
+    finally:
+        collector.close()
+
+    assert second == {("user", "n@a.pro"): (4, 30)}
+    assert xray_stats.resets == 2
+    rows = session.exec(select(TrafficSample).where(TrafficSample.kind == "user")).all()
+    assert [(r.ts, r.uplink, r.downlink) for r in rows] == [(T0 + 60, 0, 100), (T0 + 120, 4, 30)]
+    assert traffic_totals(session, "user") == {"n@a.pro": (4, 130)}
+
+
+def test_collector_keeps_deltas_when_sqlite_is_locked(session: Session, xray_stats, monkeypatch):
+    """Запись не прошла — обнуленные Xray приращения не теряются, а уходят следующим тиком;
+    падение хука на историю не влияет"""
+    hooked = []
+
+    def hook(hook_session, deltas, ts):
+        hooked.append(deltas)
+        raise RuntimeError("quota hook failed")
+
+    def locked(*args, **kwargs):
+        raise OperationalError("INSERT trafficsample", {}, Exception("database is locked"))
+
+    collector = TrafficCollector(
+        lambda: Session(engine), address=xray_stats.address, on_deltas=hook, sample_sys=False
+    )
+    metrics.reset()
+    try:
+        xray_stats.add("user>>>n@a.pro>>>traffic>>>downlink", 100)
+        with monkeypatch.context() as m:
+            m.setattr(traffic_collector, "store_samples", locked)
+            with pytest.raises(OperationalError):
+                collector.collect_once(now=T0 + 60)
+
+        xray_stats.add("user>>>n@a.pro>>>traffic>>>downlink", 30)
+        collector.collect_once(now=T0 + 120)
+        assert collector.collect_once(now=T0 + 180) == {}
+    finally:
+        collector.close()
+
+    assert xray_stats.resets == 3
+    assert traffic_totals(session, "user") == {"n@a.pro": (0, 130)}
+    assert hooked[0] == {("user", "n@a.pro"): (0, 130)}
+    assert metrics.get("traffic_collector.hook_errors") == 2
+
+
+def test_run_forever_survives_non_grpc_errors(monkeypatch):
+    class StopLoopError(Exception):
+        pass
+
+    collector = TrafficCollector(lambda: Session(engine), address="127.0.0.1:1")
+    ticks = []
+
+    def tick():
+        ticks.append(1)
+        raise OperationalError("INSERT trafficsample", {}, Exception("database is locked"))
+
+    def sleep(seconds):
+        if len(ticks) == 2:
+            raise StopLoopError
+
+    monkeypatch.setattr(collector, "collect_once", tick)
+    monkeypatch.setattr(traffic_collector.time, "sleep", sleep)
+    metrics.reset()
+    try:
+        with pytest.raises(StopLoopError):
+            collector.run_forever(interval=1)
+    finally:
+        collector.close()
+
+    assert len(ticks) == 2
+    assert metrics.get("traffic_collector.errors") == 2
+
+
+def test_rollup_folds_buckets_and_keeps_totals(session: Session):
+    # Два дня сырых замеров каждые 30 минут
+    for i in range(96):
+        store_samples(session, {("user", "n@a.pro"): (1, 10)}, T0 + i * 1800)
+    session.commit()
+    now = T0 + 2 * DAY
+
+    folded = rollup(session, now)
+    again = rollup(session, now)
+    session.commit()
+
+    by_resolution = {}
+    for row in session.exec(select(TrafficSample)).all():
+        by_resolution[row.resolution] = by_resolution.get(row.resolution, 0) + 1
+    # Последние сутки — сырыми, первые — 24 часовыми бакетами
+    assert by_resolution == {0: 48, HOUR: 24}
+    assert folded["hour"] == 48
+    assert again == {"hour": 0, "day": 0}
+    assert traffic_totals(session, "user") == {"n@a.pro": (96, 960)}
+
+    series = traffic_series(session, "user", "n@a.pro", since=T0, step=DAY)
+    assert series == [(T0, 48, 480), (T0 + DAY, 48, 480)]
+
+
+def test_rollup_hours_into_days(session: Session, monkeypatch):
+    monkeypatch.setattr("app.core.config.settings.TRAFFIC_HOURLY_RETENTION", DAY)
+    for hour in range(24):
+        store_samples(session, {("inbound", "vless-h2"): (0, 7)}, T0 + hour * HOUR)
+    session.commit()
+
+    rollup(session, T0 + 3 * DAY)
+    session.commit()
+
+    rows = session.exec(select(TrafficSample)).all()
+    assert [(r.resolution, r.ts, r.downlink) for r in rows] == [(DAY, T0, 168)]
+
+
+@pytest.mark.asyncio
+async def test_api_user_series(session: Session):
+    session.add(User(nickname="neo", email="n@a.pro", uuid="series-uuid", internal_ip="10.0.8.2"))
+    now = int(time.time()) // HOUR * HOUR
+    store_samples(session, {("user", "n@a.pro"): (1, 2)}, now - HOUR)
+    store_samples(session, {("user", "n@a.pro"): (3, 4)}, now - HOUR + 60)
+    session.commit()
+
+    transport = ASGITransport(app=api)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        ok = await ac.get("/stats/users/series-uuid/series", params={"since": "3h", "step": "1h"})
+        bad = await ac.get("/stats/users/series-uuid/series", params={"since": "soon"})
+
+    assert ok.json()["points"] == [{"ts": now - HOUR, "uplink": 4, "downlink": 6}]
+    assert bad.status_code == 400
+
+
+def test_cli_traffic_history(session: Session):
+    session.add(User(nickname="neo", email="n@a.pro", uuid="u1", internal_ip="10.0.8.2"))
+    store_samples(session, {("user", "n@a.pro"): (0, 5 * 1024**2)}, int(time.time()) - 60)
+    session.commit()
+
+    result = runner.invoke(app, ["mesh", "traffic", "neo", "--since", "1h", "--step", "1h"])
+
+    assert result.exit_code == 0, result.stdout
+    assert "5.00 MB" in result.stdout
+
+
+def test_collector_samples_runtime_with_load(session: Session, xray_stats):
+    session.add(User(nickname="neo", email="n@a.pro", uuid="u1", internal_ip="10.0.8.2"))
+    session.add(User(nickname="cy", email="c@a.pro", uuid="u2", internal_ip="10.0.8.3"))
+    session.commit()
+    collector = TrafficCollector(lambda: Session(engine), address=xray_stats.address)
+    try:
+        xray_stats.add("inbound>>>vless-h2>>>traffic>>>downlink", 700)
+        xray_stats.add("inbound>>>vless-h2>>>traffic>>>uplink", 300)
+        collector.collect_once(now=T0 + 60)
+    finally:
+        collector.close()
+
+    sample = session.exec(select(XraySysSample)).one()
+    assert (sample.ts, sample.goroutines, sample.alloc, sample.uptime) == (
+        T0 + 60,
+        30,
+        50 * 1024**2,
+        600,
+    )
+    assert (sample.users, sample.traffic) == (2, 1000)
+
+
+def test_sys_series_buckets_and_gc_restart(session: Session):
+    for ts, alloc, num_gc, uptime, users in [
+        (T0 - 600, 10, 90, 3000, 5),  # до окна: база для первого приращения
+        (T0, 10, 100, 3600, 5),
+        (T0 + 1800, 30, 140, 5400, 7),
+        (T0 + HOUR, 20, 150, 7200, 9),
+        (T0 + HOUR + 1800, 25, 3, 60, 9),  # рестарт Xray: счетчик GC с нуля
+        (T0 + HOUR + 2400, 25, 8, 660, 9),
+        (T0 + 2 * HOUR, 25, 200, 30, 9),  # рестарт, num_gc уже перерос прежний
+    ]:
+        session.add(
+            XraySysSample(ts=ts, alloc=alloc, num_gc=num_gc, uptime=uptime, users=users, traffic=1)
+        )
+    session.commit()
+
+    series = sys_series(session, since=T0, step=HOUR)
+
+    assert [(p.ts, p.max_alloc, p.gc_runs, p.avg_users, p.traffic) for p in series] == [
+        (T0, 30, 50, 6.0, 2),
+        (T0 + HOUR, 25, 10 + 3 + 5, 9.0, 3),
+        (T0 + 2 * HOUR, 25, 200, 9.0, 1),
+    ]
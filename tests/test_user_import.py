@@ -0,0 +1,178 @@
+import io
+import json
+from unittest.mock import patch
+
+import grpc
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, select
+from typer.testing import CliRunner
+
+from app.cli.__main__ import app
+from app.core.config import settings
+from app.core.models import IpLease, User
+from app.utils import user_import
+from app.utils.ipam import get_next_free_ip
+from app.utils.user_import import ImportRow, RowError, read_rows, run_import
+from benchmarks.fake_xray import DEFAULT_TAGS, FakeXray
+
+runner = CliRunner()
+
+CSV = """nickname,email
+neo,n@a.pro
+bad nick,x@a.pro
+trin,not-an-email
+cy,c@a.pro
+neo,other@a.pro
+old,old@a.pro
+"""
+
+
+@pytest.fixture
+def fake():
+    with FakeXray(seed=3) as xray:
+        yield xray
+
+
+def _import(session: Session, fake: FakeXray, text: str, fmt: str = "csv", **kwargs):
+    rows = read_rows(io.StringIO(text), fmt)
+    return run_import(session, rows, DEFAULT_TAGS, address=fake.address, **kwargs)
+
+
+def test_read_rows_streams_formats():
+    jsonl = '{"nickname": "neo", "email": "n@a.pro", "pool": "main"}\n\n{broken\n[1]\n'
+    rows = list(read_rows(io.StringIO(jsonl), "jsonl"))
+    assert rows[0] == ImportRow(1, "neo", "n@a.pro", "main")
+    assert isinstance(rows[1], RowError) and rows[1].line == 3
+    assert rows[2].error == "expected an object with nickname and email"
+
+    array = json.dumps({"users": [{"nickname": "cy", "email": "c@a.pro", "pool": "nope"}]})
+    assert list(read_rows(io.StringIO(array), "json"))[0].error == "Unknown mesh pool: nope"
+
+    with pytest.raises(ValueError, match="nickname and email"):
+        list(read_rows(io.StringIO("name,mail\nneo,n@a.pro\n"), "csv"))
+
+
+def test_import_reports_bad_rows_and_creates_the_rest(session: Session, fake):
+    session.add(User(nickname="old", email="old@a.pro", uuid="u0", internal_ip="10.0.8.2"))
+    session.commit()
+
+    report = _import(session, fake, CSV, batch_size=2)
+
+    assert report.rows == 6 and report.created == 2
+    assert [(e.line, e.error) for e in report.errors] == [
+        (3, "invalid nickname"),
+        (4, "invalid email"),
+        (6, "duplicate in file"),
+        (7, "nickname already exists"),
+    ]
+    users = {u.nickname: u for u in session.exec(select(User)).all()}
+    assert users["neo"].dns_name == f"neo.{settings.MESH_DOMAIN}"
+    assert users["neo"].internal_ip != users["cy"].internal_ip
+    assert users["neo"].papers_token
+    assert all(fake.users[tag]["n@a.pro"] == users["neo"].uuid for tag in DEFAULT_TAGS)
+    assert session.exec(select(IpLease)).all() == []
+
+
+def test_failed_batch_is_rolled_back_everywhere(session: Session, fake):
+    """Один сбой AlterInbound — ни строки батча в БД, в Xray и в IPAM; соседний батч цел"""
+    fake.fail_next("AlterInbound", code=grpc.StatusCode.INTERNAL)
+    text = "nickname,email\n" + "".join(f"u{i},u{i}@a.pro\n" for i in range(6))
+
+    report = _import(session, fake, text, batch_size=3, inflight=4)
+
+    assert (report.batches, report.failed_batches, report.created) == (2, 1, 3)
+    assert len(report.errors) == 3
+    assert sum(e.error == "batch rolled back" for e in report.errors) == 2
+    created = {u.email for u in session.exec(select(User)).all()}
+    assert created == {"u3@a.pro", "u4@a.pro", "u5@a.pro"}
+    assert fake.emails() == created
+    # Адреса откатившегося батча вернулись в пул и ушли следующему
+    assert session.exec(select(IpLease)).all() == []
+    ips = sorted(u.internal_ip for u in session.exec(select(User)).all())
+    assert ips == ["10.0.8.2", "10.0.8.3", "10.0.8.4"]
+    assert get_next_free_ip(session) == "10.0.8.5"
+
+
+def test_db_failure_after_sync_rolls_batch_back(session: Session, fake, monkeypatch):
+    """Не только IntegrityError: база залочена на confirm — батч убирается из Xray и IPAM"""
+
+    def locked(*args, **kwargs):
+        raise OperationalError("UPDATE ippool", {}, Exception("database is locked"))
+
+    monkeypatch.setattr(user_import, "confirm_ips", locked)
+    text = "nickname,email\nneo,n@a.pro\ncy,c@a.pro\n"
+
+    report = _import(session, fake, text)
+
+    assert (report.created, report.failed_batches) == (0, 1)
+    assert {e.error for e in report.errors} == {"database: database is locked"}
+    assert fake.emails() == set()
+    assert session.exec(select(User)).all() == []
+    assert session.exec(select(IpLease)).all() == []
+
+
+def test_ipam_failure_cancels_reserved_pools(session: Session, fake, monkeypatch):
+    """Резерв второго пула упал после всех повторов — адреса первого сразу возвращаются"""
+    monkeypatch.setattr(settings, "MESH_POOLS", "main=10.0.8.0/24,tiny=10.0.9.0/29")
+    reserve = user_import.reserve_ips
+
+    def flaky(count, pool=None, **kwargs):
+        if pool == "tiny":
+            raise OperationalError("BEGIN IMMEDIATE", {}, Exception("database is locked"))
+        return reserve(count, pool, **kwargs)
+
+    monkeypatch.setattr(user_import, "reserve_ips", flaky)
+    text = "nickname,email,pool\nneo,n@a.pro,main\ncy,c@a.pro,tiny\n"
+
+    report = _import(session, fake, text)
+
+    assert (report.created, report.failed_batches) == (0, 1)
+    assert {e.error for e in report.errors} == {"database: database is locked"}
+    assert fake.emails() == set()
+    assert session.exec(select(IpLease)).all() == []
+    assert get_next_free_ip(session) == "10.0.8.2"
+
+
+def test_existing_users_checked_in_chunks(session: Session, fake, monkeypatch):
+    monkeypatch.setattr(user_import, "IN_CHUNK", 2)
+    session.add(User(nickname="u4", email="u4@a.pro", uuid="u0", internal_ip="10.0.8.200"))
+    session.commit()
+    text = "nickname,email\n" + "".join(f"u{i},u{i}@a.pro\n" for i in range(5))
+
+    report = _import(session, fake, text)
+
+    assert report.created == 4
+    assert [(e.nickname, e.error) for e in report.errors] == [("u4", "nickname already exists")]
+
+
+def test_import_no_sync_and_full_pool(session: Session, fake, monkeypatch):
+    monkeypatch.setattr(settings, "MESH_POOLS", "main=10.0.8.0/24,tiny=10.0.9.0/30")
+    text = "nickname,email,pool\na,a@a.pro,tiny\nb,b@a.pro,tiny\nc,c@a.pro,\n"
+
+    rows = read_rows(io.StringIO(text), "csv")
+    report = run_import(session, rows, DEFAULT_TAGS, sync=False)
+
+    # В /30 один адрес для юзеров: батч с двумя строками целиком не проходит
+    assert report.created == 0
+    assert {e.error for e in report.errors} == {"Mesh subnet is full"}
+    assert fake.emails() == set()
+    assert session.exec(select(IpLease)).all() == []
+
+
+def test_cli_user_import(session: Session, inbounds, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "XRAY_GRPC_ADDR", inbounds.address)
+    source = tmp_path / "users.jsonl"
+    source.write_text(
+        '{"nickname": "neo", "email": "n@a.pro"}\n{"nickname": "", "email": "x@a.pro"}\n'
+    )
+    errors = tmp_path / "errors.csv"
+
+    with patch("app.cli.commands.user.xray") as mocked:
+        mocked.check_connection.return_value = True
+        result = runner.invoke(app, ["user", "import", str(source), "--errors", str(errors)])
+
+    assert result.exit_code == 0, result.stdout
+    assert "1/2 created" in result.stdout
+    assert inbounds.emails() == {"n@a.pro"}
+    assert errors.read_text().splitlines()[1] == "2,,x@a.pro,invalid nickname"
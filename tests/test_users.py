@@ -4,13 +4,17 @@ import pytest
 from sqlmodel import Session, select
 
 from app.cli.commands.user import add_user, list_users, remove_user, toggle_user
-from app.core.models import User
+from app.core.models import IpLease, User
+from app.utils.ipam import get_next_free_ip
 
 
 @pytest.fixture
 def temp_user(session: Session):
     user = User(
-        nickname="Morpheus", email="morph@yourdomain.com", uuid="some-uuid", internal_ip="10.0.8.100"
+        nickname="Morpheus",
+        email="morph@yourdomain.com",
+        uuid="some-uuid",
+        internal_ip="10.0.8.100",
     )
     session.add(user)
     session.commit()
@@ -18,12 +22,13 @@ def temp_user(session: Session):
 
 
 # Тестируем добавление пользователя
-def test_add_user_logic(session: Session):
+def test_add_user_logic(session: Session, wire_fanout):
     nickname = "Neo"
     email = "neo@yourdomain.com"
 
     # Патчим (подменяем) класс XrayControl, чтобы он не лез в сеть
     with patch("app.cli.commands.user.xray") as mocked_xray:
+        wire_fanout(mocked_xray)
         # Имитируем успешные ответы gRPC
         mocked_xray.check_connection.return_value = True
         mocked_xray.add_user.return_value = True
@@ -57,8 +62,9 @@ def test_add_user_xray_offline(session: Session):
 
 
 # 1. Тест удаления
-def test_remove_user_logic(session: Session, temp_user: User):
+def test_remove_user_logic(session: Session, temp_user: User, wire_fanout):
     with patch("app.cli.commands.user.xray") as mocked_xray:
+        wire_fanout(mocked_xray)
         mocked_xray.remove_user.return_value = True
 
         remove_user(temp_user.nickname)
@@ -70,8 +76,9 @@ def test_remove_user_logic(session: Session, temp_user: User):
 
 
 # 2. Тест Бан / Разбан (Toggle)
-def test_toggle_user_logic(session: Session, temp_user: User):
+def test_toggle_user_logic(session: Session, temp_user: User, wire_fanout):
     with patch("app.cli.commands.user.xray") as mocked_xray:
+        wire_fanout(mocked_xray)
         mocked_xray.remove_user.return_value = True
         mocked_xray.add_user.return_value = True
 
@@ -97,8 +104,9 @@ def test_list_users_no_error(session: Session, temp_user: User):
         pytest.fail(f"list_users() raised {e} unexpectedly!")
 
 
-def test_add_user_rollback_on_failure(session: Session):
+def test_add_user_rollback_on_failure(session: Session, wire_fanout):
     with patch("app.cli.commands.user.xray") as mocked_xray:
+        wire_fanout(mocked_xray)
         # Simulate: 1st tag OK, 2nd tag FAIL
         mocked_xray.check_connection.return_value = True
         mocked_xray.add_user.side_effect = [True, False, True]
@@ -113,3 +121,25 @@ def test_add_user_rollback_on_failure(session: Session):
         # 2. Verify DB is empty
         db_user = session.exec(select(User).where(User.nickname == "Glitch")).first()
         assert db_user is None
+
+        # 3. The reserved IP went back to the pool
+        assert session.exec(select(IpLease)).all() == []
+        assert get_next_free_ip(session) == "10.0.8.2"
+
+
+def test_add_user_keeps_user_when_export_fails(session: Session, wire_fanout):
+    """Юзер уже закоммичен: упавший экспорт не откатывает Xray и не возвращает IP"""
+    with (
+        patch("app.cli.commands.user.xray") as mocked_xray,
+        patch("app.cli.commands.user.refresh_static_export", side_effect=OSError("disk full")),
+    ):
+        wire_fanout(mocked_xray)
+        mocked_xray.check_connection.return_value = True
+        mocked_xray.add_user.return_value = True
+
+        add_user("Tank", "tank@matrix.com")
+
+        mocked_xray.remove_user.assert_not_called()
+        db_user = session.exec(select(User).where(User.nickname == "Tank")).first()
+        assert db_user is not None
+        assert get_next_free_ip(session) != db_user.internal_ip